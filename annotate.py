@@ -3,20 +3,57 @@
 Copyright @ Arkhelyi, 2019"""
 
 from collections import defaultdict
-import inspect
+import contextlib
+import math
 from operator import itemgetter
 import os
 import pathlib
 import shutil
 import subprocess
-import yaml
-
-import fire
-import numpy as np
-import pyperclip
-from PIL import Image, ImageDraw
-
-from helpers import ZoneApi, MarksHelper, Position, drop_shadow, m2c, Legend
+import sys
+import time
+
+# fire, numpy, PIL, pyperclip, yaml and the dds encoder are imported by the commands that
+# use them, so that quick commands don't pay for their import
+from cache import (
+    BackupCache,
+    BuildCache,
+    LegendCache,
+    ResponseCache,
+    Snapshot,
+    file_hash,
+    fingerprint,
+)
+from helpers import (
+    config_loader,
+    ZoneApi,
+    MarksHelper,
+    Position,
+    PositionArray,
+    band_rows,
+    blend_multiply,
+    close_pairs,
+    drop_shadow,
+    Legend,
+)
+from parallel import ZoneReport, run_serial
+import profiling
+from profiling import stage, traced
+
+CONFIG_PATH = "data/config.yaml"
+ZONE_INFO_PATH = "data/zone_info.yaml"
+MARKS_PATH = "data/marks.json"
+# Parsed content of the 3 files above, refreshed when they change
+SNAPSHOT_PATH = ".cache/data.pickle"
+
+# Configuration sections that change the rendering of every zone
+RENDER_SECTIONS = ("tool", "marker", "legend", "colors")
+
+# Set by main(), MapAnnotator prints summaries instead of returning values from the CLI
+_CLI = False
+
+# Ranks drawn as quarters and inner disk of a marker, SS and SSs fill the whole marker
+MARKER_RANKS = frozenset(["B1", "B2", "A1", "A2", "S"])
 
 
 class MapAnnotator:
@@ -27,56 +64,129 @@ class MapAnnotator:
     - data/marks.json: static data file mapping a mark to its rank, zone and spawn positions
     - data/config.yaml: configuration for paths, marker style, legend style and position
 
-    In addition to the python requirements, it requires ImageMagick to be installed (path can be in
-    user $PATH or provided in configuration)"""
+    DDS files are encoded in-process. ImageMagick is only required when `tool.dds_encoder` is set to
+    `imagemagick` in the configuration (path can be in user $PATH or provided in configuration)"""
 
     def __init__(self):
-        try:
-            with open("data/config.yaml", "rt", encoding="utf-8") as fp:
-                a = yaml.load_all(fp, Loader=yaml.SafeLoader)
-                self._config = {k: v for i in a for k, v in i.items()}
-        except FileNotFoundError:
-            raise FileNotFoundError(
-                "Configuration file not found at 'data/config.yaml'. "
-                "Please ensure the file exists or run from the correct directory."
-            )
-        except yaml.YAMLError as e:
-            raise ValueError(
-                f"Invalid YAML syntax in 'data/config.yaml': {e}\n"
-                "Check for proper indentation and syntax."
-            )
+        vars(self).update(self._load_state())
+        self._init_caches()
+        self._iscli = _CLI
+
+    def _load_state(self):
+        """Load and validate the data files, return the attributes derived from them.
+
+        Nothing is assigned, so a failed load leaves a running annotator untouched."""
+        data = Snapshot(SNAPSHOT_PATH, [CONFIG_PATH, ZONE_INFO_PATH, MARKS_PATH]).load(
+            self._load_data
+        )
+        config = data["config"]
+        tool = config["tool"]
 
         try:
-            self._base_path = pathlib.Path(
-                self._config["tool"]["textools_path"]
-            ).expanduser()
-            self._project_path = pathlib.Path(
-                self._config["tool"]["project_path"]
-            ).expanduser()
-            self._magickpath = self._config["tool"]["imagemagick_path"] or shutil.which(
-                "magick"
-            )
+            base_path = pathlib.Path(tool["textools_path"]).expanduser()
+            project_path = pathlib.Path(tool["project_path"]).expanduser()
         except KeyError as e:
             raise KeyError(
                 f"Missing required configuration key: {e} in data/config.yaml. "
                 "Please check your configuration file."
             )
+        dds_encoder = tool.get("dds_encoder", "native")
+        if dds_encoder not in ("native", "imagemagick"):
+            raise ValueError(
+                f"Invalid dds_encoder '{dds_encoder}' in config.yaml. "
+                "Use 'native' or 'imagemagick'."
+            )
 
         # Validate ImageMagick path
-        if not self._magickpath:
-            raise FileNotFoundError(
-                "ImageMagick not found. Please install ImageMagick or specify the path in config.yaml"
+        magickpath = tool.get("imagemagick_path") or shutil.which("magick")
+        if dds_encoder == "imagemagick":
+            if not magickpath:
+                raise FileNotFoundError(
+                    "ImageMagick not found. Please install ImageMagick or specify the path in config.yaml"
+                )
+            if not os.path.exists(magickpath):
+                raise FileNotFoundError(
+                    f"ImageMagick path does not exist: {magickpath}"
+                )
+
+        max_memory = tool.get("max_memory")
+        if max_memory is not None and (
+            not isinstance(max_memory, (int, float)) or max_memory <= 0
+        ):
+            raise ValueError(
+                f"Invalid max_memory '{max_memory}' in config.yaml. "
+                "Use a number of megabytes, or null for no budget."
             )
-        if not os.path.exists(self._magickpath):
+
+        zones = config["zones"]
+        Mark, marks = MarksHelper.build_marks(
+            data["marks"], {zone: info["scale"] for zone, info in zones.items()}
+        )
+        cache_path = pathlib.Path(tool.get("cache_path", ".cache")).expanduser()
+        return {
+            "_config": config,
+            "_base_path": base_path,
+            "_project_path": project_path,
+            "_dds_encoder": dds_encoder,
+            "_dds_mipmaps": tool.get("dds_mipmaps", False),
+            "_magickpath": magickpath,
+            "_max_memory": int(max_memory * 2**20) if max_memory else None,
+            "_zones": zones,
+            "_Mark": Mark,
+            "_marks": marks,
+            "_cache_path": cache_path,
+            "_build_cache": BuildCache(cache_path / "builds.json"),
+        }
+
+    def _init_caches(self):
+        """Start with empty in-memory caches, and the disk caches set by `tool`"""
+        self._masks = {}
+        self._blend_scratch = None
+        self._sprites = {}
+        self._font_hash = None
+        self._legend_cache = LegendCache(
+            self._cache_path / "legends",
+            # Under a memory budget, only the legends of the last few zones stay loaded
+            max_entries=8 if self._max_memory else 64,
+            max_files=self._config["tool"].get("legend_cache_size", 512),
+        )
+        self._backup_cache = None
+        if self._config["tool"].get("backup_cache", True):
+            self._backup_cache = BackupCache(self._cache_path / "backups")
+
+    @staticmethod
+    def _load_data():
+        """Parse and validate the configuration, zone info and marks files"""
+        config = MapAnnotator._load_config()
+        zones = config.get("zones") or {}
+        MapAnnotator._zone_api(config).load_zone_info(zones)
+        return {"config": config, "marks": MarksHelper.read_marks(MARKS_PATH)}
+
+    @staticmethod
+    def _load_config():
+        """Parse and validate the configuration file"""
+        import yaml
+
+        try:
+            with open(CONFIG_PATH, "rt", encoding="utf-8") as fp:
+                a = yaml.load_all(fp, Loader=config_loader())
+                config = {k: v for i in a for k, v in i.items()}
+        except FileNotFoundError:
             raise FileNotFoundError(
-                f"ImageMagick path does not exist: {self._magickpath}"
+                "Configuration file not found at 'data/config.yaml'. "
+                "Please ensure the file exists or run from the correct directory."
+            )
+        except yaml.YAMLError as e:
+            raise ValueError(
+                f"Invalid YAML syntax in 'data/config.yaml': {e}\n"
+                "Check for proper indentation and syntax."
             )
 
         # Validate color values
         from PIL import ImageColor
 
         try:
-            colors = self._config.get("colors", {})
+            colors = config.get("colors", {})
             for rank, color in colors.items():
                 ImageColor.getrgb(color)
         except (ValueError, AttributeError):
@@ -85,17 +195,48 @@ class MapAnnotator:
                 "Use named colors (e.g., 'red') or hex codes (e.g., '#FF0000')."
             )
 
-        zones = self._config["zones"]
-        ZoneApi(zones.keys()).load_zone_info(zones)
-        self._zones = zones
-        self._Mark, self._marks = MarksHelper.load_marks("data/marks.json")
-        self._iscli = inspect.stack()[-3].function == "Fire"
+        return config
+
+    @staticmethod
+    def _zone_api(config):
+        """ZoneApi for the configured zones, caching xivapi responses in the cache folder"""
+        tool = config.get("tool") or {}
+        cache_path = pathlib.Path(tool.get("cache_path", ".cache")).expanduser()
+        return ZoneApi(
+            (config.get("zones") or {}).keys(),
+            base_url=tool.get("xivapi_url", "https://xivapi.com"),
+            cache=ResponseCache(
+                cache_path / "http", ttl=tool.get("http_cache_ttl", 7 * 24 * 3600)
+            ),
+        )
+
+    @classmethod
+    def update_zone_info(cls, *stale, full=False):
+        """Fetch the info of the zones missing from data/zone_info.yaml, and of the `stale` zones.
+
+        xivapi responses are cached: stale zones revalidate theirs (a few conditional requests
+        when nothing changed), full=True refreshes every zone. Returns the fetched zones.
+
+        It only needs the configuration, as a MapAnnotator can't be created while zones are
+        missing from data/zone_info.yaml: call MapAnnotator.update_zone_info() first."""
+        config = cls._load_config()
+        zones = config.get("zones") or {}
+        for zone in stale:
+            cls._check_zone(zone, zones)
+        fetched = cls._zone_api(config).refresh_zone_info(stale, full)
+        if not _CLI:
+            return fetched
+        print(f"{len(fetched)} zones fetched from xivapi.")
 
     def _validate_zone(self, name):
         """Validate that a zone name exists in configuration."""
-        if name not in self._zones:
-            available = ", ".join(sorted(self._zones.keys())[:10])
-            total = len(self._zones)
+        self._check_zone(name, self._zones)
+
+    @staticmethod
+    def _check_zone(name, zones):
+        if name not in zones:
+            available = ", ".join(sorted(zones.keys())[:10])
+            total = len(zones)
             if total > 10:
                 available += f"... ({total - 10} more)"
             raise ValueError(
@@ -115,24 +256,11 @@ class MapAnnotator:
         return (base / region / zone / (file + "_m" + bck)).with_suffix("." + ext)
 
     def _get_zone_marks(self, zone, rank_remap=False):
-        marks = {
-            mark.name: (mark.rank, mark.spawns)
-            for mark in self._marks
-            if mark.zone == zone
-        }
-
-        def remap_rank(lmarks, rank):
-            """Given a dictionary {mark_name: mark_rank}, will rewrite the values for the given
-            rank to account for multiple occurences of it.
-            Example: A -> A1, A2"""
-            fmarks = [k for k, v in lmarks.items() if v[0] == rank]
-            for i, m in enumerate(sorted(fmarks)):
-                lmarks[m] = (f"{rank}{i + 1}", lmarks[m][1])
+        """Return the read-only {mark_name: (rank, spawns)} of `zone`.
 
-        if rank_remap:
-            remap_rank(marks, "A")
-            remap_rank(marks, "B")
-        return marks
+        With rank_remap, multiple occurences of the A and B ranks are renamed A1/A2, B1/B2."""
+        zone_marks = self._marks.zone(zone)
+        return zone_marks.remapped if rank_remap else zone_marks.marks
 
     def check_files(self, backup=False):
         """Verify the presence of asset backup files (used as source for map annotation)."""
@@ -144,28 +272,26 @@ class MapAnnotator:
         print("File check complete.")
 
     def check_spawn_points(self, threshold=0.5):
-        """List all spawn points that are closer to each other than `threshold` (default 0.5y)"""
-
-        def distance(s1, s2):
-            from math import sqrt
-
-            return sqrt((s2[0] - s1[0]) ** 2 + (s2[1] - s1[1]) ** 2)
+        """List all spawn points that are closer to each other than `threshold` (default 0.5y)
+
+        Spawn points shared by several marks are counted once, points of different marks
+        are compared with each other as well."""
+        spawns = []
+        zones = []
+        for zone_id, zone in enumerate(self._zones):
+            unique = dict.fromkeys(
+                spawn
+                for _, zone_spawns in self._get_zone_marks(zone).values()
+                for spawn in zone_spawns
+            )
+            spawns.extend((zone, spawn) for spawn in unique)
+            zones.extend([zone_id] * len(unique))
 
         suspicious = defaultdict(list)
-
-        for zone in self._zones:
-            spawnset = defaultdict(list)
-            marks = self._get_zone_marks(zone)
-            for mark, (_, spawns) in marks.items():
-                for spawn in spawns:
-                    spawnset[tuple(spawn)].append(mark)
-
-            spawn_list = list(spawnset.keys())
-            for i1, spawn1 in enumerate(spawn_list):
-                for spawn2 in spawn_list[i1 + 1 :]:
-                    if distance(spawn1, spawn2) <= threshold:
-                        suspicious[zone].append([spawn1, spawn2])
-
+        points = [spawn for _, spawn in spawns]
+        for i1, i2 in close_pairs(points, threshold, zones).tolist():
+            zone, spawn1 = spawns[i1]
+            suspicious[zone].append([spawn1, spawns[i2][1]])
         return suspicious
 
     def backup_files(self, warning=True):
@@ -209,6 +335,41 @@ class MapAnnotator:
 
         Saves are made both in the TexTools folder for easy import and to the map project folder for repo update.
         """
+        with stage("annotate", name):
+            complete_map = self._render_map(name, self._open_map(name))
+            if save:
+                self._save_map(complete_map, name)
+        if self._iscli and show:
+            complete_map.show(title=name)
+            return
+        return complete_map
+
+    def _open_map(self, name):
+        """Open the backup (original) asset of the zone `name`, without copying its pixels"""
+        from PIL import Image
+
+        pixels = self._backup_pixels(name)
+        return Image.frombuffer(
+            "RGBA", pixels.shape[1::-1], pixels, "raw", "RGBA", 0, 1
+        )
+
+    @traced("load_backup")
+    def _backup_pixels(self, name):
+        """Return the decoded backup of the zone `name` as a read-only (h, w, 4) array.
+
+        Decoded backups are memory-mapped from the backup cache, they're only decoded
+        again when the backup file changes."""
+        if self._backup_cache is None:
+            return self._decode_backup(name)
+        return self._backup_cache.load(
+            self._get_path(name, backup=True), lambda: self._decode_backup(name)
+        )
+
+    @traced("decode")
+    def _decode_backup(self, name):
+        import numpy as np
+        from PIL import Image
+
         map_path = self._get_path(name, backup=True)
         if not os.path.exists(map_path):
             raise FileNotFoundError(
@@ -216,13 +377,18 @@ class MapAnnotator:
                 f"Please ensure backup files exist by running backup_files() first."
             )
         try:
-            map_layer = Image.open(map_path)
+            with Image.open(map_path) as map_layer:
+                return np.asarray(map_layer.convert("RGBA"))
         except Image.UnidentifiedImageError:
             raise ValueError(
                 f"Cannot open map file for '{name}': {map_path}. "
                 "File may be corrupted or in an unsupported format."
             )
 
+    def _render_map(self, name, map_layer):
+        """Draw the markers and the legend of the zone `name` over `map_layer`"""
+        from PIL import Image
+
         marker_layer = Image.new("RGBA", map_layer.size, color=(0, 0, 0, 0))
 
         scale = self._zones[name]["scale"]
@@ -233,13 +399,8 @@ class MapAnnotator:
             warnings.warn(
                 f"No marks found for zone '{name}'. Annotated map will be empty."
             )
-        spawns = defaultdict(dict)
-        for mark, (rank, spots) in zone_marks.items():
-            for p in spots:
-                spawns[tuple(p)][mark] = rank
-        for spawn, marks in spawns.items():
-            screen_position = Position(m2c(spawn[0], scale), m2c(spawn[1], scale))
-            self._draw_marker(marker_layer, screen_position, marks)
+        with stage("markers"):
+            self._draw_markers(marker_layer, self._marks.markers(name, scale))
 
         marker_layer = drop_shadow(
             marker_layer,
@@ -248,74 +409,135 @@ class MapAnnotator:
             iterations=self._config["marker"]["shadow_iterations"],
             scale=self._config["marker"]["shadow_scale"],
             direction=self._config["marker"]["shadow_direction"],
+            engine=self._config["marker"].get("shadow_engine", "pillow"),
+            max_bytes=self._tile_bytes,
         )
 
         marks = {name: rank for name, (rank, _) in zone_marks.items()}
-        new_map = Image.alpha_composite(map_layer, marker_layer)
+        with stage("alpha_composite"):
+            new_map = Image.alpha_composite(map_layer, marker_layer)
+        del marker_layer
         legend_rows = self._zones[name]["legend"]["rows"]
         legend_position = Position(*self._zones[name]["legend"]["position"])
-        complete_map = self._draw_legend(new_map, marks, legend_rows, legend_position)
-
-        if save:
-            self._save_map(complete_map, name)
-        if self._iscli and show:
-            complete_map.show(title=name)
-            return
-        return complete_map
+        return self._draw_legend(new_map, marks, legend_rows, legend_position)
 
+    @traced("legend")
     def _draw_legend(self, img, marks, rows, position):
-        legend = Legend(self._config).draw(img.size, position, marks, rows)
-        return Image.alpha_composite(img, legend)
+        key = self._legend_fingerprint(img.size, marks, rows, position)
+        cached = self._legend_cache.get(key)
+        if cached is None:
+            legend = Legend(self._config).render(img.size, position, marks, rows)
+            self._legend_cache.put(key, *legend)
+        else:
+            legend = cached
+        tile, origin = legend
+        img.alpha_composite(tile, origin)
+        return img
+
+    def _legend_fingerprint(self, img_size, marks, rows, position):
+        """Fingerprint of everything a rendered legend depends on"""
+        if self._font_hash is None:
+            try:
+                self._font_hash = file_hash(self._config["legend"]["font"])
+            except OSError:
+                self._font_hash = ""  # Legend reports the missing font
+        return fingerprint(
+            Legend.VERSION,
+            list(img_size),
+            list(marks.items()),
+            rows,
+            list(position),
+            {key: self._config[key] for key in ("legend", "colors")},
+            self._font_hash,
+        )
 
     def _draw_marker(self, img, position, marks):
-        draw = ImageDraw.Draw(img)
+        """Paste the marker of `marks` ({mark_name: rank}) centered on `position`."""
+        return self._draw_markers(img, ((position, marks),))
+
+    def _draw_markers(self, img, markers):
+        """Paste the markers of [(position, {mark_name: rank})], centered on their position.
+
+        Pixel corners of all the markers are computed at once, and markers are drawn once
+        per combination of ranks into a sprite, then reused."""
+        if not markers:
+            return img
+        positions = PositionArray([position for position, _ in markers])
+        origins = positions.floor()
+        # The sub-pixel offset is part of the key so sprites rasterize like a direct draw
+        offsets = (positions - origins).tolist()
+        corners = (origins - self._sprite_margin).xy.astype(int).tolist()
+        for (_, marks), (dx, dy), corner in zip(markers, offsets, corners):
+            ranks = set(marks.values())
+            # There should be only one rank if it's SS or SSs
+            big_rank = next(iter(marks.values())) if ranks & {"SS", "SSs"} else None
+            key = (frozenset(ranks & MARKER_RANKS), big_rank, dx, dy)
+            sprite = self._sprites.get(key)
+            if sprite is None:
+                sprite = self._sprites[key] = self._render_marker(*key)
+            img.paste(sprite, tuple(corner), mask=sprite)
+        return img
+
+    def _render_marker(self, ranks, big_rank, dx, dy):
+        """Draw a marker sprite, its center is at (margin + dx, margin + dy)"""
+        from PIL import Image, ImageDraw
 
         size = self._config["marker"]["size"]
         inner_size = size * self._config["marker"]["inner_size_scale"]
         colors = self._config["colors"]
+        margin = self._sprite_margin
+        sprite = Image.new("RGBA", (2 * margin + 1,) * 2, color=(0, 0, 0, 0))
+        draw = ImageDraw.Draw(sprite)
+        position = Position(margin + dx, margin + dy)
         box = (*(position - 0.5 * size), *(position + 0.5 * size))
         inner_box = (*(position - 0.5 * inner_size), *(position + 0.5 * inner_size))
 
-        angle = 180
         for angle, rank in zip(range(180, 180 + 360, 90), ["B1", "B2", "A1", "A2"]):
-            if rank in marks.values():
+            if rank in ranks:
                 draw.pieslice(
                     box, angle, angle + 90, fill=colors[rank], outline=None, width=0
                 )
-            angle += 90
 
-        if "S" in marks.values():
+        if "S" in ranks:
             draw.ellipse(inner_box, fill=colors["S"], outline=None, width=0)
 
-        if "SS" in marks.values() or "SSs" in marks.values():
-            rank = next(
-                iter(marks.values())
-            )  # There should be only one rank if it's SS or SSs
-            draw.ellipse(box, fill=colors[rank], outline=None, width=0)
-
-        return img
-
-    def _save_map(self, img, name):
-        src = self._get_path(name, ext="bmp")
-        dst = src.with_suffix(".dds")
-        try:
-            img.save(src, format="bmp")
-        except OSError as e:
-            raise OSError(
-                f"Failed to save map '{name}' to {src}: {e}. "
-                "Check available disk space and permissions."
-            )
-        cmd = f'{self._magickpath} convert -define dds:compression=dxt1 -define dds:mipmaps=0 "{src}" "{dst}"'
-        try:
-            subprocess.run(cmd, capture_output=True, check=True, shell=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(
-                f"ImageMagick conversion failed for '{name}'. "
-                f"Command: {cmd}\n"
-                f"Return code: {e.returncode}\n"
-                f"stderr: {e.stderr.decode() if e.stderr else 'N/A'}"
-            ) from e
-        src.unlink()
+        if big_rank is not None:
+            draw.ellipse(box, fill=colors[big_rank], outline=None, width=0)
+
+        return sprite
+
+    @property
+    def _sprite_margin(self):
+        """Distance between a sprite's border and the marker center, fits the marker box"""
+        return math.ceil(0.5 * self._config["marker"]["size"]) + 2
+
+    def _save_map(self, img, name, batch=None):
+        """Save the annotated asset in the TexTools folder, and its copy and png preview in the project folder.
+
+        With a MagickBatch, the dds conversion is queued and the project copy is left to the batch callback."""
+        dst = self._get_path(name, ext="dds")
+        if batch is not None:
+            batch.add(name, img, dst)
+        else:
+            if self._dds_encoder == "imagemagick":
+                self._convert_map(img, name, dst)
+            else:
+                from dds import save_dds
+
+                try:
+                    save_dds(img, dst, mipmaps=self._dds_mipmaps)
+                except OSError as e:
+                    raise OSError(
+                        f"Failed to save map '{name}' to {dst}: {e}. "
+                        "Check available disk space and permissions."
+                    )
+            self._publish_map(name)
+        self._save_preview(img, name)
+
+    @traced("publish")
+    def _publish_map(self, name):
+        """Copy the saved asset to the project folder"""
+        dst = self._get_path(name, ext="dds")
         pdst = self._get_path(name, ext="dds", project=True)
         os.makedirs(os.path.dirname(pdst), exist_ok=True)
         try:
@@ -326,7 +548,10 @@ class MapAnnotator:
                 "Check available disk space and permissions."
             )
 
-        preview_dst = pdst.with_suffix(".png")
+    @traced("preview")
+    def _save_preview(self, img, name):
+        preview_dst = self._get_path(name, ext="png", project=True)
+        os.makedirs(os.path.dirname(preview_dst), exist_ok=True)
         try:
             img.save(preview_dst, format="png")
         except OSError as e:
@@ -335,18 +560,356 @@ class MapAnnotator:
                 "Check available disk space and permissions."
             )
 
-    def annotate_all(self):
+    def _convert_map(self, img, name, dst):
+        """Encode `img` to `dst` with ImageMagick, going through a temporary bmp file"""
+        src = dst.with_suffix(".bmp")
+        try:
+            with stage("bmp"):
+                img.save(src, format="bmp")
+        except OSError as e:
+            raise OSError(
+                f"Failed to save map '{name}' to {src}: {e}. "
+                "Check available disk space and permissions."
+            )
+        mipmaps = "-define dds:mipmaps=0" if not self._dds_mipmaps else ""
+        cmd = f'{self._magickpath} convert -define dds:compression=dxt1 {mipmaps} "{src}" "{dst}"'
+        try:
+            with stage("magick"):
+                subprocess.run(cmd, capture_output=True, check=True, shell=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(
+                f"ImageMagick conversion failed for '{name}'. "
+                f"Command: {cmd}\n"
+                f"Return code: {e.returncode}\n"
+                f"stderr: {e.stderr.decode() if e.stderr else 'N/A'}"
+            ) from e
+        src.unlink()
+
+    def annotate_all(
+        self, workers=None, force=False, dry_run=False, trace=None, trace_memory=False
+    ):
         """Annotate and save all maps.
 
         Saves are made both in the TexTools folder for easy import and to the map project folder for repo update.
-        """
+        With workers=N, zones are spread across N processes. A failing zone doesn't stop the run: the
+        per-zone status is returned (printed from the CLI).
+        When ImageMagick is the dds encoder, maps are converted in batches by a few long-lived processes.
+
+        Zones whose inputs (backup, marks, styles, zone config) didn't change since their last successful
+        build are skipped, unless force=True. dry_run=True only lists the zones that would be rebuilt.
+
+        trace=path saves the time spent in each stage of every zone as a Chrome trace
+        (see profiling), the per-stage summary is printed from the CLI (trace=True for the
+        summary only). trace_memory=True adds the memory peaks of each stage to the trace,
+        at the cost of a slower run. The CLI shows the progress of the run.
+
+        With `tool.max_memory` set in the configuration, large intermediate images are
+        processed in bands to stay within the budget; with workers=N, each process gets
+        an N+1th of it."""
+        stale = self._stale_zones(
+            "annotate", self._annotate_fingerprint, self._annotate_outputs, force
+        )
+        if dry_run:
+            return self._report_dry_run(stale)
+        with self._instrumented("annotate", stale, trace, trace_memory) as progress:
+            report = self._annotate_zones(list(stale), workers, progress)
+        return self._report(self._record_builds("annotate", stale, report))
+
+    def _annotate_zones(self, zones, workers=None, progress=None):
+        """Annotate and save `zones`, return the per-zone report"""
+        from parallel import run_pool
+
+        conversion_errors = {}
+        batch = self._magick_batch(conversion_errors)
+        if workers and workers > 1:
+            report = run_pool(
+                zones,
+                _annotate_worker,
+                workers,
+                initializer=_init_worker,
+                initargs=self._worker_args(workers),
+                prepare=lambda name: self._share_map(name, batch is not None),
+                finish=self._finish_shared(batch),
+                progress=progress,
+            )
+        else:
+
+            def annotate(zone):
+                with stage("annotate", zone):
+                    complete_map = self._render_map(zone, self._open_map(zone))
+                    self._save_map(complete_map, zone, batch)
+
+            report = run_serial(zones, annotate, progress)
+
+        return self._close_batch(batch, conversion_errors, report)
+
+    @contextlib.contextmanager
+    def _instrumented(self, command, zones, trace=None, memory=False):
+        """Show the progress of a batch command from the CLI, and trace it when asked.
+
+        Yields the `progress(zone, report)` callback of the zones, or None."""
+        progress = None
+        if self._iscli and zones:
+            progress = profiling.Progress(len(zones), command)
+        trace = trace or memory
+        tracing = profiling.trace(memory) if trace else contextlib.nullcontext()
+        with tracing as tracer:
+            try:
+                yield progress and progress.update
+            finally:
+                if progress:
+                    progress.close()
+        if tracer is None:
+            return
+        if trace is not True:
+            tracer.save(trace)
+        if self._iscli:
+            print(tracer.summary())
+            if trace is not True:
+                print(f"Trace saved to {trace}")
+
+    @property
+    def _tile_bytes(self):
+        """Temporary memory of an operation done in bands, None without max_memory.
+
+        A quarter of the budget: the rest goes to the full size images a zone needs
+        anyway, its map, marker layer and composite."""
+        return self._max_memory // 4 if self._max_memory else None
+
+    def _worker_args(self, workers):
+        """Initializer arguments of the pool workers: the trace to report to and their
+        share of max_memory"""
+        max_memory = self._max_memory // (workers + 1) if self._max_memory else None
+        return profiling.worker_args(), max_memory
+
+    def _magick_batch(self, conversion_errors):
+        """Return a MagickBatch when ImageMagick is the dds encoder, else None.
+
+        Converted maps are published, failures are collected in `conversion_errors`."""
+        if self._dds_encoder != "imagemagick":
+            return None
+        from dds import MagickBatch
+
+        def on_converted(name, error):
+            if error is None:
+                try:
+                    self._publish_map(name)
+                except OSError as e:
+                    error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                conversion_errors[name] = error
+
+        return MagickBatch(
+            self._magickpath,
+            on_converted,
+            mipmaps=self._dds_mipmaps,
+            batch_size=self._config["tool"].get("imagemagick_batch_size", 16),
+        )
+
+    @staticmethod
+    def _close_batch(batch, conversion_errors, report):
+        """Wait for the last conversions and report their failures"""
+        if batch is not None:
+            batch.close()
+            for zone, error in conversion_errors.items():
+                report[zone] = ZoneReport("failed", error)
+        return report
+
+    def _finish_shared(self, batch):
+        """run_pool `finish` callback: queue the annotated map left in shared memory, then release it"""
+
+        def finish(name, report, shared):
+            try:
+                if batch is not None and report is not None and report.status == "ok":
+                    batch.add(name, shared.array, self._get_path(name, ext="dds"))
+            finally:
+                _release_shared(name, report, shared)
+            return report
+
+        return finish
+
+    def _annotate_fingerprint(self, name):
+        """Fingerprint of everything an annotated map depends on"""
+        return fingerprint(
+            file_hash(self._get_path(name, backup=True)),
+            sorted(self._get_zone_marks(name, True).items()),
+            {key: self._config[key] for key in ("marker", "legend", "colors")},
+            self._zones[name],
+            [self._dds_encoder, self._dds_mipmaps],
+        )
+
+    def _annotate_outputs(self, name):
+        return [
+            self._get_path(name),
+            self._get_path(name, project=True),
+            self._get_path(name, project=True, ext="png"),
+        ]
+
+    def _stale_zones(self, section, fingerprint_func, outputs_func, force=False):
+        """Return {zone: fingerprint} for the zones that need to be rebuilt.
+
+        A zone is stale when its fingerprint differs from its last successful build or when one of
+        its outputs is missing. Zones whose fingerprint can't be computed (e.g. missing backup) are
+        stale with a None fingerprint: the build itself will report the problem."""
+        stale = {}
         for zone in self._zones:
-            self.annotate_map(zone, save=True, show=False)
+            try:
+                zone_fingerprint = fingerprint_func(zone)
+            except (OSError, KeyError):
+                stale[zone] = None  # missing backup, mask or zone setting
+                continue
+            if (
+                force
+                or not self._build_cache.is_fresh(section, zone, zone_fingerprint)
+                or not all(path.exists() for path in outputs_func(zone))
+            ):
+                stale[zone] = zone_fingerprint
+        return stale
+
+    def _record_builds(self, section, stale, report):
+        """Save the fingerprints of successful builds and complete the report with skipped zones"""
+        for zone, zone_report in report.items():
+            if zone_report.status == "ok" and stale[zone] is not None:
+                self._build_cache.record(section, zone, stale[zone])
+            else:
+                self._build_cache.forget(section, zone)
+        self._build_cache.save()
+        return {zone: report.get(zone, ZoneReport("skipped")) for zone in self._zones}
+
+    def _report_dry_run(self, stale):
+        if not self._iscli:
+            return list(stale)
+        for zone in stale:
+            print(f"STALE: '{zone}'")
+        print(f"{len(stale)}/{len(self._zones)} zones would be rebuilt.")
+
+    @traced("share")
+    def _share_map(self, name, deferred=False):
+        """Decode the backup of `name` into shared memory for a pool worker"""
+        from parallel import SharedArray
+
+        shared = SharedArray.create(self._backup_pixels(name))
+        return (shared.spec, deferred), shared
+
+    def _decode_map(self, name):
+        """Return the decoded backup of `name` as a writable (h, w, 4) array"""
+        import numpy as np
+
+        return np.array(self._backup_pixels(name))
+
+    def _report(self, report):
+        """Return the per-zone report, or print a summary of it from the CLI"""
+        if not self._iscli:
+            return report
+        failed = {zone: r for zone, r in report.items() if r.status == "failed"}
+        skipped = [zone for zone, r in report.items() if r.status == "skipped"]
+        for zone, r in failed.items():
+            print(f"FAILED: '{zone}': {r.error}")
+        done = len(report) - len(failed) - len(skipped)
+        print(f"{done}/{len(report)} zones done, {len(skipped)} up to date.")
+
+    def watch(self, interval=0.5, debounce=0.5, save=False, max_updates=None):
+        """Re-render the zones affected by edits of the data files, until interrupted (Ctrl+C).
+
+        The annotator stays loaded between updates. Reloaded marks and configuration are
+        compared with the previous ones: a change of the marker, legend, colors or tool
+        sections re-renders every zone, a change of a zone's configuration or marks only
+        that zone. Updates wait for the files to stay unchanged for `debounce` seconds,
+        then refresh the previews of the affected zones (save=True also saves their assets).
+        max_updates stops watching after that many updates."""
+        stats = self._watched_stats()
+        print(f"Watching {CONFIG_PATH}, {ZONE_INFO_PATH}, {MARKS_PATH}...")
+        updates = 0
+        try:
+            while max_updates is None or updates < max_updates:
+                time.sleep(interval)
+                current = self._watched_stats()
+                if current == stats:
+                    continue
+                # Editors may save in several writes, wait for the files to settle
+                while True:
+                    time.sleep(debounce)
+                    stats, current = current, self._watched_stats()
+                    if current == stats:
+                        break
+                self._refresh(save)
+                updates += 1
+        except KeyboardInterrupt:
+            pass
+
+    @staticmethod
+    def _watched_stats():
+        stats = []
+        for path in (CONFIG_PATH, ZONE_INFO_PATH, MARKS_PATH):
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)  # being replaced by the editor
+        return stats
+
+    def _refresh(self, save=False):
+        """Reload the data files and re-render the changed zones, return their report"""
+        import yaml
+
+        try:
+            zones = self._reload()
+        except (OSError, ValueError, KeyError, TypeError, yaml.YAMLError) as e:
+            # A file being edited can be missing, malformed or hold invalid settings
+            print(f"FAILED: reloading the data files: {type(e).__name__}: {e}")
+            return {}
+
+        def render(zone):
+            complete_map = self._render_map(zone, self._open_map(zone))
+            if save:
+                self._save_map(complete_map, zone)
+            else:
+                self._save_preview(complete_map, zone)
+
+        def show(zone, report):
+            if report.status == "ok":
+                print(f"UPDATED: '{zone}'")
+            else:
+                print(f"FAILED: '{zone}': {report.error}")
+
+        report = run_serial(zones, render, show)
+        if not zones:
+            print("No zone affected.")
+        return report
+
+    def _reload(self):
+        """Load the data files again, keep the caches still valid and return the changed zones.
+
+        The previous state is kept when the files can't be loaded."""
+        state = self._load_state()
+        config, marks = self._config, self._marks
+        vars(self).update(state)
+        changed = self._changed_zones(config, marks)
+        if config["tool"] != self._config["tool"]:
+            self._init_caches()
+        else:
+            self._font_hash = None  # the legend font may have been replaced
+            if any(config[key] != self._config[key] for key in ("marker", "colors")):
+                self._sprites = {}
+        return changed
+
+    def _changed_zones(self, config, marks):
+        """Return the zones rendered differently with `config` and `marks` than with the current data"""
+        if any(config.get(key) != self._config.get(key) for key in RENDER_SECTIONS):
+            return list(self._zones)
+        return [
+            zone
+            for zone in self._zones
+            if config["zones"].get(zone) != self._zones[zone]
+            or marks.zone(zone).remapped != self._marks.zone(zone).remapped
+        ]
 
     def generate_thumbnail_table(self):
         """Generate html code for the collapsable preview tables used in the map repo's README.
 
         Results is copied into the OS' clipboard"""
+        import pyperclip
+
         document = ""
         for expansion, expac_name in self._config["expansions"].items():
             expac_data = defaultdict(list)
@@ -405,7 +968,71 @@ class MapAnnotator:
         """Blend the base asset image (live, likely annotated or backup) with the relevant background.
 
         Saves are in the map project folder for repo update."""
+        with stage("blend", name):
+            blended = self._blend_map(name, from_backup)
+            if save:
+                self._save_blended_map(blended, name)
+        if self._iscli and show:
+            blended.show(title=name)
+            return
+        return blended
+
+    def _blend_map(self, name, from_backup):
+        import numpy as np
+        from PIL import Image
+
+        if from_backup:
+            np_map = self._decode_map(name)
+            np_mask = self._get_mask(name)
+        else:
+            map_file_path = self._get_path(name)
+            if not os.path.exists(map_file_path):
+                raise FileNotFoundError(
+                    f"Map file not found for zone '{name}': {map_file_path}"
+                )
+
+            np_mask = self._get_mask(name)
 
+            try:
+                with stage("decode"), Image.open(map_file_path) as map_layer:
+                    np_map = np.array(map_layer.convert("RGBA"))
+            except Image.UnidentifiedImageError:
+                raise ValueError(
+                    f"Cannot open map file for '{name}': {map_file_path}. "
+                    "File may be corrupted or in an unsupported format."
+                )
+
+        self._check_mask_size(name, np_map.shape[1::-1], np_mask)
+        return Image.fromarray(self._blend(np_map, np_mask))
+
+    @staticmethod
+    def _check_mask_size(name, size, mask):
+        mask_size = mask.shape[1::-1]
+        if tuple(size) != mask_size:
+            raise ValueError(
+                f"Map size {size} does not match mask size {mask_size} for zone '{name}'"
+            )
+
+    @traced("multiply")
+    def _blend(self, pixels, mask):
+        """Multiply `pixels` by `mask` in place, with a scratch buffer kept between zones.
+
+        Under a max_memory budget, the scratch buffer only holds a band of rows."""
+        import numpy as np
+
+        rows = band_rows(pixels.shape[1::-1], 2 * pixels.shape[2], self._tile_bytes)
+        shape = (min(rows, len(pixels)), *pixels.shape[1:])
+        scratch = self._blend_scratch
+        if scratch is None or scratch.shape != shape:
+            # The previous buffer is released before the new one is allocated
+            scratch = self._blend_scratch = None
+            scratch = self._blend_scratch = np.empty(shape, dtype=np.uint16)
+        for top in range(0, len(pixels), rows):
+            band = pixels[top : top + rows]
+            blend_multiply(band, mask[top : top + rows], scratch[: len(band)])
+        return pixels
+
+    def _mask_path(self, name):
         maskpath_map = {
             "ARR": "arrhw",
             "HW": "arrhw",
@@ -416,27 +1043,29 @@ class MapAnnotator:
         }
         maskbase_path = self._project_path / "Blended" / "masks"
         mask_name = maskpath_map[self._zones[name]["expansion"]] + "_mask.png"
-        mask_path = maskbase_path / mask_name
+        return maskbase_path / mask_name
 
-        map_file_path = self._get_path(name, backup=from_backup)
-        if not os.path.exists(map_file_path):
-            raise FileNotFoundError(
-                f"Map file not found for zone '{name}': {map_file_path}"
-            )
+    @traced("mask")
+    def _get_mask(self, name):
+        """Return the blending mask of the zone `name` as a (h, w, 4) array ready to multiply.
 
+        The alpha channel is 255 so that the map's alpha is kept by blend_multiply. Masks are
+        shared by whole expansions so each one is only decoded once."""
+        import numpy as np
+        from PIL import Image
+
+        mask_path = self._mask_path(name)
+        key = str(mask_path)
+        if key in self._masks:
+            return self._masks[key]
+
+        if self._max_memory:
+            self._masks.clear()  # only the mask in use stays loaded
         if not os.path.exists(mask_path):
             raise FileNotFoundError(
                 f"Mask file not found: {mask_path}. "
                 f"Expected mask for expansion '{self._zones[name]['expansion']}'."
             )
-
-        try:
-            map_layer = Image.open(map_file_path)
-        except Image.UnidentifiedImageError:
-            raise ValueError(
-                f"Cannot open map file for '{name}': {map_file_path}. "
-                "File may be corrupted or in an unsupported format."
-            )
         try:
             mask_layer = Image.open(mask_path)
         except Image.UnidentifiedImageError:
@@ -444,43 +1073,347 @@ class MapAnnotator:
                 f"Cannot open mask file: {mask_path}. "
                 "File may be corrupted or in an unsupported format."
             )
+        np_mask = np.array(mask_layer.convert("RGB").convert("RGBA"))
+        np_mask.flags.writeable = False
+        self._masks[key] = np_mask
+        return np_mask
 
-        if map_layer.size != mask_layer.size:
-            raise ValueError(
-                f"Map size {map_layer.size} does not match mask size {mask_layer.size} for zone '{name}'"
+    @traced("save_blended")
+    def _save_blended_map(self, img, name):
+        filepath = self._project_path / "Blended" / (name + ".png")
+        img.save(filepath, format="png")
+
+    def blend_all(
+        self,
+        from_backup=True,
+        workers=None,
+        force=False,
+        dry_run=False,
+        trace=None,
+        trace_memory=False,
+    ):
+        """Blend and save all maps.
+
+        Saves are made in the map project folder for repo update.
+        With workers=N, zones are spread across N processes which read the masks from shared memory.
+        A failing zone doesn't stop the run: the per-zone status is returned (printed from the CLI).
+
+        Zones whose map and mask didn't change since their last successful blend are skipped, unless
+        force=True. dry_run=True only lists the zones that would be blended.
+        trace=path saves a Chrome trace of the run and tool.max_memory applies, see
+        annotate_all."""
+        stale = self._stale_zones(
+            "blend",
+            lambda zone: self._blend_fingerprint(zone, from_backup),
+            self._blend_outputs,
+            force,
+        )
+        if dry_run:
+            return self._report_dry_run(stale)
+        with self._instrumented("blend", stale, trace, trace_memory) as progress:
+            report = self._blend_zones(list(stale), from_backup, workers, progress)
+        return self._report(self._record_builds("blend", stale, report))
+
+    def _blend_zones(self, zones, from_backup=True, workers=None, progress=None):
+        """Blend and save `zones`, return the per-zone report"""
+        from parallel import run_pool
+
+        if not workers or workers <= 1:
+
+            def blend(zone):
+                self.blend_map(zone, save=True, from_backup=from_backup, show=False)
+
+            return run_serial(zones, blend, progress)
+
+        shared_masks = self._share_masks(zones)
+
+        def prepare(zone):
+            self._get_mask(zone)
+            return (from_backup,), None
+
+        try:
+            return run_pool(
+                zones,
+                _blend_worker,
+                workers,
+                initializer=_init_blend_worker,
+                initargs=(
+                    {k: v.spec for k, v in shared_masks.items()},
+                    *self._worker_args(workers),
+                ),
+                prepare=prepare,
+                progress=progress,
             )
+        finally:
+            for shared in shared_masks.values():
+                shared.close()
+                shared.unlink()
+
+    def _share_masks(self, zones):
+        """Copy the masks used by `zones` into shared memory, return {mask path: SharedArray}"""
+        from parallel import SharedArray
 
-        np_map = np.array(map_layer)
-        np_mask = np.array(mask_layer)
-        np_blended = np.zeros(np_map.shape, dtype=np_map.dtype)
-        np_blended[:, :, :3] = (
-            np_map.astype(float)[:, :, :3] * np_mask[:, :, :3] / 255.0
+        shared_masks = {}
+        try:
+            for zone in zones:
+                key = str(self._mask_path(zone))
+                if key in shared_masks:
+                    continue
+                try:
+                    mask = self._get_mask(zone)
+                except (OSError, ValueError):
+                    continue  # reported for each zone by prepare()
+                shared_masks[key] = SharedArray.create(mask)
+        except BaseException:
+            for shared in shared_masks.values():
+                shared.close()
+                shared.unlink()
+            raise
+        return shared_masks
+
+    def _blend_fingerprint(self, name, from_backup):
+        """Fingerprint of everything a blended map depends on"""
+        return fingerprint(
+            file_hash(self._get_path(name, backup=from_backup)),
+            file_hash(self._mask_path(name)),
+            from_backup,
         )
-        np_blended[:, :, 3] = np_map[:, :, 3]
-        blended = Image.fromarray(np_blended)
 
-        if save:
-            self._save_blended_map(blended, name)
-        if self._iscli and show:
-            blended.show(title=name)
+    def _blend_outputs(self, name):
+        return [self._project_path / "Blended" / (name + ".png")]
+
+    def build_map(self, name, composite=False):
+        """Produce every output of the zone `name` from a single decode of its backup.
+
+        Writes what annotate_map(save=True) and blend_map(save=True) write: the annotated
+        asset and its png preview, and the blended backup. With composite=True, the
+        annotated map is also blended and saved in the project's Blended/Annotated folder."""
+        with stage("build", name):
+            images = self._build_zone(name, self._decode_map(name), composite)
+        if self._iscli:
             return
-        return blended
+        return images
+
+    def _build_zone(self, name, pixels, composite=False, batch=None, deferred=False):
+        """Save the outputs of `name` from its decoded backup `pixels`, which ends up blended.
+
+        The decoded map feeds both the annotation and the blend, and the annotated map feeds
+        the asset, the preview and the composite. With `deferred`, only the preview of the
+        annotated map is saved: the caller converts it. Returns {output: image}."""
+        from PIL import Image
+
+        mask = self._get_mask(name)
+        self._check_mask_size(name, pixels.shape[1::-1], mask)
+        # Rendering doesn't modify its input, pixels can then be blended in place
+        annotated = self._render_map(name, Image.fromarray(pixels))
+        if deferred:
+            self._save_preview(annotated, name)
+        else:
+            self._save_map(annotated, name, batch)
+
+        images = {"annotated": annotated}
+        images["blended"] = Image.fromarray(self._blend(pixels, mask))
+        self._save_blended_map(images["blended"], name)
+        if composite:
+            import numpy as np
+
+            images["composite"] = Image.fromarray(
+                self._blend(np.array(annotated), mask)
+            )
+            path = self._composite_path(name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with stage("save_composite"):
+                images["composite"].save(path, format="png")
+        return images
+
+    def _composite_path(self, name):
+        return self._project_path / "Blended" / "Annotated" / (name + ".png")
+
+    def build_all(
+        self,
+        workers=None,
+        force=False,
+        dry_run=False,
+        composite=False,
+        trace=None,
+        trace_memory=False,
+    ):
+        """Produce every output of all zones, decoding each backup once (see build_map).
+
+        Takes the same options as annotate_all: workers=N spreads the zones across N
+        processes, zones whose inputs didn't change since their last successful build are
+        skipped unless force=True, dry_run=True only lists the zones to rebuild and
+        trace=path saves a Chrome trace of the run. tool.max_memory applies as well."""
+        stale = self._stale_zones(
+            "build",
+            lambda zone: self._build_fingerprint(zone, composite),
+            lambda zone: self._build_outputs(zone, composite),
+            force,
+        )
+        if dry_run:
+            return self._report_dry_run(stale)
+        with self._instrumented("build", stale, trace, trace_memory) as progress:
+            report = self._build_zones(list(stale), workers, composite, progress)
+        return self._report(self._record_builds("build", stale, report))
+
+    def _build_zones(self, zones, workers=None, composite=False, progress=None):
+        """Build `zones`, return the per-zone report"""
+        from parallel import run_pool
+
+        conversion_errors = {}
+        batch = self._magick_batch(conversion_errors)
+        if workers and workers > 1:
+            shared_masks = self._share_masks(zones)
+
+            def prepare(zone):
+                self._get_mask(zone)
+                args, shared = self._share_map(zone, batch is not None)
+                return (*args, composite), shared
 
-    def _save_blended_map(self, img, name):
-        filepath = self._project_path / "Blended" / (name + ".png")
-        img.save(filepath, format="png")
+            try:
+                report = run_pool(
+                    zones,
+                    _build_worker,
+                    workers,
+                    initializer=_init_blend_worker,
+                    initargs=(
+                        {k: v.spec for k, v in shared_masks.items()},
+                        *self._worker_args(workers),
+                    ),
+                    prepare=prepare,
+                    finish=self._finish_shared(batch),
+                    progress=progress,
+                )
+            finally:
+                for shared in shared_masks.values():
+                    shared.close()
+                    shared.unlink()
+        else:
+
+            def build(zone):
+                with stage("build", zone):
+                    self._build_zone(zone, self._decode_map(zone), composite, batch)
+
+            report = run_serial(zones, build, progress)
+        return self._close_batch(batch, conversion_errors, report)
+
+    def _build_fingerprint(self, name, composite):
+        return fingerprint(
+            self._annotate_fingerprint(name),
+            self._blend_fingerprint(name, True),
+            composite,
+        )
 
-    def blend_all(self, from_backup=True):
-        """Blend and save all maps.
+    def _build_outputs(self, name, composite):
+        paths = self._annotate_outputs(name) + self._blend_outputs(name)
+        if composite:
+            paths.append(self._composite_path(name))
+        return paths
 
-        Saves are made in the map project folder for repo update."""
-        for zone in self._zones:
-            self.blend_map(zone, save=True, from_backup=from_backup, show=False)
+
+_worker = None
+_shared_masks = {}
+
+
+def _init_worker(trace=None, max_memory=None):
+    """Pool initializer: every worker process loads its own MapAnnotator.
+
+    `trace` is the profiling.worker_args() of the parent's trace, if any, and
+    `max_memory` the worker's share of the memory budget."""
+    global _worker
+    profiling.start_worker(trace)
+    _worker = MapAnnotator()
+    if max_memory:
+        _worker._max_memory = max_memory
+
+
+def _annotate_worker(name, spec, deferred):
+    """Annotate the shared map of `name` and save it.
+
+    When `deferred`, only the preview is saved and the annotated map is written back in
+    place, for the parent to convert from shared memory."""
+    import numpy as np
+    from PIL import Image
+
+    from parallel import SharedArray
+
+    shared = SharedArray.attach(spec)
+    try:
+        with stage("annotate", name):
+            complete_map = _worker._render_map(name, Image.fromarray(shared.array))
+            if deferred:
+                shared.array[...] = np.asarray(complete_map)
+                _worker._save_preview(complete_map, name)
+            else:
+                _worker._save_map(complete_map, name)
+    finally:
+        shared.close()
+        profiling.flush()
+    return ZoneReport("ok")
+
+
+def _init_blend_worker(mask_specs, trace=None, max_memory=None):
+    """Pool initializer: load a MapAnnotator whose mask cache points to shared memory"""
+    from parallel import SharedArray
+
+    global _shared_masks
+    _init_worker(trace, max_memory)
+    _shared_masks = {key: SharedArray.attach(spec) for key, spec in mask_specs.items()}
+    for key, shared in _shared_masks.items():
+        shared.array.flags.writeable = False
+        _worker._masks[key] = shared.array
+
+
+def _build_worker(name, spec, deferred, composite):
+    """Build every output of the shared map of `name`, see MapAnnotator.build_map.
+
+    The map is blended in place; when `deferred`, the annotated map is written back
+    instead, for the parent to convert."""
+    import numpy as np
+
+    from parallel import SharedArray
+
+    shared = SharedArray.attach(spec)
+    try:
+        with stage("build", name):
+            images = _worker._build_zone(
+                name, shared.array, composite, deferred=deferred
+            )
+            annotated = images.pop("annotated")
+            del images  # views of the shared block, they'd keep it mapped
+            if deferred:
+                shared.array[...] = np.asarray(annotated)
+    finally:
+        shared.close()
+        profiling.flush()
+    return ZoneReport("ok")
+
+
+def _blend_worker(name, from_backup):
+    try:
+        _worker.blend_map(name, from_backup=from_backup, save=True, show=False)
+    finally:
+        profiling.flush()
+    return ZoneReport("ok")
+
+
+def _release_shared(name, report, shared):
+    shared.close()
+    shared.unlink()
+    return report
 
 
 def main():
     """CLI entry point for ffxiv-huntmaps-maker."""
-    fire.Fire(MapAnnotator)
+    import fire
+
+    global _CLI
+    _CLI = True
+    if sys.argv[1:2] == ["update_zone_info"]:
+        # Fire would create a MapAnnotator first, which fails on the zones to fetch
+        fire.Fire(MapAnnotator.update_zone_info, sys.argv[2:], "update_zone_info")
+    else:
+        fire.Fire(MapAnnotator)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+"""Benchmarks of the rendering hot paths on synthetic data.
+
+    python bench.py run --scale=10             # time the suite, compare with the baseline
+    python bench.py run --scale=10 --baseline  # record the baseline of this machine
+    python bench.py compare old.json new.json --threshold=0.1
+
+Synthetic data is modelled on the real data files (47 zones, about 5 marks of 13 spawns
+per zone) at `scale` times their size: scale times the zones, each with the real density
+of marks. Zone 0 is the rendered one, it gets scale times the spawns of an average zone
+so that marker drawing and shadows scale too. Maps are 2048x2048, the size of the game
+assets, with the marker and legend styles of data/config.yaml.
+
+Results are json files in bench/: `baseline-<scale>x.json` for the baselines and
+`results/<scale>x-<date>.json` for the runs. Comparisons use the fastest repeat of each
+benchmark and flag those slower than the baseline by more than `threshold`."""
+
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent / "bench"
+CONFIG_PATH = pathlib.Path(__file__).resolve().parent / "data" / "config.yaml"
+
+# Size of the real data files: zones, marks per zone and spawns per mark
+REAL_ZONES = 47
+RANKS = ["A", "A", "B", "B", "S"]
+SPAWNS_PER_MARK = 13
+# Coordinate range of the spawns of a scale 100 zone
+COORDINATES = (1.0, 41.0)
+
+FONTS = [
+    r"C:\WINDOWS\FONTS\CORBELI.TTF",
+    r"C:\Windows\Fonts\arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+]
+
+# Set by main(), results are printed instead of returned from the CLI
+_CLI = False
+
+
+def make_data(scale=1, seed=0):
+    """Return synthetic (zones config, zone info, marks) at `scale` times the real size"""
+    import yaml
+
+    from helpers import config_loader
+
+    with open(CONFIG_PATH, "rt", encoding="utf-8") as fp:
+        expansions = list(yaml.load(fp, Loader=config_loader())["expansions"])
+    rng = random.Random(seed)
+    zones, zone_info, marks = {}, {}, []
+    for i in range(REAL_ZONES * scale):
+        zone = f"Zone {i}"
+        zones[zone] = {
+            "expansion": expansions[i % len(expansions)],
+            "landmine": False,
+            "legend": {"rows": 2, "position": [60, 60]},
+        }
+        zone_info[zone] = {
+            "region": f"Region {i % 6}",
+            "scale": 100,
+            "filename": f"z{i}f1",
+        }
+        spawns = SPAWNS_PER_MARK * (scale if i == 0 else 1)
+        for j, rank in enumerate(RANKS):
+            marks.append(
+                {
+                    "name": f"Mark {i}-{j}",
+                    "rank": rank,
+                    "zone": zone,
+                    "spawns": [
+                        [round(rng.uniform(*COORDINATES), 1) for _ in range(2)]
+                        for _ in range(spawns)
+                    ],
+                }
+            )
+    return zones, zone_info, marks
+
+
+def make_workspace(path, scale=1, seed=0, map_size=2048, maps=1):
+    """Write a synthetic workspace in `path`: data files, backups of the first `maps` zones and masks"""
+    import numpy as np
+    import yaml
+    from PIL import Image
+
+    from dds import save_dds
+    from helpers import config_loader
+
+    path = pathlib.Path(path)
+    with open(CONFIG_PATH, "rt", encoding="utf-8") as fp:
+        config = {
+            k: v
+            for d in yaml.load_all(fp, Loader=config_loader())
+            for k, v in d.items()
+        }
+    zones, zone_info, marks = make_data(scale, seed)
+    config["zones"] = zones
+    config["tool"] = dict(
+        config["tool"],
+        textools_path=str(path / "textools"),
+        project_path=str(path / "project"),
+        dds_encoder="native",
+    )
+    if not os.path.exists(config["legend"]["font"]):
+        font = next((font for font in FONTS if os.path.exists(font)), None)
+        if font is None:
+            raise FileNotFoundError(
+                f"No font found for the legend, tried: {', '.join(FONTS)}. "
+                "Set legend.font in data/config.yaml to an existing font file."
+            )
+        config["legend"]["font"] = font
+
+    # The tuple tag isn't known to safe_dump, and yaml.dump would write python tags
+    def untuple(value):
+        if isinstance(value, tuple):
+            return f"({', '.join(map(str, value))})"
+        if isinstance(value, dict):
+            return {k: untuple(v) for k, v in value.items()}
+        return value
+
+    (path / "data").mkdir(parents=True, exist_ok=True)
+    with open(path / "data" / "config.yaml", "wt", encoding="utf-8") as fp:
+        yaml.safe_dump(untuple(config), fp, sort_keys=False)
+    with open(path / "data" / "zone_info.yaml", "wt", encoding="utf-8") as fp:
+        yaml.safe_dump(zone_info, fp, sort_keys=False)
+    with open(path / "data" / "marks.json", "wt", encoding="utf-8") as fp:
+        json.dump(marks, fp)
+
+    rng = np.random.default_rng(seed)
+    # Parchment-like backgrounds: a warm gradient with some grain
+    gradient = np.linspace(150, 220, map_size, dtype=np.float32)
+    for zone in list(zones)[:maps]:
+        grain = rng.normal(0, 12, (map_size, map_size, 1)).astype(np.float32)
+        rgb = gradient[None, :, None] * [1.0, 0.9, 0.7] + grain
+        info = zone_info[zone]
+        folder = path / "textools" / "Saved" / "UI" / "Maps" / info["region"] / zone
+        folder.mkdir(parents=True, exist_ok=True)
+        save_dds(
+            np.clip(rgb, 0, 255).astype(np.uint8),
+            folder / f"{info['filename']}_m_backup.dds",
+        )
+    masks = path / "project" / "Blended" / "masks"
+    masks.mkdir(parents=True, exist_ok=True)
+    for mask in ("arrhw", "sb", "shb"):
+        noise = Image.effect_noise((map_size, map_size), 30).convert("RGB")
+        noise.save(masks / f"{mask}_mask.png")
+    return path
+
+
+@contextlib.contextmanager
+def workspace(scale=1, seed=0, map_size=2048):
+    """Generate a temporary synthetic workspace and work from it"""
+    path = pathlib.Path(tempfile.mkdtemp(prefix="huntmaps-bench-"))
+    cwd = os.getcwd()
+    try:
+        make_workspace(path, scale, seed, map_size)
+        os.chdir(path)
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def cases():
+    """Return {name: callable} of the benchmarks, to run from a synthetic workspace"""
+    from PIL import Image
+
+    from annotate import MapAnnotator
+    from helpers import Legend, Position, drop_shadow
+
+    annotator = MapAnnotator()
+    config = annotator._config
+    zone = "Zone 0"
+    size = annotator._open_map(zone).size
+    marker_layer = Image.new("RGBA", size, color=(0, 0, 0, 0))
+    annotator._draw_markers(marker_layer, annotator._marks.markers(zone, 100))
+    marks = {
+        name: rank for name, (rank, _) in annotator._get_zone_marks(zone, True).items()
+    }
+    legend = Legend(config)
+    shadow = {
+        "offset": Position(*config["marker"]["shadow_offset"]),
+        "shadow_color": config["marker"]["shadow_color"],
+        "iterations": config["marker"]["shadow_iterations"],
+        "engine": config["marker"].get("shadow_engine", "pillow"),
+    }
+    zones = list(annotator._zones)
+
+    return {
+        "annotate_map": lambda: annotator.annotate_map(zone, show=False),
+        "blend_map": lambda: annotator.blend_map(zone, show=False),
+        "drop_shadow": lambda: drop_shadow(marker_layer, **shadow),
+        "drop_shadow_radial": lambda: drop_shadow(
+            marker_layer, direction="radial", **shadow
+        ),
+        "legend_draw": lambda: legend.draw(size, Position(60, 60), marks, 2),
+        "get_zone_marks": lambda: [annotator._get_zone_marks(z, True) for z in zones],
+        "check_spawn_points": annotator.check_spawn_points,
+    }
+
+
+def measure(func, repeats=5, min_time=0.05):
+    """Time `func`: loops are grown until a repeat lasts `min_time`, the first run warms caches"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time or number >= 10**6:
+            break
+        number *= 10
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "number": number,
+        "repeats": repeats,
+    }
+
+
+def metadata(scale):
+    import numpy as np
+    import PIL
+
+    return {
+        "scale": scale,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def run(scale=1, repeats=5, only=None, baseline=False, threshold=0.1, map_size=2048):
+    """Run the suite on synthetic data at `scale` times the real size and save the results.
+
+    `only` is a comma separated list of benchmarks. The results are saved as the baseline
+    of this scale with baseline=True, otherwise in bench/results and compared with the
+    baseline when there is one (see compare)."""
+    if isinstance(only, str):
+        only = only.split(",")
+    results = {}
+    with workspace(scale, map_size=map_size):
+        for name, func in cases().items():
+            if only and name not in only:
+                continue
+            results[name] = measure(func, repeats)
+            if _CLI:
+                print(f"{name:<20} {_format(results[name]['min'])}")
+    report = {"meta": metadata(scale), "results": results}
+
+    if baseline:
+        path = BENCH_DIR / f"baseline-{scale}x.json"
+    else:
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = BENCH_DIR / "results" / f"{scale}x-{stamp}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wt", encoding="utf-8") as fp:
+        json.dump(report, fp, indent=1)
+    if _CLI:
+        print(f"Results saved to {path}")
+
+    baseline_path = BENCH_DIR / f"baseline-{scale}x.json"
+    if not baseline and baseline_path.exists():
+        return compare(baseline_path, path, threshold)
+    if not _CLI:
+        return report
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare two result files and flag the benchmarks slower by more than `threshold`.
+
+    Returns {name: relative change of the fastest repeat} of the regressions; from the
+    CLI, prints the comparison and exits with status 1 when there are regressions."""
+    with open(baseline, "rt", encoding="utf-8") as fp:
+        old = json.load(fp)
+    with open(current, "rt", encoding="utf-8") as fp:
+        new = json.load(fp)
+    if old["meta"].get("scale") != new["meta"].get("scale"):
+        raise ValueError(
+            f"Results at different scales can't be compared: {baseline} is at "
+            f"{old['meta'].get('scale')}x, {current} at {new['meta'].get('scale')}x."
+        )
+
+    regressions = {}
+    lines = [f"{'benchmark':<20} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            lines.append(f"{name:<20} {'-':>10} {_format(result['min']):>10}")
+            continue
+        change = result["min"] / old["results"][name]["min"] - 1
+        flag = ""
+        if change > threshold:
+            regressions[name] = change
+            flag = "  REGRESSION"
+        lines.append(
+            f"{name:<20} {_format(old['results'][name]['min']):>10} "
+            f"{_format(result['min']):>10} {change:>+8.1%}{flag}"
+        )
+    if not _CLI:
+        return regressions
+    print("\n".join(lines))
+    for key in ("python", "numpy", "pillow", "platform"):
+        if old["meta"].get(key) != new["meta"].get(key):
+            print(
+                f"Note: {key} changed from {old['meta'].get(key)} to {new['meta'].get(key)}"
+            )
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower by more than {threshold:.0%}.")
+        sys.exit(1)
+
+
+def _format(seconds):
+    for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= factor:
+            return f"{seconds / factor:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+def main():
+    import fire
+
+    global _CLI
+    _CLI = True
+    fire.Fire({"run": run, "compare": compare})
+
+
+if __name__ == "__main__":
+    main()
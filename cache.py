@@ -0,0 +1,372 @@
+"""On-disk caches used to avoid redoing work between runs.
+
+- BuildCache: fingerprints of the inputs of each zone's last successful build, so that
+  batch commands only rebuild the zones whose inputs changed
+- LegendCache: rendered legend tiles, keyed by a fingerprint of what they're drawn from
+- Snapshot: parsed data files, reused as long as the files don't change
+- BackupCache: decoded map backups, memory-mapped instead of decoded again
+- ResponseCache: HTTP responses, reused for a while then revalidated"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(*parts):
+    """sha256 hex digest of json-serializable parts (dict keys are sorted)"""
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BuildCache:
+    """Manifest of the input fingerprints of the last successful build of each zone.
+
+    Fingerprints are grouped by section (one per batch command) and persisted as json."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(self.path, "rt", encoding="utf-8") as fp:
+                self._manifest = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._manifest = {}
+
+    def is_fresh(self, section, zone, zone_fingerprint):
+        """Whether the last successful build of `zone` had the same fingerprint"""
+        return self._manifest.get(section, {}).get(zone) == zone_fingerprint
+
+    def record(self, section, zone, zone_fingerprint):
+        self._manifest.setdefault(section, {})[zone] = zone_fingerprint
+
+    def forget(self, section, zone):
+        self._manifest.get(section, {}).pop(zone, None)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wt", encoding="utf-8") as fp:
+            json.dump(self._manifest, fp, indent=1, sort_keys=True, ensure_ascii=False)
+        tmp.replace(self.path)
+
+
+class LegendCache:
+    """Rendered legend tiles, kept in memory and on disk with LRU eviction.
+
+    A tile is stored as `<key>.png` with its position on the map in a text chunk. Disk
+    hits refresh the file's mtime, and the least recently used files are removed once
+    there are more than `max_files` of them."""
+
+    def __init__(self, directory, max_entries=64, max_files=512):
+        self.directory = Path(directory)
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_files = max_files
+
+    def get(self, key):
+        """Return the (tile, origin) stored under `key`, or None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        from PIL import Image
+
+        path = self._path(key)
+        try:
+            with Image.open(path) as img:
+                origin = tuple(int(v) for v in img.text["origin"].split(","))
+                tile = img.convert("RGBA")
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return self._remember(key, (tile, origin))
+
+    def put(self, key, tile, origin):
+        from PIL import PngImagePlugin
+
+        self._remember(key, (tile, tuple(origin)))
+        info = PngImagePlugin.PngInfo()
+        info.add_text("origin", ",".join(str(int(v)) for v in origin))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Unique per process, pool workers may render the same legend at the same time
+        tmp = self._path(key).with_suffix(f".{os.getpid()}.tmp")
+        tile.save(tmp, format="PNG", pnginfo=info, compress_level=1)
+        tmp.replace(self._path(key))
+        self._evict_files()
+
+    def _path(self, key):
+        return self.directory / f"{key}.png"
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _evict_files(self):
+        files = []
+        for path in self.directory.glob("*.png"):
+            try:
+                files.append((path.stat().st_mtime_ns, path))
+            except FileNotFoundError:
+                pass  # evicted by another process
+        files.sort()
+        for _, path in files[: max(len(files) - self._max_files, 0)]:
+            path.unlink(missing_ok=True)
+
+
+class Snapshot:
+    """Pickled result of parsing a set of source files, rebuilt when one of them changes.
+
+    Sources are compared by mtime and size first, then by content hash when those
+    differ, so touching a file doesn't cause a rebuild."""
+
+    VERSION = 1
+
+    def __init__(self, path, sources):
+        self.path = Path(path)
+        self.sources = [str(source) for source in sources]
+
+    def load(self, build):
+        """Return the snapshot's data, or `build()` it and save it when stale"""
+        try:
+            stats = {source: self._stat(source) for source in self.sources}
+        except OSError:
+            return build()  # let build() report the missing source
+        state = self._read()
+        if state is not None:
+            recorded = state["sources"]
+            if all(recorded[s][:2] == stats[s] for s in self.sources):
+                return state["data"]
+            hashes = {s: file_hash(s) for s in self.sources}
+            if all(recorded[s][2] == hashes[s] for s in self.sources):
+                self._write(state["data"], stats, hashes)
+                return state["data"]
+        else:
+            hashes = {s: file_hash(s) for s in self.sources}
+        # Stats and hashes are taken before parsing, so an edit made meanwhile is
+        # picked up by the next load
+        data = build()
+        self._write(data, stats, hashes)
+        return data
+
+    @staticmethod
+    def _stat(source):
+        stat = os.stat(source)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fp:
+                state = pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if (
+            not isinstance(state, dict)
+            or state.get("version") != self.VERSION
+            or set(state.get("sources", ())) != set(self.sources)
+        ):
+            return None
+        return state
+
+    def _write(self, data, stats, hashes):
+        state = {
+            "version": self.VERSION,
+            "sources": {s: [*stats[s], hashes[s]] for s in self.sources},
+            "data": data,
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "wb") as fp:
+                pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp.replace(self.path)
+        except OSError:
+            pass  # read-only location, the data is parsed on every run
+
+
+class BackupCache:
+    """Decoded RGBA pixels of image files, stored raw and memory-mapped on load.
+
+    `manifest.json` records the size, mtime and content hash of each source next to the
+    shape and name of its raw file. Sources are compared like Snapshot does: by mtime
+    and size, then by hash, so re-exporting an identical backup keeps its entry."""
+
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._manifest = None
+
+    def load(self, source, decode):
+        """Return the pixels of `source` as a read-only (h, w, 4) uint8 array.
+
+        `decode()` returns the pixels as an array when there's no valid entry; the result
+        is then stored for the next loads."""
+        source = str(source)
+        try:
+            stat = Snapshot._stat(source)
+        except OSError:
+            return decode()  # let decode() report the missing source
+        entry = self._entries().get(source)
+        pixels = self._map(entry) if entry is not None else None
+        if pixels is not None and entry["stat"] == stat:
+            return pixels
+        content_hash = file_hash(source)
+        if pixels is not None and entry["hash"] == content_hash:
+            self._record(source, dict(entry, stat=stat))
+            return pixels
+        # Stat and hash are taken before decoding, so an edit made meanwhile is picked
+        # up by the next load
+        return self._store(source, decode(), stat, content_hash)
+
+    def _entries(self):
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+        return self._manifest
+
+    def _read_manifest(self):
+        try:
+            with open(self.directory / "manifest.json", "rt", encoding="utf-8") as fp:
+                manifest = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        if not isinstance(manifest, dict) or manifest.get("version") != self.VERSION:
+            return {}
+        return manifest.get("entries", {})
+
+    def _map(self, entry):
+        import numpy as np
+
+        path = self.directory / entry["file"]
+        shape = tuple(entry["shape"])
+        try:
+            if path.stat().st_size != np.prod(shape):
+                return None
+            return np.memmap(path, dtype=np.uint8, mode="r", shape=shape)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, source, pixels, stat, content_hash):
+        import numpy as np
+
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        name = f"{fingerprint(source)}.rgba"
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = (self.directory / name).with_suffix(f".{os.getpid()}.tmp")
+            pixels.tofile(tmp)
+            tmp.replace(self.directory / name)
+        except OSError:
+            # Read-only location, or the previous file is still mapped on Windows: the
+            # backup is decoded again next time
+            return pixels
+        entry = {
+            "stat": stat,
+            "hash": content_hash,
+            "shape": list(pixels.shape),
+            "file": name,
+        }
+        self._record(source, entry)
+        return self._map(entry)
+
+    def _record(self, source, entry):
+        # Re-read to keep the entries written by other processes meanwhile
+        entries = self._read_manifest()
+        entries[source] = entry
+        self._manifest = entries
+        try:
+            tmp = self.directory / f"manifest.{os.getpid()}.tmp"
+            with open(tmp, "wt", encoding="utf-8") as fp:
+                json.dump(
+                    {"version": self.VERSION, "entries": entries},
+                    fp,
+                    indent=1,
+                    sort_keys=True,
+                    ensure_ascii=False,
+                )
+            tmp.replace(self.directory / "manifest.json")
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    """Successful HTTP responses kept on disk, reused for `ttl` seconds then revalidated.
+
+    Each response is a json file named after its url, with its body, the time it was
+    stored and its validators (ETag, Last-Modified). Once expired, an entry provides the
+    headers of a conditional request; a 304 answer makes it fresh again."""
+
+    def __init__(self, directory, ttl=7 * 24 * 3600):
+        self.directory = Path(directory)
+        self.ttl = ttl
+
+    def get(self, url):
+        """Return the entry stored for `url`, or None"""
+        try:
+            with open(self._path(url), "rt", encoding="utf-8") as fp:
+                entry = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return entry if isinstance(entry, dict) and entry.get("url") == url else None
+
+    def is_fresh(self, entry):
+        return time.time() - entry["stored"] < self.ttl
+
+    @staticmethod
+    def validators(entry):
+        """Headers of a conditional request revalidating `entry`"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url, body, headers):
+        """Store a response body with the validators found in its `headers`"""
+        entry = {
+            "url": url,
+            "stored": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "body": body,
+        }
+        self._write(url, entry)
+        return entry
+
+    def touch(self, url, entry):
+        """Mark `entry` as fresh again, after the server confirmed it's unchanged"""
+        entry = dict(entry, stored=time.time())
+        self._write(url, entry)
+        return entry
+
+    def _path(self, url):
+        return self.directory / f"{fingerprint(url)}.json"
+
+    def _write(self, url, entry):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Unique per thread, responses are fetched concurrently
+            tmp = self._path(url).with_suffix(
+                f".{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            with open(tmp, "wt", encoding="utf-8") as fp:
+                json.dump(entry, fp, ensure_ascii=False)
+            tmp.replace(self._path(url))
+        except OSError:
+            pass  # read-only location, the response is fetched again next time
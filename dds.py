@@ -0,0 +1,261 @@
+"""In-process DDS writer with a vectorised BC1 (DXT1) block encoder.
+
+This replaces the round-trip through a temporary BMP and an ImageMagick process when
+saving annotated maps. Blocks are encoded with a principal-axis range fit: the block's
+colours are projected on their main axis, the extremes become the two 5:6:5 endpoints
+and every pixel is snapped to the nearest of the 4 colours along the endpoint line.
+Alpha is dropped, the game maps are opaque.
+
+When ImageMagick is preferred, MagickBatch converts a whole run's maps with a handful of
+processes fed over pipes instead of one process and one temporary file per map."""
+
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+from profiling import traced
+
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+
+# Number of block rows encoded at once, bounds the temporary arrays to a few MB
+CHUNK_ROWS = 64
+
+# Index of the palette entry for a pixel at 0, 1/3, 2/3 and 1 along the c1 -> c0 line
+LINE_TO_INDEX = np.array([1, 3, 2, 0], dtype=np.uint32)
+
+
+def _to_planes(rgb):
+    """Pad a (h, w, 3) array to a multiple of 4 and split it in 3 (n, 16) planes of blocks"""
+    h, w = rgb.shape[:2]
+    ph, pw = -h % 4, -w % 4
+    if ph or pw:
+        rgb = np.pad(rgb, ((0, ph), (0, pw), (0, 0)), mode="edge")
+    bh, bw = rgb.shape[0] // 4, rgb.shape[1] // 4
+    blocks = rgb.reshape(bh, 4, bw, 4, 3).transpose(4, 0, 2, 1, 3)
+    return blocks.reshape(3, bh * bw, 16).astype(np.float32)
+
+
+def _quantize(channels):
+    """Round colours in [0, 255] to 5:6:5, return packed values and the decoded colours"""
+    r = np.rint(channels[0] * (31 / 255)).astype(np.uint16)
+    g = np.rint(channels[1] * (63 / 255)).astype(np.uint16)
+    b = np.rint(channels[2] * (31 / 255)).astype(np.uint16)
+    packed = (r << 11) | (g << 5) | b
+    decoded = [(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)]
+    return packed, np.array(decoded, dtype=np.float32)
+
+
+def _encode_blocks(planes):
+    """Encode 3 (n, 16) colour planes into an (n, 8) uint8 array of BC1 blocks"""
+    mean = planes.mean(axis=2, keepdims=True)
+    centered = planes - mean
+
+    # Principal axis through a few power iterations on the colour covariance
+    cov = np.empty((3, 3, planes.shape[1]), dtype=np.float32)
+    for i in range(3):
+        for j in range(i, 3):
+            cov[i, j] = cov[j, i] = (centered[i] * centered[j]).sum(axis=1)
+    axis = np.ones((3, planes.shape[1]), dtype=np.float32)
+    for _ in range(4):
+        axis = (cov * axis[None]).sum(axis=1)
+        norm = np.sqrt((axis * axis).sum(axis=0))
+        axis = np.divide(axis, norm, out=np.zeros_like(axis), where=norm > 0)
+
+    proj = (centered * axis[:, :, None]).sum(axis=0)
+    lo = mean[:, :, 0] + axis * proj.min(axis=1)
+    hi = mean[:, :, 0] + axis * proj.max(axis=1)
+    c0, p0 = _quantize(np.clip(hi, 0, 255))
+    c1, p1 = _quantize(np.clip(lo, 0, 255))
+
+    # Opaque 4-colour mode requires c0 > c1
+    swap = c0 < c1
+    c0[swap], c1[swap] = c1[swap], c0[swap]
+    p0[:, swap], p1[:, swap] = p1[:, swap], p0[:, swap]
+
+    # Snap each pixel's position along the quantized c1 -> c0 line to the nearest third
+    line = p0 - p1
+    length = (line * line).sum(axis=0)
+    t = ((planes - p1[:, :, None]) * line[:, :, None]).sum(axis=0)
+    t = np.divide(t, length[:, None], out=np.zeros_like(t), where=length[:, None] > 0)
+    indices = LINE_TO_INDEX[np.clip(np.rint(t * 3), 0, 3).astype(np.intp)]
+    indices[c0 == c1] = 0
+
+    bits = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(
+        axis=1, dtype=np.uint32
+    )
+    out = np.empty((len(bits), 8), dtype=np.uint8)
+    out[:, 0:2] = c0.astype("<u2").view(np.uint8).reshape(-1, 2)
+    out[:, 2:4] = c1.astype("<u2").view(np.uint8).reshape(-1, 2)
+    out[:, 4:8] = bits.astype("<u4").view(np.uint8).reshape(-1, 4)
+    return out
+
+
+def encode_bc1(rgb):
+    """Encode a (h, w, 3+) uint8 image array as BC1 data, row of blocks after row of blocks"""
+    rgb = np.asarray(rgb)[:, :, :3]
+    chunks = []
+    for y in range(0, rgb.shape[0], 4 * CHUNK_ROWS):
+        chunks.append(_encode_blocks(_to_planes(rgb[y : y + 4 * CHUNK_ROWS])))
+    return b"".join(chunk.tobytes() for chunk in chunks)
+
+
+def _downsample(rgb):
+    """Halve an image with a 2x2 box filter (odd edges are replicated)"""
+    h, w = rgb.shape[:2]
+    if h % 2 or w % 2:
+        rgb = np.pad(rgb, ((0, h % 2), (0, w % 2), (0, 0)), mode="edge")
+    total = rgb.reshape(rgb.shape[0] // 2, 2, rgb.shape[1] // 2, 2, 3).sum(
+        axis=(1, 3), dtype=np.uint16
+    )
+    return ((total + 2) // 4).astype(np.uint8)
+
+
+def _header(width, height, mipmap_count):
+    flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_LINEARSIZE
+    caps = DDSCAPS_TEXTURE
+    if mipmap_count > 1:
+        flags |= DDSD_MIPMAPCOUNT
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+    linear_size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * 8
+    pixel_format = struct.pack("<II4s5I", 32, DDPF_FOURCC, b"DXT1", 0, 0, 0, 0, 0)
+    return (
+        b"DDS "
+        + struct.pack("<7I", 124, flags, height, width, linear_size, 0, mipmap_count)
+        + b"\0" * 44
+        + pixel_format
+        + struct.pack("<5I", caps, 0, 0, 0, 0)
+    )
+
+
+@traced("dds_encode")
+def save_dds(img, path, mipmaps=False):
+    """Save a PIL image (or an array) as a BC1 compressed DDS file, optionally with its mipmaps"""
+    rgb = np.asarray(img)
+    if rgb.ndim == 2:
+        rgb = np.repeat(rgb[:, :, None], 3, axis=2)
+    rgb = np.ascontiguousarray(rgb[:, :, :3])
+    height, width = rgb.shape[:2]
+
+    levels = [rgb]
+    while mipmaps and levels[-1].shape[:2] != (1, 1):
+        levels.append(_downsample(levels[-1]))
+
+    with open(path, "wb") as fp:
+        fp.write(_header(width, height, len(levels) if mipmaps else 0))
+        fp.writelines(encode_bc1(level) for level in levels)
+
+
+class MagickBatch:
+    """Convert many images to BC1 DDS files with one ImageMagick process per batch.
+
+    Images are streamed to `magick` as a multi-frame PAM over stdin, so there is no
+    temporary bmp per map and only one process start-up per `batch_size` images. Each
+    frame is written to `<tmp>/<scene>.dds` and moved to its destination once the batch
+    is done; `on_done(name, error)` is then called for every image (error is None on
+    success), so failures can be traced back to the zone that produced them."""
+
+    def __init__(self, magickpath, on_done, mipmaps=False, batch_size=16):
+        if isinstance(magickpath, (str, os.PathLike)):
+            magickpath = [magickpath]
+        self._cmd = [
+            *map(str, magickpath),
+            "convert",
+            "-define",
+            "dds:compression=dxt1",
+        ]
+        if not mipmaps:
+            self._cmd += ["-define", "dds:mipmaps=0"]
+        self._cmd += ["pam:-", "+adjoin"]
+        self._on_done = on_done
+        self._batch_size = batch_size
+        self._proc = None
+        self._stderr = None
+        self._tmpdir = None
+        self._items = []
+
+    @traced("magick_write")
+    def add(self, name, img, dst):
+        """Queue `img` (a PIL image or an RGBA array) for conversion to `dst`"""
+        if self._proc is None:
+            self._start()
+        rgba = np.ascontiguousarray(np.asarray(img))
+        h, w = rgba.shape[:2]
+        depth = rgba.shape[2] if rgba.ndim == 3 else 1
+        tupltype = {1: "GRAYSCALE", 3: "RGB", 4: "RGB_ALPHA"}[depth]
+        header = f"P7\nWIDTH {w}\nHEIGHT {h}\nDEPTH {depth}\nMAXVAL 255\nTUPLTYPE {tupltype}\nENDHDR\n"
+        self._items.append((name, pathlib.Path(dst)))
+        try:
+            self._proc.stdin.write(header.encode("ascii"))
+            self._proc.stdin.write(memoryview(rgba).cast("B"))
+        except (BrokenPipeError, OSError):
+            pass  # the process died, reported for every image of the batch by flush()
+        if len(self._items) >= self._batch_size:
+            self.flush()
+
+    def _start(self):
+        self._tmpdir = pathlib.Path(tempfile.mkdtemp(prefix="huntmaps-"))
+        # stderr goes to a file: a pipe only read by flush() could fill up with warnings
+        # and block magick while we are still writing to its stdin
+        self._stderr = tempfile.TemporaryFile()  # noqa: SIM115, closed by flush()
+        self._proc = subprocess.Popen(
+            [*self._cmd, str(self._tmpdir / "%d.dds")],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self._stderr,
+        )
+
+    @traced("magick")
+    def flush(self):
+        """Wait for the running batch to complete and dispatch its results"""
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        returncode = self._proc.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors="replace").strip()
+        self._stderr.close()
+        try:
+            for scene, (name, dst) in enumerate(self._items):
+                output = self._tmpdir / f"{scene}.dds"
+                if not output.exists():
+                    self._on_done(
+                        name,
+                        f"ImageMagick conversion failed for '{name}' (frame {scene}). "
+                        f"Return code: {returncode}\nstderr: {stderr or 'N/A'}",
+                    )
+                    continue
+                try:
+                    shutil.move(output, dst)
+                except OSError as e:
+                    self._on_done(name, f"Failed to save map '{name}' to {dst}: {e}")
+                    continue
+                self._on_done(name, None)
+        finally:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._proc, self._stderr, self._tmpdir, self._items = None, None, None, []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
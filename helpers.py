@@ -1,14 +1,15 @@
-from collections import namedtuple
-from copy import deepcopy
+from collections import defaultdict, namedtuple
+from functools import cache, lru_cache
 import json
 from pathlib import Path
-import yaml
-from math import pi, cos, sin
+from types import MappingProxyType
+from math import ceil, floor, pi, cos, sin, sqrt
 from operator import itemgetter
 import re
 
-from PIL import Image, ImageFilter, ImageFont, ImageDraw, ImageColor
-import requests
+from profiling import traced
+
+# numpy, PIL, requests and yaml are imported where needed to keep the start-up fast
 
 
 def yml_tuple_constructor(loader, node):
@@ -35,11 +36,23 @@ def yml_tuple_constructor(loader, node):
     return tup
 
 
-# !tuple is my own tag name, I think you could choose anything you want
-yaml.add_constructor("!tuple", yml_tuple_constructor)
 # this is to spot the strings written as tuple in the yaml
 pattern = re.compile(r"\(([+-]?([0-9]*[.])?[0-9]+, ?)+([+-]?([0-9]*[.])?[0-9]+)?\)")
-yaml.add_implicit_resolver("!tuple", pattern)
+
+
+@cache
+def config_loader():
+    """Safe yaml loader (libyaml based when available) reading `(x, y)` as tuples"""
+    import yaml
+
+    class ConfigLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+        pass
+
+    # !tuple is my own tag name, I think you could choose anything you want
+    ConfigLoader.add_constructor("!tuple", yml_tuple_constructor)
+    # only tried on scalars starting with a parenthesis
+    ConfigLoader.add_implicit_resolver("!tuple", pattern, ["("])
+    return ConfigLoader
 
 
 class MarksHelper:
@@ -61,8 +74,16 @@ class MarksHelper:
             json.dump(new_list, fp)
 
     @staticmethod
-    def load_marks(filename):
-        """Load the json file and build the list of namedtuples"""
+    def load_marks(filename, scales=None):
+        """Load the json file and build the list of namedtuples, indexed by zone.
+
+        `scales` optionally maps zone names to their scale factor so that marker pixel
+        positions are precomputed (see MarksRegistry)."""
+        return MarksHelper.build_marks(MarksHelper.read_marks(filename), scales)
+
+    @staticmethod
+    def read_marks(filename):
+        """Load and check the json file, return the list of marks as dicts"""
         try:
             with open(filename, "rt", encoding="utf-8") as fp:
                 marks = json.load(fp)
@@ -84,9 +105,13 @@ class MarksHelper:
                 f"Marks file '{filename}' is empty or has no valid mark entries. "
                 "Please ensure the file contains valid mark data."
             )
+        return marks
 
+    @staticmethod
+    def build_marks(marks, scales=None):
+        """Build the list of namedtuples from the marks dicts, indexed by zone"""
         Mark = namedtuple("Mark", marks[0])
-        return Mark, [Mark(**mark) for mark in marks]
+        return Mark, MarksRegistry([Mark(**mark) for mark in marks], scales)
 
     @staticmethod
     def sort_marks(filename):
@@ -108,35 +133,225 @@ class MarksHelper:
             json.dump(marks, fp)
 
 
+ZoneMarks = namedtuple("ZoneMarks", ["marks", "remapped", "scale", "markers"])
+ZoneMarks.__doc__ = """Marks of one zone, as indexed by MarksRegistry.
+
+- marks: {mark_name: (rank, spawns)}
+- remapped: same with multiple A/B ranks renamed A1/A2, B1/B2
+- scale, markers: the zone scale and, for each unique spawn point, its pixel position
+  and the {mark_name: remapped_rank} spawning there (None if the scale is unknown)"""
+
+_UNCOMPUTED = object()
+
+
+class MarksRegistry(tuple):
+    """Immutable list of marks with a per-zone index built once at load time.
+
+    It behaves as the plain list of Mark namedtuples it's built from, and `zone(name)`
+    returns the ZoneMarks of a zone in O(1), with rank remaps computed. Marker positions
+    are converted for the whole zone on its first lookup, then kept: commands that
+    don't draw don't pay for NumPy."""
+
+    def __new__(cls, marks, scales=None):
+        self = super().__new__(cls, marks)
+        scales = scales or {}
+        by_zone = defaultdict(dict)
+        for mark in self:
+            by_zone[mark.zone][mark.name] = (
+                mark.rank,
+                tuple(tuple(spawn) for spawn in mark.spawns),
+            )
+        self._by_zone = {
+            zone: self._index_zone(marks, scales.get(zone))
+            for zone, marks in by_zone.items()
+        }
+        return self
+
+    @staticmethod
+    def _index_zone(marks, scale):
+        remapped = dict(marks)
+        for rank in ("A", "B"):
+            # Rewrite the rank of zones with multiple occurences of it. Example: A -> A1, A2
+            same_rank = [name for name, (r, _) in marks.items() if r == rank]
+            for i, name in enumerate(sorted(same_rank)):
+                remapped[name] = (f"{rank}{i + 1}", marks[name][1])
+        markers = None if scale is None else _UNCOMPUTED
+        return ZoneMarks(
+            MappingProxyType(marks), MappingProxyType(remapped), scale, markers
+        )
+
+    @staticmethod
+    def compute_markers(marks, scale):
+        """Group marks by spawn point and convert the points to pixel positions"""
+        spawns = defaultdict(dict)
+        for name, (rank, spots) in marks.items():
+            for spot in spots:
+                spawns[tuple(spot)][name] = rank
+        pixels = m2c(PositionArray(list(spawns)), scale).tolist()
+        return tuple(
+            (pixel, MappingProxyType(ranks))
+            for pixel, ranks in zip(pixels, spawns.values())
+        )
+
+    def zone(self, name):
+        """Return the ZoneMarks of the zone `name` (empty if it has no marks)"""
+        zone_marks = self._by_zone.get(name, EMPTY_ZONE)
+        if zone_marks.markers is _UNCOMPUTED:
+            markers = self.compute_markers(zone_marks.remapped, zone_marks.scale)
+            zone_marks = self._by_zone[name] = zone_marks._replace(markers=markers)
+        return zone_marks
+
+    def markers(self, name, scale):
+        """Return the markers of the zone `name`, computing them if `scale` isn't the indexed one"""
+        zone_marks = self.zone(name)
+        if zone_marks.scale == scale and zone_marks.markers is not None:
+            return zone_marks.markers
+        return self.compute_markers(zone_marks.remapped, scale)
+
+
+EMPTY_ZONE = ZoneMarks(MappingProxyType({}), MappingProxyType({}), None, ())
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` in reserve"""
+
+    def __init__(self, rate, capacity=1):
+        import threading
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty"""
+        import time
+
+        with self._lock:
+            now = time.monotonic()
+            if self._stamp is not None:
+                elapsed = now - self._stamp
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            # A negative balance is the wait before the token is earned; holding the
+            # lock isn't needed for it, later callers queue up behind it
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
 class ZoneApi:
     """Helper class to query xivapi.com and collect zone information.
 
     Nothing fancy and only the load method is useful on a regular basis. Other methods
-    were used to put the data in a good shape."""
-
-    def __init__(self, zones):
-        self.base_url = "https://xivapi.com"
+    were used to put the data in a good shape.
+
+    Zones are fetched by `workers` threads sharing one pooled session. Requests are
+    limited to `rate` per second (bursts of `burst`, None for no limit), and timeouts,
+    connection errors, 429 and 5xx responses are retried `retries` times with
+    exponential backoff. With a `cache` (cache.ResponseCache), successful responses are
+    reused while fresh and revalidated with ETag/Last-Modified once expired."""
+
+    RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(
+        self,
+        zones,
+        base_url="https://xivapi.com",
+        workers=8,
+        rate=10,
+        burst=5,
+        retries=3,
+        backoff=0.5,
+        cache=None,
+    ):
+        self.base_url = base_url
         self.zones = zones
         self.cachename = "data/zone_info"
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self.cache = cache
+        self._session = None
+
+    @property
+    def session(self):
+        """requests session shared by the fetching threads, created on first use"""
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+        return self._session
+
+    def _get(self, url, name, revalidate=False):
+        """GET `url` for the zone `name`, rate limited and retried on transient errors.
+
+        A fresh cached response is returned without a request, unless `revalidate`."""
+        import time
+
+        import requests
+
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None and not revalidate and self.cache.is_fresh(entry):
+            return self._cached_response(url, entry)
+        headers = self.cache.validators(entry) if entry is not None else {}
+        for attempt in range(self.retries + 1):
+            if self._bucket is not None:
+                self._bucket.acquire()
+            try:
+                resp = self.session.get(url, timeout=30, headers=headers)
+            except requests.Timeout:
+                if attempt == self.retries:
+                    raise RuntimeError(
+                        f"Request to xivapi.com timed out for zone '{name}'. "
+                        "Check your internet connection or try again later."
+                    )
+                delay = self.backoff * 2**attempt
+            except requests.ConnectionError:
+                if attempt == self.retries:
+                    raise RuntimeError(
+                        f"Failed to connect to xivapi.com for zone '{name}'. "
+                        "Check your internet connection."
+                    )
+                delay = self.backoff * 2**attempt
+            else:
+                if resp.status_code == 304 and entry is not None:
+                    return self._cached_response(url, self.cache.touch(url, entry))
+                if resp.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                    if resp.status_code == 200 and self.cache is not None:
+                        self.cache.put(url, resp.text, resp.headers)
+                    return resp
+                delay = self.backoff * 2**attempt
+                retry_after = resp.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            time.sleep(delay)
+
+    @staticmethod
+    def _cached_response(url, entry):
+        import requests
+
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = 200
+        resp.encoding = "utf-8"
+        resp._content = entry["body"].encode("utf-8")
+        return resp
 
-    def _get_zone_url(self, name):
+    def _get_zone_url(self, name, revalidate=False):
         """query xivapi to find the url to access zone info.
 
         There's a trick to Mor Dhona as the zone exists under multiple id"""
-        try:
-            resp = requests.get(
-                f"{self.base_url}/search?indexes=PlaceName&string={name}", timeout=30
-            )
-        except requests.Timeout:
-            raise RuntimeError(
-                f"Request to xivapi.com timed out for zone '{name}'. "
-                "Check your internet connection or try again later."
-            )
-        except requests.ConnectionError:
-            raise RuntimeError(
-                f"Failed to connect to xivapi.com for zone '{name}'. "
-                "Check your internet connection."
-            )
+        resp = self._get(
+            f"{self.base_url}/search?indexes=PlaceName&string={name}", name, revalidate
+        )
         if resp.ok:
             try:
                 results = resp.json()["Results"]
@@ -168,21 +383,10 @@ class ZoneApi:
                 f"Failed to fetch zone URL for '{name}': HTTP {resp.status_code}"
             )
 
-    def get_zone_info(self, name):
-        """Get the info about a zone"""
-        zone_url = self._get_zone_url(name)
-        try:
-            resp = requests.get(f"{self.base_url}{zone_url}", timeout=30)
-        except requests.Timeout:
-            raise RuntimeError(
-                f"Request to xivapi.com timed out for zone '{name}'. "
-                "Check your internet connection or try again later."
-            )
-        except requests.ConnectionError:
-            raise RuntimeError(
-                f"Failed to connect to xivapi.com for zone '{name}'. "
-                "Check your internet connection."
-            )
+    def get_zone_info(self, name, revalidate=False):
+        """Get the info about a zone, `revalidate` bypasses the freshness of cached responses"""
+        zone_url = self._get_zone_url(name, revalidate)
+        resp = self._get(f"{self.base_url}{zone_url}", name, revalidate)
         if resp.ok:
             try:
                 results = resp.json()["Maps"][0]
@@ -204,16 +408,44 @@ class ZoneApi:
         filename = info["MapFilenameId"].replace("/", "")
         return {"region": region, "scale": size_factor, "filename": filename}
 
-    def get_all_zone_info(self):
-        """Collect all information"""
-        results = {}
-        for zone in self.zones:
-            info = self.get_zone_info(zone)
-            results[zone] = self.get_zone_data(info)
-        return results
+    def get_all_zone_info(self, zones=None, revalidate=()):
+        """Collect all information (or that of `zones`), fetching the zones concurrently.
+
+        Cached responses of the zones in `revalidate` are revalidated even when fresh.
+        Results keep the order of the zones; the error of the first failing zone is raised."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        zones = list(self.zones if zones is None else zones)
+        revalidate = set(revalidate)
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+            infos = list(
+                pool.map(
+                    lambda zone: self.get_zone_info(zone, zone in revalidate), zones
+                )
+            )
+        return {zone: self.get_zone_data(info) for zone, info in zip(zones, infos)}
+
+    def refresh_zone_info(self, stale=(), full=False):
+        """Fetch the zones missing from the zone info file and the `stale` ones, then save it.
+
+        With full=True every zone is fetched again. Stale zones revalidate their cached
+        responses, so an unchanged zone costs conditional requests only. Returns the
+        fetched zones."""
+        try:
+            info = self.load_zone_info() or {}
+        except FileNotFoundError:
+            info = {}
+        stale = set(self.zones) if full else set(stale)
+        fetch = [zone for zone in self.zones if zone in stale or zone not in info]
+        if fetch:
+            info.update(self.get_all_zone_info(fetch, revalidate=stale))
+            self.save_zone_info(info)
+        return fetch
 
     def save_zone_info(self, zones, as_json=False):
         """Save the data, either as yaml (default) or json"""
+        import yaml
+
         if as_json:
             with open(self.cachename + ".json", "wt", encoding="utf-8") as fp:
                 json.dump(zones, fp)
@@ -223,9 +455,11 @@ class ZoneApi:
 
     def load_zone_info(self, zones=None):
         """Load the data (yaml only)"""
+        import yaml
+
         try:
             with open(self.cachename + ".yaml", "rt", encoding="utf-8") as fp:
-                info = yaml.load(fp, Loader=yaml.SafeLoader)
+                info = yaml.load(fp, Loader=config_loader())
         except FileNotFoundError:
             raise FileNotFoundError(
                 f"Zone information file not found: {self.cachename}.yaml. "
@@ -236,6 +470,12 @@ class ZoneApi:
                 f"Invalid YAML in zone info file: {e}. Please check the file format."
             )
         if zones:
+            missing = [zone for zone in zones if zone not in (info or {})]
+            if missing:
+                raise KeyError(
+                    f"Zones missing from {self.cachename}.yaml: {', '.join(missing)}. "
+                    "Run update_zone_info to fetch them."
+                )
             for zone in list(zones.keys()):
                 zones[zone].update(info[zone])
             return
@@ -249,11 +489,20 @@ class Position:
     Accessing 'other''s values is done through indexers in order to be compatible
     with coordinates passed as lists or tuples."""
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
     def __add__(self, other):
+        # Positions and plain numbers skip the generic fallbacks below
+        if type(other) is Position:
+            return Position(self.x + other.x, self.y + other.y)
+        if type(other) in _SCALARS:
+            return Position(self.x + other, self.y + other)
+        if isinstance(other, PositionArray):
+            return NotImplemented
         try:
             return Position(self.x + other[0], self.y + other[1])
         except TypeError:
@@ -268,6 +517,12 @@ class Position:
         return self + other
 
     def __mul__(self, other):
+        if type(other) is Position:
+            return Position(self.x * other.x, self.y * other.y)
+        if type(other) in _SCALARS:
+            return Position(self.x * other, self.y * other)
+        if isinstance(other, PositionArray):
+            return NotImplemented
         if isinstance(other, str):
             raise TypeError(
                 "Position expect to be multiplied by a Position-like or a scalar"
@@ -293,6 +548,12 @@ class Position:
         return Position(-self.x, -self.y)
 
     def __sub__(self, other):
+        if type(other) is Position:
+            return Position(self.x - other.x, self.y - other.y)
+        if type(other) in _SCALARS:
+            return Position(self.x - other, self.y - other)
+        if isinstance(other, PositionArray):
+            return NotImplemented
         try:
             return Position(self.x - other[0], self.y - other[1])
         except TypeError:
@@ -306,6 +567,9 @@ class Position:
     def __rsub__(self, other):
         return self.__neg__() + other
 
+    def __len__(self):
+        return 2
+
     def __getitem__(self, index):
         if index == 0:
             return self.x
@@ -319,12 +583,112 @@ class Position:
             self.y = value
 
     def __iter__(self):
-        return (self.__dict__[item] for item in sorted(self.__dict__))
+        yield self.x
+        yield self.y
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.x},{self.y})"
 
 
+_SCALARS = (int, float)
+
+
+class PositionArray:
+    """Positions of many points held in a (n, 2) NumPy array, to operate on all the
+    spawns of a zone at once rather than point by point.
+
+    Arithmetic works like Position's: the other operand is a PositionArray of the same
+    length, a Position-like or a scalar. Indexing a point returns a Position."""
+
+    __slots__ = ("xy",)
+
+    def __init__(self, points=(), dtype=None):
+        import numpy as np
+
+        xy = np.asarray(points, dtype=dtype)
+        if xy.size == 0:
+            xy = xy.astype(dtype or float)
+        if xy.dtype.kind not in "iuf":
+            raise TypeError(
+                f"PositionArray expects numeric coordinates, not {xy.dtype}"
+            )
+        self.xy = xy.reshape(-1, 2)
+
+    @classmethod
+    def _wrap(cls, xy):
+        array = cls.__new__(cls)
+        array.xy = xy
+        return array
+
+    @property
+    def x(self):
+        return self.xy[:, 0]
+
+    @property
+    def y(self):
+        return self.xy[:, 1]
+
+    def _operand(self, other, verb):
+        import numpy as np
+
+        if isinstance(other, PositionArray):
+            return other.xy
+        operand = None if isinstance(other, str) else np.asarray(other)
+        if operand is None or operand.dtype.kind not in "iuf" or operand.size > 2:
+            raise TypeError(
+                f"PositionArray expect to be {verb} a PositionArray, a Position-like or a scalar"
+            )
+        return operand
+
+    def __add__(self, other):
+        return self._wrap(self.xy + self._operand(other, "added to"))
+
+    def __radd__(self, other):
+        return self + other
+
+    def __mul__(self, other):
+        return self._wrap(self.xy * self._operand(other, "multiplied by"))
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __neg__(self):
+        return self._wrap(-self.xy)
+
+    def __sub__(self, other):
+        return self._wrap(self.xy - self._operand(other, "subtracted from"))
+
+    def __rsub__(self, other):
+        return self._wrap(self._operand(other, "subtracted from") - self.xy)
+
+    def floor(self):
+        """Round the coordinates down, to the pixel holding each point"""
+        import numpy as np
+
+        return self._wrap(np.floor(self.xy))
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._wrap(self.xy[index])
+        return Position(*self.xy[index].tolist())
+
+    def __iter__(self):
+        return (Position(x, y) for x, y in self.xy.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.xy if dtype is None else self.xy.astype(dtype)
+
+    def tolist(self):
+        """The points as a list of (x, y) tuples of Python numbers"""
+        return [(x, y) for x, y in self.xy.tolist()]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.tolist()})"
+
+
 def compute_columns(n_items, n_rows):
     """Compute the required number of columns given a number of items
     n_items to be displayed in a grid n_rows x n_cols"""
@@ -341,20 +705,334 @@ def compute_columns(n_items, n_rows):
 
 
 def m2c(pos, scale=100):
-    """Convert map coordinates to screen/pixel coordinates"""
+    """Convert map coordinates to screen/pixel coordinates.
+
+    `pos` is a coordinate, or a PositionArray to convert all its points in one call."""
+    if isinstance(pos, PositionArray):
+        import numpy as np
+
+        # Same operations in the same order as below, so results are identical
+        pixels = np.rint((pos.xy - 1) * scale * 0.01 / 40.85 * 2048)
+        return PositionArray._wrap(pixels.astype(np.int64))
     return round((pos - 1) * scale * 0.01 / 40.85 * 2048)
 
 
 def c2m(pos, scale=100):
-    """Convert screen/pixel coordinates to map coordinates"""
+    """Convert screen/pixel coordinates to map coordinates, of a PositionArray too"""
+    if isinstance(pos, PositionArray):
+        return PositionArray._wrap(pos.xy * 40.85 * 100 / 2048 / scale + 1)
     return pos * 40.85 * 100 / 2048 / scale + 1
 
 
-def drop_shadow(img, offset, shadow_color, iterations=5, scale=1, direction=None):
+# Cells compared with a point's own cell on a grid hash. Each pair of neighbouring cells
+# is visited once; pairs inside the same cell are handled separately.
+_NEIGHBOUR_CELLS = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def close_pairs(points, threshold, groups=None):
+    """Find the pairs of points that are at most `threshold` apart.
+
+    Points are bucketed on a grid of `threshold` sized cells, so only points in the same
+    or adjacent cells are compared. With `groups` (one integer label per point), only
+    points of the same group are paired, which checks all zones in a single pass.
+    Returns an (n, 2) array of indices (i < j), sorted."""
+    import numpy as np
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if groups is None:
+        groups = np.zeros(len(points), dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    if len(points) < 2:
+        return np.empty((0, 2), dtype=np.intp)
+
+    # Cells a bit larger than threshold: rounding can't push close pairs 2 cells apart
+    cell_size = threshold * (1 + 1e-9) if threshold > 0 else 1.0
+    cells = np.floor(points / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # keep a free column/row on each side
+    height = cells[:, 1].max() + 2
+    width = cells[:, 0].max() + 2
+    keys = (groups * width + cells[:, 0]) * height + cells[:, 1]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    def expand(starts, counts):
+        """Pair each point with the `counts` sorted points following `starts`"""
+        total = counts.sum()
+        first = np.repeat(np.arange(len(points)), counts)
+        steps = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return first, order[np.repeat(starts, counts) + steps]
+
+    # Same cell: each point is paired with the points after it in the sorted order
+    rank = np.empty(len(points), dtype=np.intp)
+    rank[order] = np.arange(len(points))
+    end = np.searchsorted(sorted_keys, keys, side="right")
+    candidates = [expand(rank + 1, end - rank - 1)]
+    for dx, dy in _NEIGHBOUR_CELLS:
+        target = keys + dx * height + dy
+        start = np.searchsorted(sorted_keys, target, side="left")
+        end = np.searchsorted(sorted_keys, target, side="right")
+        candidates.append(expand(start, end - start))
+
+    first = np.concatenate([c[0] for c in candidates])
+    second = np.concatenate([c[1] for c in candidates])
+    delta = points[first] - points[second]
+    close = np.sqrt((delta * delta).sum(axis=1)) <= threshold
+    pairs = np.sort(np.stack([first[close], second[close]], axis=1), axis=1)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+# Variance along each axis of one ImageFilter.BLUR pass (5x5 ring kernel)
+BLUR_VARIANCE = 2.75
+# Temporary memory used by drop_shadow per pixel, measured on 2048x2048 marker layers:
+# about 32 bytes with the alpha engine and 23 with the pillow one
+SHADOW_BYTES_PER_PIXEL = 32
+
+
+@traced("drop_shadow")
+def drop_shadow(
+    img,
+    offset,
+    shadow_color,
+    iterations=5,
+    scale=1,
+    direction=None,
+    engine="pillow",
+    max_bytes=None,
+):
     """Compute a drop shadow, configured by color, offset and iterations.
 
     scale shouldn't be used as results aren't great.
-    direction='radial' will layer multiple shadows in all cardinal directions"""
+    direction='radial' will layer multiple shadows in all cardinal directions
+
+    engine='alpha' blurs the alpha plane only, with box filters matching the spread of
+    `iterations` BLUR passes, so its cost doesn't depend on `iterations`; near the image
+    borders, where BLUR behaves differently, the shadow is taken from the pillow engine.
+    It stays an approximation inside the image and has to be chosen explicitly.
+    engine='pillow' applies ImageFilter.BLUR `iterations` times to the RGBA shadow.
+
+    Only the bounding box of the non-transparent pixels, padded by the blur and offset
+    reach, is processed; with the pillow engine the result is identical to processing
+    the whole image.
+
+    With `max_bytes`, an image whose shadow would need more temporary memory than that
+    is processed in bands of rows, each with the rows its blur and offsets reach. Bands
+    give the same result, within 1/255 of alpha for the alpha engine."""
+    if engine not in ("alpha", "pillow"):
+        raise ValueError(
+            f"Invalid shadow engine: '{engine}'. Valid options are 'alpha' or 'pillow'."
+        )
+    offsets = _shadow_offsets(offset, direction)
+    if scale != 1:
+        # Scaling moves the shadow away from the content, no cheap bound for it
+        return _cast_shadow(img, shadow_color, iterations, scale, offsets)
+
+    def shadow(img):
+        if engine == "alpha":
+            return _alpha_shadow(img, shadow_color, iterations, offsets)
+        return _pillow_shadow(img, shadow_color, iterations, offsets)
+
+    rows = band_rows(img.size, SHADOW_BYTES_PER_PIXEL, max_bytes)
+    if rows < img.height:
+        result = _in_bands(shadow, img, rows, _shadow_margin(iterations, offsets))
+    else:
+        result = shadow(img)
+    if engine == "alpha":
+        _pillow_borders(result, img, shadow_color, iterations, offsets, rows)
+    return result
+
+
+def _pillow_shadow(img, shadow_color, iterations, offsets):
+    """Shadow computed with ImageFilter.BLUR on the content's bounding box, see drop_shadow"""
+    from PIL import Image
+
+    # Where nothing is drawn, the whole image computation leaves the shadow color with a
+    # null alpha, except on the band the last offset shifted in from outside the image
+    rgb = Image.new("RGBA", (1, 1), color=shadow_color).getpixel((0, 0))[:3]
+    result = Image.new("RGBA", img.size, color=(0, 0, 0, 0))
+    result.paste((*rgb, 0), _shifted_box(img.size, offsets[-1]))
+    bbox = img.getchannel("A").getbbox()
+    if bbox is None:
+        return result
+
+    reach = max(abs(c) for xy in offsets for c in xy)
+    margin = 2 * iterations + 2 + ceil(reach)  # BLUR spreads by 2px per iteration
+    box = _pad_box(bbox, margin, img.size)
+    shadow = _cast_shadow(img.crop(box), shadow_color, iterations, 1, offsets)
+    drawn = shadow.getchannel("A").point([0] + [255] * 255)
+    result.paste(shadow, box[:2], mask=drawn)
+    return result
+
+
+def _shadow_margin(iterations, offsets):
+    """Distance from which content can reach a pixel of its shadow, for both engines"""
+    reach = ceil(max(abs(c) for xy in offsets for c in xy)) + 1
+    blur = max(
+        2 * iterations + 2,
+        sum(size // 2 for size in _box_sizes(BLUR_VARIANCE * iterations)),
+    )
+    return blur + reach
+
+
+def band_rows(size, bytes_per_pixel, max_bytes):
+    """Rows of an image of `size` processed at once to use at most `max_bytes`.
+
+    Returns the image height when max_bytes is None."""
+    if not max_bytes:
+        return size[1]
+    return max(int(max_bytes // (size[0] * bytes_per_pixel)), 1)
+
+
+def _in_bands(func, img, rows, margin):
+    """Apply the local operation `func` to bands of `rows` rows of `img`.
+
+    Each band is processed with `margin` rows of context above and below, which are
+    cropped from its result; the bands are at least `margin` rows high."""
+    from PIL import Image
+
+    rows = max(rows, margin)
+    result = Image.new(img.mode, img.size)
+    for top in range(0, img.height, rows):
+        bottom = min(top + rows, img.height)
+        y0, y1 = max(top - margin, 0), min(bottom + margin, img.height)
+        band = func(img.crop((0, y0, img.width, y1)))
+        result.paste(band.crop((0, top - y0, img.width, bottom - y0)), (0, top))
+        del band
+    return result
+
+
+def _pad_box(bbox, margin, size):
+    left, top, right, bottom = bbox
+    return (
+        max(left - margin, 0),
+        max(top - margin, 0),
+        min(right + margin, size[0]),
+        min(bottom + margin, size[1]),
+    )
+
+
+def _alpha_shadow(img, shadow_color, iterations, offsets):
+    """Shadow computed on the alpha plane with numpy, see drop_shadow"""
+    import numpy as np
+    from PIL import Image
+
+    alpha = img.getchannel("A")
+    bbox = alpha.getbbox()
+    coverage = np.zeros((img.height, img.width), dtype=np.float32)
+    if bbox is not None:
+        sizes = _box_sizes(BLUR_VARIANCE * iterations)
+        # Pixel shifts of the nearest neighbour affine transform used by the pillow engine
+        shifts = [(floor(x + 0.5), floor(y + 0.5)) for x, y in offsets]
+        reach = max(abs(c) for shift in shifts for c in shift)
+        left, top, right, bottom = box = _pad_box(
+            bbox, sum(size // 2 for size in sizes) + reach, img.size
+        )
+        base = np.asarray(alpha.crop(box), dtype=np.float32) / 255
+        base = _box_blur(base, sizes)
+        # Layers are stacked with the "over" operator, like alpha_composite
+        transparency = np.ones_like(base)
+        for dx, dy in shifts:
+            transparency *= 1 - _shift(base, dx, dy)
+        coverage[top:bottom, left:right] = 1 - transparency
+
+    shadow = Image.new("RGBA", img.size, color=shadow_color)
+    shadow.putalpha(Image.fromarray(np.rint(coverage * 255).astype(np.uint8)))
+    return Image.alpha_composite(shadow, img)
+
+
+def _pillow_borders(result, img, shadow_color, iterations, offsets, rows):
+    """Compute again with the pillow engine the borders of `result` that content reaches.
+
+    ImageFilter.BLUR leaves the outer pixels of the image as they are at each pass, which
+    box filters can't reproduce: near the image borders, the shadow is taken from pillow.
+    A strip twice as wide as the shadow margin is processed, in bands of `rows` rows, and
+    its outer half kept."""
+    bbox = img.getchannel("A").getbbox()
+    if bbox is None:
+        return
+
+    def shadow(img):
+        return _pillow_shadow(img, shadow_color, iterations, offsets)
+
+    w, h = img.size
+    margin = _shadow_margin(iterations, offsets)
+    left, top, right, bottom = bbox
+    strips = []  # (strip processed, part kept)
+    if left < margin:
+        strips.append(((0, 0, 2 * margin, h), (0, 0, margin, h)))
+    if top < margin:
+        strips.append(((0, 0, w, 2 * margin), (0, 0, w, margin)))
+    if right > w - margin:
+        strips.append(((w - 2 * margin, 0, w, h), (w - margin, 0, w, h)))
+    if bottom > h - margin:
+        strips.append(((0, h - 2 * margin, w, h), (0, h - margin, w, h)))
+    for strip, kept in strips:
+        strip = _pad_box(strip, 0, img.size)
+        crop = img.crop(strip)
+        if rows < crop.height:
+            crop = _in_bands(shadow, crop, rows, margin)
+        else:
+            crop = shadow(crop)
+        x0, y0 = max(kept[0], 0), max(kept[1], 0)
+        part = (x0 - strip[0], y0 - strip[1], kept[2] - strip[0], kept[3] - strip[1])
+        result.paste(crop.crop(part), (x0, y0))
+
+
+def _box_sizes(variance, n=3):
+    """Odd widths of `n` successive box filters with a total variance close to `variance`"""
+    if variance <= 0:
+        return []
+    ideal = sqrt(12 * variance / n + 1)
+    lower = max(floor(ideal) - (floor(ideal) + 1) % 2, 1)
+    upper = lower + 2
+    m = round((12 * variance - n * lower**2 - 4 * n * lower - 3 * n) / (-4 * lower - 4))
+    m = min(max(m, 0), n)
+    return [lower] * m + [upper] * (n - m)
+
+
+def _box_blur(plane, sizes):
+    """Blur a 2D plane with box filters of odd `sizes` along both axes, edge padded.
+
+    Each box is a difference of cumulative sums, whatever its size."""
+    import numpy as np
+
+    for _ in range(2):
+        for size in sizes:
+            r = size // 2
+            csum = np.cumsum(np.pad(plane, ((r + 1, r), (0, 0)), mode="edge"), axis=0)
+            plane = (csum[size:] - csum[:-size]) / size
+        plane = plane.T
+    return plane
+
+
+def _shift(plane, dx, dy):
+    """out[y, x] = plane[y + dy, x + dx], zero where that falls outside plane"""
+    import numpy as np
+
+    h, w = plane.shape
+    out = np.zeros_like(plane)
+    out[max(-dy, 0) : h - max(dy, 0), max(-dx, 0) : w - max(dx, 0)] = plane[
+        max(dy, 0) : h - max(-dy, 0), max(dx, 0) : w - max(-dx, 0)
+    ]
+    return out
+
+
+def _shadow_offsets(offset, direction):
+    """Source offsets of the shadow layers, the last one is on top"""
+    x, y = -offset.x, -offset.y
+    offsets = [(x, y)]
+    if direction == "radial":
+        radial_steps = 4
+        radial_angle_shift = 2 * pi / radial_steps
+        for theta in [i * radial_angle_shift for i in range(1, 4)]:
+            x, y = x * cos(theta) - y * sin(theta), x * sin(theta) + y * cos(theta)
+            offsets.append((x, y))
+    return offsets
+
+
+def _cast_shadow(img, shadow_color, iterations, scale, offsets):
+    """Blur the alpha of img, layer it at each offset and put img on top"""
+    from PIL import Image, ImageFilter
+
     alpha = img.getchannel("A")
 
     base_shadow = Image.new("RGBA", img.size, color=shadow_color)
@@ -363,29 +1041,135 @@ def drop_shadow(img, offset, shadow_color, iterations=5, scale=1, direction=None
     for i in range(iterations):
         base_shadow = base_shadow.filter(ImageFilter.BLUR)
 
-    if direction == "radial":
-        radial_steps = 4
-        radial_angle_shift = 2 * pi / radial_steps
-        x, y = -offset.x, -offset.y
-        shadow = base_shadow.transform(
+    shadow = None
+    for x, y in offsets:
+        temp_shadow = base_shadow.transform(
             base_shadow.size, Image.AFFINE, (scale, 0, x, 0, scale, y)
         )
-        for theta in [i * radial_angle_shift for i in range(1, 4)]:
-            x, y = x * cos(theta) - y * sin(theta), x * sin(theta) + y * cos(theta)
-            temp_shadow = base_shadow.transform(
-                base_shadow.size, Image.AFFINE, (scale, 0, x, 0, scale, y)
-            )
+        if shadow is None:
+            shadow = temp_shadow
+        else:
             shadow = Image.alpha_composite(temp_shadow, shadow)
-    else:
-        shadow = base_shadow.transform(
-            base_shadow.size, Image.AFFINE, (scale, 0, -offset.x, 0, scale, -offset.y)
-        )
     return Image.alpha_composite(shadow, img)
 
 
+def _shifted_box(size, offset):
+    """Box of the pixels that an affine shift by offset samples from inside the image"""
+    from PIL import Image
+
+    x, y = offset
+    cols = Image.new("L", (size[0], 1), 255)
+    rows = Image.new("L", (1, size[1]), 255)
+    cols = cols.transform(cols.size, Image.AFFINE, (1, 0, x, 0, 1, 0)).getbbox()
+    rows = rows.transform(rows.size, Image.AFFINE, (1, 0, 0, 0, 1, y)).getbbox()
+    if cols is None or rows is None:
+        return (0, 0, 0, 0)
+    return (cols[0], rows[1], cols[2], rows[3])
+
+
+def blend_multiply(pixels, mask, scratch=None):
+    """Multiply a uint8 image array by a uint8 mask of the same shape, in place.
+
+    The result is floor(pixel * mask / 255), like the float computation, using uint16
+    fixed point: for x = pixel * mask, x // 255 == (x + 1 + (x >> 8)) >> 8 over the
+    whole 0..255*255 range. A channel of the mask at 255 leaves that channel unchanged.
+    `scratch` is an optional uint16 buffer of the same shape, reused between calls.
+    Returns `pixels`."""
+    import numpy as np
+
+    if scratch is None:
+        scratch = np.empty(pixels.shape, dtype=np.uint16)
+    np.multiply(pixels, mask, out=scratch, dtype=np.uint16)
+    # pixels is free until the final copy, it holds the x >> 8 temporary
+    np.right_shift(scratch, 8, out=pixels, casting="unsafe")
+    np.add(scratch, pixels, out=scratch)
+    scratch += 1
+    scratch >>= 8
+    np.copyto(pixels, scratch, casting="unsafe")
+    return pixels
+
+
+@cache
+def load_font(path, size):
+    """Load a truetype font once per process"""
+    from PIL import ImageFont
+
+    if not Path(path).exists():
+        raise FileNotFoundError(
+            f"Font file not found: {path}. "
+            f"Please ensure the font file exists or update the path in config.yaml"
+        )
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=4096)
+def text_bbox(font, text, stroke_width=0):
+    """Bounding box of `text` drawn at (0, 0), like ImageDraw.textbbox"""
+    return font.getbbox(text, stroke_width=stroke_width)
+
+
+def draw_label(img, xy, text, font, stroke_width, fill="white", stroke_fill="black"):
+    """Draw an outlined single line of text, like ImageDraw.text, on a transparent area.
+
+    The text is rendered once into a bitmap per (text, style, sub-pixel offset) and
+    composited at `xy` the next times."""
+    from PIL import ImageDraw
+
+    x, y = xy
+    if x < 0 or y < 0:
+        # Pillow splits negative coordinates differently, draw those directly
+        ImageDraw.Draw(img).text(
+            xy,
+            text,
+            fill=fill,
+            font=font,
+            stroke_width=stroke_width,
+            stroke_fill=stroke_fill,
+        )
+        return img
+    # ImageDraw.text renders at the fractional part of xy and places at its integer part
+    bitmap, pad = _label_bitmap(
+        font, text, stroke_width, fill, stroke_fill, x - int(x), y - int(y)
+    )
+    left, top = int(x) - pad, int(y) - pad
+    crop_left, crop_top = max(-left, 0), max(-top, 0)
+    right = min(left + bitmap.width, img.width)
+    bottom = min(top + bitmap.height, img.height)
+    if right > left + crop_left and bottom > top + crop_top:
+        img.alpha_composite(
+            bitmap,
+            (left + crop_left, top + crop_top),
+            (crop_left, crop_top, right - left, bottom - top),
+        )
+    return img
+
+
+@lru_cache(maxsize=1024)
+def _label_bitmap(font, text, stroke_width, fill, stroke_fill, dx, dy):
+    from PIL import Image, ImageDraw
+
+    bbox = text_bbox(font, text, stroke_width)
+    pad = stroke_width + 2
+    bitmap = Image.new(
+        "RGBA", (bbox[2] + 2 * pad + 1, bbox[3] + 2 * pad + 1), color=(0, 0, 0, 0)
+    )
+    ImageDraw.Draw(bitmap).text(
+        (pad + dx, pad + dy),
+        text,
+        fill=fill,
+        font=font,
+        stroke_width=stroke_width,
+        stroke_fill=stroke_fill,
+    )
+    return bitmap, pad
+
+
 class Legend:
     """Helper class to draw the legend on a map"""
 
+    # Part of the key of the cached legend tiles: bump it when the rendering changes
+    VERSION = 2
+
     def __init__(self, config):
         self.inner_offset = Position(
             *config["legend"]["inner_offset"]
@@ -405,45 +1189,87 @@ class Legend:
             "border_space"
         ]  # spacing between the two rectangles forming the border
 
-        # Validate font file exists
-        font_path = config["legend"]["font"]
-        if not Path(font_path).exists():
-            raise FileNotFoundError(
-                f"Font file not found: {font_path}. "
-                f"Please ensure the font file exists or update the path in config.yaml"
-            )
-
-        self.font = ImageFont.truetype(font_path, config["legend"]["font_size"])
+        self.font = load_font(config["legend"]["font"], config["legend"]["font_size"])
         self.shadow_color = config["legend"]["shadow_color"]
         self.shadow_iterations = config["legend"]["shadow_iterations"]
+        self.shadow_engine = config["legend"].get("shadow_engine", "pillow")
         self.colors = config["colors"]
 
     def draw(self, img_size, position, marks, rows):
+        """Draw the legend on a transparent layer of size `img_size`"""
+        from PIL import Image
+
+        tile, origin = self.render(img_size, position, marks, rows)
         img = Image.new("RGBA", img_size, color=(0, 0, 0, 0))
+        img.paste(tile, origin)
+        return img
+
+    @traced("legend_render")
+    def render(self, img_size, position, marks, rows):
+        """Draw the legend on a canvas just large enough for it and its shadow.
+
+        Returns the canvas and the coordinates of its top left corner on the map, the
+        area outside of the canvas is left transparent."""
+        from PIL import Image
 
         position = Position(*position)  # ensure Position object
-        inner_position = position + self.inner_offset
+        items, size = self._layout(position + self.inner_offset, marks, rows)
+        size = size + 2 * self.inner_offset
+
+        # Everything drawn: the border and the item labels, which may overflow it
+        left, top = position
+        right, bottom = position + size
+        for item_position, mark, rank in items:
+            text_box = self._label_box(item_position, mark, rank)
+            left, top = min(left, text_box[0]), min(top, text_box[1])
+            right, bottom = max(right, text_box[2]), max(bottom, text_box[3])
+        margin = 2 * self.shadow_iterations + 2
+        margin += ceil(max(abs(self.shadow_offset.x), abs(self.shadow_offset.y)))
+        x0 = min(max(floor(left) - margin, 0), img_size[0])
+        y0 = min(max(floor(top) - margin, 0), img_size[1])
+        x1 = max(min(ceil(right) + 1 + margin, img_size[0]), x0)
+        y1 = max(min(ceil(bottom) + 1 + margin, img_size[1]), y0)
+        origin = Position(x0, y0)
+
+        img = Image.new("RGBA", (x1 - x0, y1 - y0), color=(0, 0, 0, 0))
+        positions = PositionArray([item_position for item_position, _, _ in items])
+        for item_position, (_, mark, rank) in zip(positions - origin, items):
+            img, _ = self._draw_legend_item(img, item_position, mark, rank)
+
+        img = drop_shadow(
+            img,
+            self.shadow_offset,
+            self.shadow_color,
+            self.shadow_iterations,
+            engine=self.shadow_engine,
+        )
+        return self._draw_border(img, position - origin, size), (x0, y0)
+
+    def _layout(self, inner_position, marks, rows):
+        """Place the items of the legend in a grid, filled column after column.
+
+        Returns the [(position, mark, rank)] of the items and the size of the grid."""
         n_items = len(marks)
         rows, columns = compute_columns(n_items, rows)
-        max_height = self._check_height(img, marks)
+        max_height = self._check_height(marks)
 
         # Initialize the size of the legend. Height is already determined but width
-        # will be updated as we draw.
+        # will be updated as we go.
         size = Position(
             (columns - 1) * self.column_space,
             rows * max_height + (rows - 1) * self.line_space,
         )
 
-        current_position = deepcopy(inner_position)
+        items = []
+        current_position = Position(*inner_position)
         max_width = 0
         grid_list = [
             (r, c) for c in range(1, columns + 1) for r in range(1, rows + 1)
         ]  # this is a list of grid coordinates
         for grid_pos, (mark, rank) in zip(grid_list, marks.items()):
             if mark:
-                img, item_size = self._draw_legend_item(
-                    img, current_position, mark, rank
-                )
+                items.append((Position(*current_position), mark, rank))
+                item_size = self._item_size(mark, rank)
                 max_width = max(max_width, item_size.x)
 
                 if grid_pos[0] == rows or (
@@ -457,30 +1283,21 @@ class Legend:
                     current_position.x += max_width + self.column_space
                     current_position.y = inner_position.y
                     max_width = 0
+        return items, size
 
-        img = drop_shadow(
-            img, self.shadow_offset, self.shadow_color, self.shadow_iterations
-        )
-        return self._draw_border(img, position, size + 2 * self.inner_offset)
-
-    def _check_height(self, img, marks):
+    def _check_height(self, marks):
         """precompute the max height of the lines necessary to draw the marks' names"""
-        draw = ImageDraw.Draw(img)
         max_height = 0
         for mark in marks.keys():
             if mark:
-                bbox = draw.textbbox(
-                    (0, 0), mark, font=self.font, stroke_width=self.font_stroke
-                )
+                bbox = text_bbox(self.font, mark, self.font_stroke)
                 h = bbox[3] - bbox[1]
                 max_height = max(max_height, h)
 
         return max_height
 
-    def _draw_legend_item(self, img, position, mark_name, mark_rank):
-        """Draw one item of the legend"""
-        draw = ImageDraw.Draw(img)
-
+    @staticmethod
+    def _label(mark_name, mark_rank):
         rank_label = {
             "A1": "A",
             "A2": "A",
@@ -490,15 +1307,34 @@ class Legend:
             "SS": "SS",
             "SSs": "SS",
         }
-        label = f"{mark_name} ({rank_label[mark_rank]})"
-        bbox = draw.textbbox(
-            (0, 0), "a", font=self.font, stroke_width=1
-        )  # Determine the height of the text's baseline
+        return f"{mark_name} ({rank_label[mark_rank]})"
+
+    def _metrics(self, mark_name, mark_rank):
+        """Height of the text's baseline and the width and height of an item's label"""
+        bbox = text_bbox(self.font, "a", 1)
         hc = bbox[3] - bbox[1]
-        bbox = draw.textbbox(
-            (0, 0), label, font=self.font, stroke_width=1
-        )  # Actual text size
-        w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        bbox = text_bbox(self.font, self._label(mark_name, mark_rank), 1)
+        return hc, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    def _item_size(self, mark_name, mark_rank):
+        hc, w, h = self._metrics(mark_name, mark_rank)
+        return Position(hc * self.mark_scale * 1.75 + w, h)
+
+    def _label_box(self, position, mark_name, mark_rank):
+        """Bounding box of an item's label drawn at `position`"""
+        hc, _, _ = self._metrics(mark_name, mark_rank)
+        x, y = position + (hc * self.mark_scale * 1.75, 0)
+        bbox = text_bbox(self.font, self._label(mark_name, mark_rank), self.font_stroke)
+        return (x + bbox[0], y + bbox[1], x + bbox[2], y + bbox[3])
+
+    def _draw_legend_item(self, img, position, mark_name, mark_rank):
+        """Draw one item of the legend"""
+        from PIL import ImageDraw
+
+        draw = ImageDraw.Draw(img)
+
+        label = self._label(mark_name, mark_rank)
+        hc, w, h = self._metrics(mark_name, mark_rank)
 
         draw.ellipse(
             [
@@ -509,13 +1345,12 @@ class Legend:
             outline=None,
             width=0,
         )
-        draw.text(
+        draw_label(
+            img,
             position + (hc * self.mark_scale * 1.75, 0),
             label,
-            fill="white",
-            font=self.font,
-            stroke_width=self.font_stroke,
-            stroke_fill="black",
+            self.font,
+            self.font_stroke,
         )
 
         size = Position(hc * self.mark_scale * 1.75 + w, h)
@@ -523,6 +1358,8 @@ class Legend:
 
     def _draw_border(self, img, position, size):
         """Draw the legend's border"""
+        from PIL import Image, ImageColor, ImageDraw
+
         border = Image.new("RGBA", img.size, (0, 0, 0, 0))
         draw = ImageDraw.Draw(border)
 
@@ -539,6 +1376,10 @@ class Legend:
             width=1,
         )
         border = drop_shadow(
-            border, self.shadow_offset, self.shadow_color, self.shadow_iterations
+            border,
+            self.shadow_offset,
+            self.shadow_color,
+            self.shadow_iterations,
+            engine=self.shadow_engine,
         )
         return Image.alpha_composite(border, img)
@@ -0,0 +1,188 @@
+"""Process-pool helpers used by MapAnnotator's batch commands.
+
+Decoded maps travel between the parent and the workers through shared memory blocks,
+so 2048x2048 RGBA arrays are never pickled. Worker crashes are isolated: zones caught
+in a broken pool are replayed one at a time so only the culprit is reported as failed."""
+
+from collections import namedtuple
+
+ZoneReport = namedtuple("ZoneReport", ["status", "error"], defaults=[None])
+
+
+class SharedArray:
+    """A numpy array backed by a named shared memory block.
+
+    The parent creates the block and passes `spec` to a worker, which attaches to it
+    without copying. The creator is responsible for calling `unlink`."""
+
+    def __init__(self, shm, shape, dtype):
+        import numpy as np
+
+        self._shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, array):
+        """Allocate a block sized for `array` and copy its content in"""
+        from multiprocessing import shared_memory
+
+        import numpy as np
+
+        array = np.asarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = cls(shm, array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        """Attach to a block created by another process"""
+        from multiprocessing import shared_memory
+
+        name, shape, dtype = spec
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    @property
+    def spec(self):
+        """Picklable description used by `attach`"""
+        return self._shm.name, self.array.shape, self.array.dtype.str
+
+    def close(self):
+        del self.array
+        try:
+            self._shm.close()
+        except BufferError:
+            # A view is still alive (e.g. held by a traceback); the mapping goes away
+            # with the last reference instead.
+            pass
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+def run_pool(
+    zones,
+    worker,
+    workers,
+    initializer=None,
+    initargs=(),
+    prepare=None,
+    finish=None,
+    progress=None,
+):
+    """Run `worker(zone, *args)` for every zone in a process pool and report per zone.
+
+    - `prepare(zone)` runs in the parent before submission and returns `(args, handle)`
+    - `finish(zone, report, handle)` runs in the parent once the zone is done (or
+      failed) and returns the final report; it must release whatever `handle` holds.
+      `report` is None when the zone is going to be replayed after a pool crash, or
+      when run_pool exits on an exception. If it raises, the zone is failed.
+    - `progress(zone, report)` runs in the parent once the final report of a zone is known
+
+    At most 2 zones per worker are prepared at a time to bound memory use. Returns a
+    dict {zone: ZoneReport} in the order of `zones`."""
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    reports = {}
+
+    def record(zone, report):
+        reports[zone] = report
+        if progress:
+            progress(zone, report)
+
+    def release(zone, report, handle):
+        if not finish:
+            return report
+        finished, failure = _isolated(finish, zone, report, handle)
+        return failure or finished
+
+    pending = list(zones)
+    isolate = False
+    while pending:
+        queue, pending = pending, []
+        n_workers = 1 if isolate else workers
+        window = 1 if isolate else 2 * workers
+        running = {}
+        broken = False
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers, initializer=initializer, initargs=initargs
+            ) as pool:
+                while queue or running:
+                    while queue and not broken and len(running) < window:
+                        zone = queue.pop(0)
+                        prepared, failure = _isolated(
+                            prepare or (lambda _: ((), None)), zone
+                        )
+                        if failure:
+                            record(zone, failure)
+                            continue
+                        args, handle = prepared
+                        try:
+                            future = pool.submit(worker, zone, *args)
+                        except BrokenProcessPool:
+                            broken = True
+                            failure = release(zone, None, handle)
+                            if failure:
+                                record(zone, failure)
+                            else:
+                                queue.insert(0, zone)
+                            continue
+                        running[future] = (zone, handle)
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        zone, handle = running.pop(future)
+                        replay = False
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            broken = True
+                            report = None
+                            if isolate:
+                                report = ZoneReport("failed", "worker process crashed")
+                            else:
+                                replay = True
+                        else:
+                            report, failure = _isolated(future.result)
+                            report = failure or report
+                        report = release(zone, report, handle)
+                        if report is not None:
+                            record(zone, report)
+                        elif replay:
+                            pending.append(zone)
+        finally:
+            # Only left here when leaving on an exception, once the workers are done
+            for zone, handle in running.values():
+                release(zone, None, handle)
+        # Zones that never ran because the pool broke are replayed in isolation
+        pending.extend(queue)
+        isolate = isolate or broken
+    return {zone: reports[zone] for zone in zones if zone in reports}
+
+
+def run_serial(zones, func, progress=None):
+    """Run `func(zone)` for every zone in this process and report per zone, like run_pool"""
+    reports = {}
+    for zone in zones:
+        _, failure = _isolated(func, zone)
+        reports[zone] = failure or ZoneReport("ok")
+        if progress:
+            progress(zone, reports[zone])
+    return reports
+
+
+def _isolated(func, *args):
+    """Return `(func(*args), None)`, or `(None, failed ZoneReport)` if it raised.
+
+    This is the per-zone isolation boundary of the batch commands: whatever goes wrong
+    with one zone (its data, decoding, drawing, saving or the worker running it) must
+    only fail that zone, so any exception is caught here and nowhere else."""
+    try:
+        return func(*args), None
+    except Exception as e:  # noqa: BLE001, the isolation boundary
+        return None, ZoneReport("failed", _describe(e))
+
+
+def _describe(error):
+    return f"{type(error).__name__}: {error}"
@@ -0,0 +1,454 @@
+"""Opt-in timing of the rendering stages, and live progress of the batch commands.
+
+Code paths are wrapped in `stage(name)` blocks, which cost a global lookup when no trace
+is running. Within `trace()`, every block records its wall and CPU (thread) time and the
+zone it worked on, nested blocks included:
+
+    with profiling.trace() as tracer:
+        annotator.annotate_map("Central Shroud")
+    print(tracer.summary())
+    tracer.save("trace.json")  # open in chrome://tracing or https://ui.perfetto.dev
+
+With trace(memory=True), stages also record their memory peaks: the tracemalloc peak,
+which counts python objects and numpy arrays but not Pillow's image buffers, and the
+resident set size, sampled by a thread every few milliseconds. Memory tracing slows the
+run down, its timings shouldn't be compared with those of a plain trace.
+
+Pool workers started during a trace append their spans to per-process files, see
+worker_args(), which are merged back when the trace ends."""
+
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+_tracer = None
+# Spans file of this process when it's a pool worker of a trace
+_worker_path = None
+
+# Seconds between two samples of the resident set size
+RSS_INTERVAL = 0.005
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, zone=None):
+    """Time the enclosed block as `name` when a trace is running.
+
+    `zone` defaults to the zone of the enclosing stage."""
+    if _tracer is None:
+        return _NULL_STAGE
+    return _tracer.stage(name, zone)
+
+
+def traced(name):
+    """Decorator timing every call of the function as the stage `name`"""
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class Tracer:
+    """Records the spans of the stages run while it's active, see trace().
+
+    Memory peaks assume one thread runs stages at a time in each process: tracemalloc
+    peaks are process wide."""
+
+    def __init__(self, memory=False):
+        # Spans are {name, zone, start (epoch us), wall, cpu, self (s), pid, tid}, plus
+        # py_peak (bytes allocated over the stage's start) and rss_peak (bytes) with memory
+        self.spans = []
+        # RSS samples, [epoch us, bytes, pid]
+        self.samples = []
+        self.memory = memory
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._worker_dir = None
+        self._sampler = None
+        self._stop = threading.Event()
+        self._started_tracemalloc = False
+
+    def start(self):
+        """Start the memory probes"""
+        if not self.memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if rss() is not None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        """Stop the memory probes"""
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _sample(self):
+        pid = os.getpid()
+        while not self._stop.wait(RSS_INTERVAL):
+            value = rss()
+            with self._lock:
+                self.samples.append([int(time.time() * 1e6), value, pid])
+                for stack in self._stacks.values():
+                    for frame in stack:
+                        frame["rss"] = max(frame["rss"], value)
+
+    @contextlib.contextmanager
+    def stage(self, name, zone=None):
+        tid = threading.get_ident()
+        stack = self._stacks.setdefault(tid, [])
+        parent = stack[-1] if stack else None
+        if zone is None and parent is not None:
+            zone = parent["zone"]
+        frame = {"zone": zone, "children": 0.0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                # The parent's peak so far, before it's reset for this stage
+                parent["peak"] = max(parent["peak"], peak)
+            tracemalloc.reset_peak()
+            frame.update(base=current, peak=current, rss=rss() or 0)
+        with self._lock:
+            stack.append(frame)
+        start = time.time()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+            span = {
+                "name": name,
+                "zone": zone,
+                "start": int(start * 1e6),
+                "wall": wall,
+                "cpu": cpu,
+                "self": wall - frame["children"],
+                "pid": os.getpid(),
+                "tid": tid,
+            }
+            if self.memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                value = rss() or 0
+            with self._lock:
+                stack.pop()
+                if parent is not None:
+                    parent["children"] += wall
+                if self.memory:
+                    frame["rss"] = max(frame["rss"], value)
+                    span["py_peak"] = peak - frame["base"]
+                    span["rss_peak"] = frame["rss"]
+                    if parent is not None:
+                        parent["peak"] = max(parent["peak"], peak)
+                        parent["rss"] = max(parent["rss"], frame["rss"])
+                self.spans.append(span)
+
+    def worker_dir(self):
+        """Directory where pool workers write their spans, created on first use"""
+        if self._worker_dir is None:
+            self._worker_dir = tempfile.mkdtemp(prefix="huntmaps-trace-")
+        return self._worker_dir
+
+    def flush(self, path):
+        """Append the spans and samples recorded so far to the json lines file `path`"""
+        with self._lock:
+            spans, self.spans = self.spans, []
+            samples, self.samples = self.samples, []
+        with open(path, "at", encoding="utf-8") as fp:
+            fp.writelines(json.dumps(span) + "\n" for span in spans)
+            fp.writelines(json.dumps({"sample": sample}) + "\n" for sample in samples)
+
+    def collect(self):
+        """Merge the spans written by pool workers"""
+        if self._worker_dir is None:
+            return
+        for path in sorted(pathlib.Path(self._worker_dir).glob("*.jsonl")):
+            with open(path, "rt", encoding="utf-8") as fp:
+                for line in fp:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "sample" in record:
+                        self.samples.append(record["sample"])
+                    else:
+                        self.spans.append(record)
+        shutil.rmtree(self._worker_dir, ignore_errors=True)
+        self._worker_dir = None
+
+    def chrome_trace(self):
+        """Return the spans as Chrome trace events ("X" complete events, in us).
+
+        RSS samples become "rss" counter events."""
+        events = []
+        for span in sorted(self.spans, key=lambda span: span["start"]):
+            args = {"cpu_ms": round(span["cpu"] * 1e3, 3)}
+            if span["zone"] is not None:
+                args["zone"] = span["zone"]
+            for key in ("py_peak", "rss_peak"):
+                if key in span:
+                    args[f"{key}_mb"] = round(span[key] / 2**20, 1)
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": "stage",
+                    "ph": "X",
+                    "ts": span["start"],
+                    "dur": round(span["wall"] * 1e6),
+                    "pid": span["pid"],
+                    "tid": span["tid"],
+                    "args": args,
+                }
+            )
+        for ts, value, pid in self.samples:
+            events.append(
+                {
+                    "name": "rss",
+                    "ph": "C",
+                    "ts": ts,
+                    "pid": pid,
+                    "args": {"MB": round(value / 2**20, 1)},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        """Write the Chrome trace-event json to `path`"""
+        with open(path, "wt", encoding="utf-8") as fp:
+            json.dump(self.chrome_trace(), fp)
+
+    def stages(self):
+        """Return {stage: {count, wall, cpu, self, max}} of the recorded spans, in seconds.
+
+        wall and cpu include the nested stages, self excludes them: the self times add
+        up to the traced time of each thread. With memory, py_peak and rss_peak are the
+        largest peaks of the stage, in bytes."""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(
+                span["name"],
+                {"count": 0, "wall": 0.0, "cpu": 0.0, "self": 0.0, "max": 0.0},
+            )
+            total["count"] += 1
+            total["wall"] += span["wall"]
+            total["cpu"] += span["cpu"]
+            total["self"] += span["self"]
+            total["max"] = max(total["max"], span["wall"])
+            for key in ("py_peak", "rss_peak"):
+                if key in span:
+                    total[key] = max(total.get(key, 0), span[key])
+        return dict(sorted(totals.items(), key=lambda item: -item[1]["self"]))
+
+    def zones(self):
+        """Return {zone: {stage: wall time}} of the recorded spans, in seconds"""
+        zones = {}
+        for span in self.spans:
+            if span["zone"] is not None:
+                stages = zones.setdefault(span["zone"], {})
+                stages[span["name"]] = stages.get(span["name"], 0.0) + span["wall"]
+        return zones
+
+    def peak_rss(self):
+        """Largest resident set size sampled by any process of the trace, in bytes"""
+        values = [value for _, value, _ in self.samples]
+        values += [span["rss_peak"] for span in self.spans if "rss_peak" in span]
+        return max(values, default=None)
+
+    def summary(self):
+        """Return the per-stage totals as a table, slowest first"""
+        stages = self.stages()
+        memory = any("py_peak" in total for total in stages.values())
+        traced = sum(total["self"] for total in stages.values()) or 1
+        header = (
+            f"{'stage':<16} {'count':>6} {'wall':>9} {'self':>9} {'cpu':>9} "
+            f"{'mean':>9} {'max':>9} {'self %':>7}"
+        )
+        if memory:
+            header += f" {'py peak':>9} {'rss peak':>9}"
+        lines = [header]
+        for name, total in stages.items():
+            line = (
+                f"{name:<16} {total['count']:>6} {_ms(total['wall'])} "
+                f"{_ms(total['self'])} {_ms(total['cpu'])} "
+                f"{_ms(total['wall'] / total['count'])} {_ms(total['max'])} "
+                f"{total['self'] / traced:>7.1%}"
+            )
+            if memory:
+                line += f" {_mb(total.get('py_peak'))} {_mb(total.get('rss_peak'))}"
+            lines.append(line)
+        if memory and self.peak_rss():
+            lines.append(f"Peak resident memory: {_mb(self.peak_rss()).strip()}")
+        return "\n".join(lines)
+
+
+def _ms(seconds):
+    return f"{seconds * 1e3:>7.1f}ms"
+
+
+def _mb(size):
+    if not size:
+        return f"{'-':>9}"
+    return f"{size / 2**20:>7.1f}MB"
+
+
+def rss():
+    """Resident set size of this process in bytes, None where it can't be read"""
+    try:
+        with open("/proc/self/statm", "rb") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if sys.platform == "win32":
+        return _windows_rss()
+    return None
+
+
+def _windows_rss():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    if not kernel32.K32GetProcessMemoryInfo(
+        kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+    ):
+        return None
+    return counters.WorkingSetSize
+
+
+@contextlib.contextmanager
+def trace(memory=False):
+    """Record the stages run in the block, including those of pool workers started in it.
+
+    memory=True also records the memory peaks of the stages."""
+    global _tracer
+    if _tracer is not None:
+        raise RuntimeError("A trace is already running, traces can't be nested.")
+    tracer = _tracer = Tracer(memory)
+    tracer.start()
+    try:
+        yield tracer
+    finally:
+        _tracer = None
+        tracer.stop()
+        tracer.collect()
+
+
+def worker_args():
+    """Picklable arguments to hand to pool workers for start_worker, None without trace"""
+    if _tracer is None:
+        return None
+    return _tracer.worker_dir(), _tracer.memory
+
+
+def start_worker(args):
+    """Record the stages of this worker process for the trace that handed out `args`"""
+    global _tracer, _worker_path
+    if args is None:
+        return
+    directory, memory = args
+    _tracer = Tracer(memory)
+    _tracer.start()
+    _worker_path = os.path.join(directory, f"{os.getpid()}.jsonl")
+
+
+def flush():
+    """Hand the spans of this worker process over to the parent's trace"""
+    if _tracer is not None and _worker_path is not None:
+        _tracer.flush(_worker_path)
+
+
+class Progress:
+    """Live `done/total` line with throughput and ETA of a batch command, on stderr.
+
+    The line is redrawn in place on a terminal, otherwise a line is printed per update."""
+
+    def __init__(self, total, label, stream=None):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self._stream = stream or sys.stderr
+        self._tty = getattr(self._stream, "isatty", lambda: False)()
+        self._start = time.monotonic()
+        self._width = 0
+
+    def update(self, zone, report=None):
+        """Count `zone` as done"""
+        self.done += 1
+        elapsed = time.monotonic() - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        status = (
+            "" if report is None or report.status == "ok" else f" ({report.status})"
+        )
+        line = (
+            f"{self.label} {self.done}/{self.total} {self.done / self.total:.0%} "
+            f"{rate:.2f} zones/s ETA {_duration(eta)} - {zone}{status}"
+        )
+        if self._tty:
+            self._stream.write("\r" + line.ljust(self._width))
+            self._width = len(line)
+        else:
+            self._stream.write(line + "\n")
+        self._stream.flush()
+
+    def close(self):
+        if self._tty and self._width:
+            self._stream.write("\n")
+            self._stream.flush()
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
@@ -191,3 +191,64 @@ def sample_image_file(temp_dir, sample_image):
     img_file = temp_dir / "test_map.png"
     sample_image.save(img_file)
     return img_file
+
+
+@pytest.fixture
+def annotator_workspace(temp_dir, sample_config, monkeypatch):
+    """Create a working directory with data files and backup maps for MapAnnotator.
+
+    Maps are small DXT1 files so rendering stays fast (512x512, and 256x256 for the
+    second zone); spawns are placed in the top-left of the 2048-based coordinate space."""
+    config = dict(sample_config)
+    config["tool"] = dict(
+        config["tool"],
+        textools_path=str(temp_dir / "textools"),
+        project_path=str(temp_dir / "project"),
+    )
+    config["zones"] = {
+        "Test Zone": {
+            "expansion": "ARR",
+            "landmine": False,
+            "legend": {"rows": 2, "position": [250, 300]},
+        },
+        "Second Zone": {
+            "expansion": "SB",
+            "landmine": False,
+            "legend": {"rows": 4, "position": [20, 20]},
+        },
+    }
+    zone_info = {
+        "Test Zone": {"region": "Test Region", "scale": 100, "filename": "t1f100"},
+        "Second Zone": {"region": "Test Region", "scale": 200, "filename": "t1f200"},
+    }
+    marks = [
+        {"name": "Mark A", "rank": "A", "zone": "Test Zone", "spawns": [[3.0, 4.0], [5.5, 6.0]]},
+        {"name": "Mark A2", "rank": "A", "zone": "Test Zone", "spawns": [[3.0, 4.0]]},
+        {"name": "Mark B", "rank": "B", "zone": "Test Zone", "spawns": [[7.0, 3.5]]},
+        {"name": "Mark S", "rank": "S", "zone": "Test Zone", "spawns": [[8.0, 8.0]]},
+        {"name": "Mark B2", "rank": "B", "zone": "Second Zone", "spawns": [[2.0, 2.5], [3.0, 3.0]]},
+    ]
+
+    data = temp_dir / "data"
+    data.mkdir()
+    with open(data / "config.yaml", "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f)
+    with open(data / "zone_info.yaml", "w", encoding="utf-8") as f:
+        yaml.safe_dump(zone_info, f)
+    with open(data / "marks.json", "w", encoding="utf-8") as f:
+        json.dump(marks, f)
+
+    sizes = {"Test Zone": 512, "Second Zone": 256}
+    for zone, info in zone_info.items():
+        folder = temp_dir / "textools" / "Saved" / "UI" / "Maps" / info["region"] / zone
+        folder.mkdir(parents=True)
+        img = Image.linear_gradient("L").resize((sizes[zone],) * 2).convert("RGBA")
+        img.save(folder / (info["filename"] + "_m_backup.dds"), pixel_format="DXT1")
+
+    masks = temp_dir / "project" / "Blended" / "masks"
+    masks.mkdir(parents=True)
+    for size, mask in [(512, "arrhw_mask.png"), (256, "sb_mask.png")]:
+        Image.effect_noise((size, size), 40).convert("RGB").save(masks / mask)
+
+    monkeypatch.chdir(temp_dir)
+    return temp_dir
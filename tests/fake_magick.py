@@ -0,0 +1,48 @@
+"""Stand-in for `magick convert ... pam:- +adjoin <pattern>` used by the batch tests.
+
+Reads a multi-frame PAM stream from stdin and writes each frame with the native encoder
+to `pattern % scene`. Frames whose width is FAKE_MAGICK_SKIP_WIDTH are dropped with a
+message on stderr, like ImageMagick does for a frame it can't write. FAKE_MAGICK_WARNINGS
+bytes of warnings are written to stderr for every frame."""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dds import save_dds  # noqa: E402
+
+
+def read_frames(stream):
+    while True:
+        magic = stream.readline()
+        if not magic:
+            return
+        header = {}
+        while True:
+            line = stream.readline().decode().strip()
+            if line == "ENDHDR":
+                break
+            key, value = line.split(" ", 1)
+            header[key] = value
+        w, h, depth = int(header["WIDTH"]), int(header["HEIGHT"]), int(header["DEPTH"])
+        data = stream.read(w * h * depth)
+        yield np.frombuffer(data, dtype=np.uint8).reshape(h, w, depth)
+
+
+def main():
+    pattern = sys.argv[-1]
+    skip = int(os.environ.get("FAKE_MAGICK_SKIP_WIDTH", -1))
+    warnings = int(os.environ.get("FAKE_MAGICK_WARNINGS", 0))
+    for scene, frame in enumerate(read_frames(sys.stdin.buffer)):
+        sys.stderr.write("w" * warnings)
+        if frame.shape[1] == skip:
+            print(f"convert: unable to write frame {scene}", file=sys.stderr)
+            continue
+        save_dds(frame, pattern % scene)
+
+
+if __name__ == "__main__":
+    main()
@@ -59,25 +59,66 @@ class TestMapAnnotatorFileOps:
 class TestMapAnnotatorZoneMarks:
     """Tests for zone and mark handling."""
 
-    def test_get_zone_marks_basic(self):
+    def test_get_zone_marks_basic(self, annotator_workspace):
         """Test getting marks for a zone."""
-        pytest.skip("Requires MapAnnotator setup")
+        from annotate import MapAnnotator
 
-    def test_get_zone_marks_with_rank_remap(self):
+        marks = MapAnnotator()._get_zone_marks("Test Zone")
+
+        assert marks["Mark A"] == ("A", ((3, 4), (5.5, 6)))
+        assert marks["Mark B"] == ("B", ((7, 3.5),))
+        assert set(marks) == {"Mark A", "Mark A2", "Mark B", "Mark S"}
+
+    def test_get_zone_marks_with_rank_remap(self, annotator_workspace):
         """Test rank remapping for multiple marks of same rank."""
-        pytest.skip("Requires MapAnnotator setup")
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        marks = annotator._get_zone_marks("Test Zone", True)
+
+        assert marks["Mark A"][0] == "A1"
+        assert marks["Mark A2"][0] == "A2"
+        assert marks["Mark B"][0] == "B1"
+        assert marks["Mark S"][0] == "S"
+        assert annotator._get_zone_marks("Second Zone", True)["Mark B2"][0] == "B1"
 
-    def test_check_spawn_points_no_overlap(self):
+    def test_get_zone_marks_unknown_zone(self, annotator_workspace):
+        """Test getting marks for a zone without marks."""
+        from annotate import MapAnnotator
+
+        assert MapAnnotator()._get_zone_marks("Nowhere") == {}
+
+    def test_check_spawn_points_no_overlap(self, annotator_workspace):
         """Test checking spawn points with no overlaps."""
-        pytest.skip("Requires MapAnnotator setup")
+        from annotate import MapAnnotator
 
-    def test_check_spawn_points_with_overlap(self):
+        assert MapAnnotator().check_spawn_points() == {}
+
+    def test_check_spawn_points_with_overlap(self, annotator_workspace):
         """Test checking spawn points with overlapping positions."""
-        pytest.skip("Requires MapAnnotator setup")
+        from annotate import MapAnnotator
+
+        marks_file = annotator_workspace / "data" / "marks.json"
+        marks = json.loads(marks_file.read_text(encoding="utf-8"))
+        marks += [
+            # Near-duplicate of a spawn of another mark in the same zone
+            {"name": "Mark C", "rank": "B", "zone": "Test Zone", "spawns": [[3.2, 4.1]]},
+            # Same coordinates, different zone: not a duplicate
+            {"name": "Mark D", "rank": "A", "zone": "Second Zone", "spawns": [[3.0, 4.0]]},
+        ]
+        marks_file.write_text(json.dumps(marks), encoding="utf-8")
 
-    def test_check_spawn_points_custom_threshold(self):
+        suspicious = MapAnnotator().check_spawn_points()
+
+        assert dict(suspicious) == {"Test Zone": [[(3.0, 4.0), (3.2, 4.1)]]}
+
+    def test_check_spawn_points_custom_threshold(self, annotator_workspace):
         """Test checking spawn points with custom threshold."""
-        pytest.skip("Requires MapAnnotator setup")
+        from annotate import MapAnnotator
+
+        suspicious = MapAnnotator().check_spawn_points(threshold=1.2)
+
+        assert dict(suspicious) == {"Second Zone": [[(2.0, 2.5), (3.0, 3.0)]]}
 
 
 class TestMapAnnotatorAnnotation:
@@ -103,22 +144,81 @@ class TestMapAnnotatorAnnotation:
         """Test that annotate_all processes all zones."""
         pytest.skip("Requires full setup")
 
-    def test_draw_marker_rank_s(self):
+    @staticmethod
+    def draw_marker_direct(config, img, position, marks):
+        """Reference: draw the marker straight on the layer, as before sprites"""
+        from PIL import ImageDraw
+
+        draw = ImageDraw.Draw(img)
+        size = config["marker"]["size"]
+        inner_size = size * config["marker"]["inner_size_scale"]
+        colors = config["colors"]
+        box = (*(position - 0.5 * size), *(position + 0.5 * size))
+        inner_box = (*(position - 0.5 * inner_size), *(position + 0.5 * inner_size))
+        for angle, rank in zip(range(180, 180 + 360, 90), ["B1", "B2", "A1", "A2"]):
+            if rank in marks.values():
+                draw.pieslice(box, angle, angle + 90, fill=colors[rank])
+        if "S" in marks.values():
+            draw.ellipse(inner_box, fill=colors["S"])
+        if "SS" in marks.values() or "SSs" in marks.values():
+            draw.ellipse(box, fill=colors[next(iter(marks.values()))])
+        return img
+
+    def assert_same_as_direct(self, markers):
+        from annotate import MapAnnotator
+        from helpers import Position
+
+        annotator = MapAnnotator()
+        expected = Image.new("RGBA", (128, 96), (0, 0, 0, 0))
+        result = Image.new("RGBA", (128, 96), (0, 0, 0, 0))
+        for position, marks in markers:
+            self.draw_marker_direct(
+                annotator._config, expected, Position(*position), marks
+            )
+            annotator._draw_marker(result, Position(*position), marks)
+        assert result.tobytes() == expected.tobytes()
+        return annotator
+
+    def test_draw_marker_rank_s(self, annotator_workspace):
         """Test drawing S rank marker."""
-        pytest.skip("Requires MapAnnotator instance")
+        self.assert_same_as_direct([((60, 40), {"s": "S"})])
 
-    def test_draw_marker_rank_a(self):
+    def test_draw_marker_rank_a(self, annotator_workspace):
         """Test drawing A rank markers."""
-        pytest.skip("Requires MapAnnotator instance")
+        self.assert_same_as_direct(
+            [((30, 30), {"a1": "A1"}), ((90, 50), {"a1": "A1", "a2": "A2"})]
+        )
 
-    def test_draw_marker_rank_b(self):
+    def test_draw_marker_rank_b(self, annotator_workspace):
         """Test drawing B rank markers."""
-        pytest.skip("Requires MapAnnotator instance")
+        self.assert_same_as_direct(
+            [((30, 30), {"b2": "B2"}), ((90, 50), {"b1": "B1", "s": "S"})]
+        )
 
-    def test_draw_marker_rank_ss(self):
+    def test_draw_marker_rank_ss(self, annotator_workspace):
         """Test drawing SS rank marker."""
-        pytest.skip("Requires MapAnnotator instance")
-
+        self.assert_same_as_direct(
+            [((30, 30), {"ss": "SS"}), ((90, 50), {"minion": "SSs"})]
+        )
+
+    def test_draw_marker_overlap_and_edges(self, annotator_workspace):
+        """Overlapping, clipped and sub-pixel markers match direct drawing."""
+        self.assert_same_as_direct(
+            [
+                ((5, 3), {"a1": "A1", "b1": "B1"}),
+                ((20, 10), {"a2": "A2", "s": "S"}),
+                ((125, 94), {"b2": "B2", "a1": "A1", "a2": "A2", "b1": "B1"}),
+                ((60.5, 40.25), {"a1": "A1", "s": "S"}),
+            ]
+        )
+
+    def test_draw_marker_reuses_sprites(self, annotator_workspace):
+        """A sprite is rendered once per rank combination."""
+        annotator = self.assert_same_as_direct(
+            [((x, 40), {"a": "A1", "b": "B2"}) for x in range(10, 120, 15)]
+            + [((x, 80), {"b": "B2", "a": "A1"}) for x in range(10, 120, 15)]
+        )
+        assert len(annotator._sprites) == 1
 
 class TestMapAnnotatorSave:
     """Tests for map saving functionality."""
@@ -146,9 +246,25 @@ class TestMapAnnotatorSave:
 class TestMapAnnotatorBlend:
     """Tests for map blending functionality."""
 
-    def test_blend_map_basic(self):
-        """Test basic map blending."""
-        pytest.skip("Requires full setup with mask files")
+    def test_blend_map_basic(self, annotator_workspace):
+        """Test that blend_map matches the float computation it replaced."""
+        import numpy as np
+        from PIL import Image
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        with Image.open(annotator._get_path("Test Zone", backup=True)) as img:
+            pixels = np.array(img.convert("RGBA"))
+        mask_path = annotator_workspace / "project" / "Blended" / "masks" / "arrhw_mask.png"
+        with Image.open(mask_path) as img:
+            mask = np.array(img)[:, :, :3]
+        expected = np.zeros(pixels.shape, dtype=pixels.dtype)
+        expected[:, :, :3] = pixels.astype(float)[:, :, :3] * mask / 255.0
+        expected[:, :, 3] = pixels[:, :, 3]
+
+        for _ in range(2):  # the second blend reuses the scratch buffer
+            blended = annotator.blend_map("Test Zone", show=False)
+            assert (np.asarray(blended) == expected).all()
 
     def test_blend_map_size_mismatch_raises_error(self):
         """Test that size mismatch raises ValueError."""
@@ -166,6 +282,358 @@ class TestMapAnnotatorBlend:
         pytest.skip("Requires full setup")
 
 
+class TestBuildPipeline:
+    """Tests for build_map and build_all."""
+
+    def test_build_map_matches_separate_commands(self, annotator_workspace):
+        """Test that the fused pipeline writes what annotate_map and blend_map write."""
+        import numpy as np
+        from PIL import Image
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        outputs = {
+            "dds": annotator._get_path("Test Zone"),
+            "preview": annotator._get_path("Test Zone", project=True, ext="png"),
+            "blended": annotator_workspace / "project" / "Blended" / "Test Zone.png",
+        }
+        annotator.annotate_map("Test Zone", save=True, show=False)
+        annotator.blend_map("Test Zone", save=True, show=False)
+        expected = {key: path.read_bytes() for key, path in outputs.items()}
+        for path in outputs.values():
+            path.unlink()
+
+        images = annotator.build_map("Test Zone")
+
+        for key, path in outputs.items():
+            assert path.read_bytes() == expected[key], key
+        assert (np.asarray(images["blended"]) == np.asarray(Image.open(outputs["blended"]))).all()
+
+    def test_build_map_decodes_once(self, annotator_workspace, monkeypatch):
+        """Test that the backup is opened a single time for all outputs."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        calls = []
+        decode = annotator._decode_backup
+        monkeypatch.setattr(annotator, "_decode_backup", lambda name: calls.append(name) or decode(name))
+
+        annotator.build_map("Test Zone", composite=True)
+
+        assert calls == ["Test Zone"]
+
+    def test_composite_is_blended_annotation(self, annotator_workspace):
+        """Test that the composite is the annotated map multiplied by the mask."""
+        import numpy as np
+        from annotate import MapAnnotator
+        from helpers import blend_multiply
+
+        annotator = MapAnnotator()
+
+        images = annotator.build_map("Test Zone", composite=True)
+
+        expected = blend_multiply(np.array(images["annotated"]), annotator._get_mask("Test Zone"))
+        assert (np.asarray(images["composite"]) == expected).all()
+        assert (annotator_workspace / "project" / "Blended" / "Annotated" / "Test Zone.png").exists()
+
+    def test_build_all_skips_fresh_zones(self, annotator_workspace):
+        """Test that build_all only rebuilds the zones whose inputs changed."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        report = annotator.build_all()
+
+        assert all(r.status == "ok" for r in report.values())
+        assert annotator.build_all(dry_run=True) == []
+        assert set(annotator.build_all(dry_run=True, composite=True)) == set(annotator._zones)
+
+        (annotator_workspace / "project" / "Blended" / "Second Zone.png").unlink()
+        assert annotator.build_all(dry_run=True) == ["Second Zone"]
+
+    def test_build_all_missing_mask_fails_zone(self, annotator_workspace):
+        """Test that a zone without its mask fails before any of its outputs is written."""
+        from annotate import MapAnnotator
+
+        (annotator_workspace / "project" / "Blended" / "masks" / "sb_mask.png").unlink()
+        annotator = MapAnnotator()
+
+        report = annotator.build_all()
+
+        assert report["Test Zone"].status == "ok"
+        assert "Mask file not found" in report["Second Zone"].error
+        assert not annotator._get_path("Second Zone").exists()
+
+
+
+class TestMemoryBudget:
+    """Tests for the max_memory budget of the tool."""
+
+    @staticmethod
+    def set_budget(workspace, max_memory):
+        path = workspace / "data" / "config.yaml"
+        config = yaml.safe_load(path.read_text(encoding="utf-8"))
+        config["tool"]["max_memory"] = max_memory
+        path.write_text(yaml.safe_dump(config), encoding="utf-8")
+
+    def test_budget_gives_the_same_maps(self, annotator_workspace):
+        """Test that the banded processing renders what the unbudgeted one does."""
+        import numpy as np
+        from annotate import MapAnnotator
+
+        unbudgeted = MapAnnotator()
+        expected = {
+            "annotated": np.asarray(unbudgeted.annotate_map("Test Zone", show=False)),
+            "blended": np.asarray(unbudgeted.blend_map("Test Zone", show=False)),
+        }
+        # A 0.05 MB budget cuts the 512px map in bands of a few rows
+        self.set_budget(annotator_workspace, 0.05)
+        annotator = MapAnnotator()
+        annotated = np.asarray(annotator.annotate_map("Test Zone", show=False))
+        blended = np.asarray(annotator.blend_map("Test Zone", show=False))
+
+        diff = np.abs(annotated.astype(int) - expected["annotated"])
+        assert diff.max() <= 1
+        assert (blended == expected["blended"]).all()
+        assert len(annotator._blend_scratch) < 512
+
+    def test_budget_keeps_a_single_mask(self, annotator_workspace):
+        """Test that the masks are not all kept in memory under a budget."""
+        from annotate import MapAnnotator
+
+        self.set_budget(annotator_workspace, 1)
+        annotator = MapAnnotator()
+        annotator.blend_map("Test Zone", show=False)
+        annotator.blend_map("Second Zone", show=False)
+        assert len(annotator._masks) == 1
+
+    @pytest.mark.parametrize("max_memory", [0, -5, "lots"])
+    def test_invalid_budget_raises_error(self, annotator_workspace, max_memory):
+        """Test that a budget which isn't a positive number is refused."""
+        from annotate import MapAnnotator
+
+        self.set_budget(annotator_workspace, max_memory)
+        with pytest.raises(ValueError, match="max_memory"):
+            MapAnnotator()
+
+
+class TestWatch:
+    """Tests for the watch command and the detection of the zones to re-render."""
+
+    @staticmethod
+    def edit_config(workspace, edit):
+        path = workspace / "data" / "config.yaml"
+        config = yaml.safe_load(path.read_text(encoding="utf-8"))
+        edit(config)
+        path.write_text(yaml.safe_dump(config), encoding="utf-8")
+
+    @staticmethod
+    def edit_marks(workspace, edit):
+        path = workspace / "data" / "marks.json"
+        marks = json.loads(path.read_text(encoding="utf-8"))
+        edit(marks)
+        path.write_text(json.dumps(marks), encoding="utf-8")
+
+    def test_global_style_change_affects_all_zones(self, annotator_workspace):
+        """Test that a colors change re-renders every zone."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        self.edit_config(annotator_workspace, lambda c: c["colors"].update(S="blue"))
+
+        assert set(annotator._reload()) == {"Test Zone", "Second Zone"}
+
+    def test_zone_change_affects_one_zone(self, annotator_workspace):
+        """Test that a zone's legend position only re-renders that zone."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        self.edit_config(
+            annotator_workspace,
+            lambda c: c["zones"]["Second Zone"]["legend"].update(position=[40, 40]),
+        )
+
+        assert annotator._reload() == ["Second Zone"]
+        assert annotator._zones["Second Zone"]["legend"]["position"] == [40, 40]
+
+    def test_marks_change_affects_their_zone(self, annotator_workspace):
+        """Test that moving a spawn re-renders its zone only."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        self.edit_marks(annotator_workspace, lambda m: m[4]["spawns"].append([4.0, 4.0]))
+
+        assert annotator._reload() == ["Second Zone"]
+
+    def test_unrelated_change_affects_no_zone(self, annotator_workspace):
+        """Test that sections not used for rendering don't re-render anything."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        sprites = annotator._sprites
+        self.edit_config(annotator_workspace, lambda c: c.update(notes="unused"))
+
+        assert annotator._reload() == []
+        assert annotator._sprites is sprites
+
+    def test_refresh_updates_changed_previews(self, annotator_workspace):
+        """Test that only the previews of the changed zones are written."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        self.edit_marks(annotator_workspace, lambda m: m[0]["spawns"].pop())
+
+        report = annotator._refresh()
+
+        assert list(report) == ["Test Zone"] and report["Test Zone"].status == "ok"
+        assert annotator._get_path("Test Zone", project=True, ext="png").exists()
+        assert not annotator._get_path("Second Zone", project=True, ext="png").exists()
+        assert not annotator._get_path("Test Zone").exists()
+
+    def test_invalid_edit_keeps_previous_state(self, annotator_workspace, capsys):
+        """Test that a file that can't be loaded is reported and the annotator kept as is."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        zones = annotator._zones
+        (annotator_workspace / "data" / "config.yaml").write_text("tool: [", encoding="utf-8")
+
+        assert annotator._refresh() == {}
+        assert "Invalid YAML" in capsys.readouterr().out
+        assert annotator._zones is zones
+
+    def test_invalid_setting_keeps_previous_state(self, annotator_workspace):
+        """Test that a setting rejected after the files were parsed changes nothing."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        state = dict(vars(annotator))
+        self.edit_config(annotator_workspace, lambda c: c["tool"].update(max_memory=-1))
+
+        with pytest.raises(ValueError, match="max_memory"):
+            annotator._reload()
+        assert vars(annotator) == state
+
+    def test_tool_change_resets_caches(self, annotator_workspace):
+        """Test that the caches are only started again when the tool settings change."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        legend_cache = annotator._legend_cache
+        self.edit_config(annotator_workspace, lambda c: c["colors"].update(S="blue"))
+        annotator._reload()
+        assert annotator._legend_cache is legend_cache
+
+        self.edit_config(annotator_workspace, lambda c: c["tool"].update(max_memory=64))
+        annotator._reload()
+        assert annotator._legend_cache is not legend_cache
+        assert annotator._max_memory == 64 * 2**20
+
+    def test_watch_debounces_edits(self, annotator_workspace, monkeypatch):
+        """Test that edits made in a burst lead to a single update."""
+        import threading
+        import time
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        refreshed = []
+        monkeypatch.setattr(annotator, "_refresh", lambda save=False: refreshed.append(save))
+        thread = threading.Thread(
+            target=annotator.watch, kwargs=dict(interval=0.02, debounce=0.3, max_updates=1)
+        )
+        thread.start()
+        time.sleep(0.1)
+        for i in range(3):
+            self.edit_marks(annotator_workspace, lambda m: m[0]["spawns"].append([i, i]))
+            time.sleep(0.05)
+        thread.join(timeout=10)
+
+        assert not thread.is_alive()
+        assert refreshed == [False]
+
+
+
+class TestZoneInfoUpdate:
+    """Tests for fetching zone info of new or stale zones."""
+
+    @staticmethod
+    def served_zones(workspace):
+        zone_info = yaml.safe_load((workspace / "data" / "zone_info.yaml").read_text())
+        zone_info["New Zone"] = {"region": "New Region", "scale": 400, "filename": "n1f100"}
+        return zone_info
+
+    def test_new_zone_is_fetched_by_update(self, annotator_workspace):
+        """Test that a zone added to the configuration is only fetched on request, alone."""
+        from annotate import MapAnnotator
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.served_zones(annotator_workspace)) as server:
+            TestWatch.edit_config(
+                annotator_workspace,
+                lambda c: (
+                    c["tool"].update(xivapi_url=server.url),
+                    c["zones"].update(
+                        {"New Zone": {"expansion": "DT", "landmine": False, "legend": {"rows": 1, "position": [0, 0]}}}
+                    ),
+                ),
+            )
+            with pytest.raises(KeyError, match="Run update_zone_info"):
+                MapAnnotator()
+            assert server.requests == []
+
+            assert MapAnnotator.update_zone_info() == ["New Zone"]
+            annotator = MapAnnotator()
+
+        assert annotator._zones["New Zone"]["scale"] == 400
+        assert sorted(path for path, _ in server.requests) == ["/placename/3", "/search"]
+
+    def test_update_from_cli_without_zone_info(self, annotator_workspace):
+        """Test that the CLI command runs while zones are missing from zone_info.yaml."""
+        import subprocess
+        import sys
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.served_zones(annotator_workspace)) as server:
+            TestWatch.edit_config(
+                annotator_workspace,
+                lambda c: (
+                    c["tool"].update(xivapi_url=server.url),
+                    c["zones"].update(
+                        {"New Zone": {"expansion": "DT", "landmine": False, "legend": {"rows": 1, "position": [0, 0]}}}
+                    ),
+                ),
+            )
+            script = Path(__file__).parent.parent / "annotate.py"
+            result = subprocess.run(
+                [sys.executable, str(script), "update_zone_info"],
+                cwd=annotator_workspace,
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+
+        assert result.returncode == 0, result.stderr
+        assert "1 zones fetched from xivapi." in result.stdout
+
+    def test_update_stale_zone(self, annotator_workspace):
+        """Test that update_zone_info refreshes the given zones only."""
+        from annotate import MapAnnotator
+        from tests.xivapi_server import XivApiServer
+
+        zones = self.served_zones(annotator_workspace)
+        zones["Second Zone"]["scale"] = 250
+        with XivApiServer(zones) as server:
+            TestWatch.edit_config(
+                annotator_workspace, lambda c: c["tool"].update(xivapi_url=server.url)
+            )
+            assert MapAnnotator.update_zone_info("Second Zone") == ["Second Zone"]
+            annotator = MapAnnotator()
+
+        assert annotator._zones["Second Zone"]["scale"] == 250
+        assert annotator._zones["Test Zone"]["scale"] == 100
+        with pytest.raises(ValueError, match="Unknown zone"):
+            annotator.update_zone_info("Nowhere")
+
+
 class TestMapAnnotatorThumbnail:
     """Tests for thumbnail generation."""
 
@@ -207,13 +675,60 @@ class TestIntegrationAnnotate:
 class TestYAMLSafeLoading:
     """Tests for YAML loading security."""
 
-    def test_config_uses_safe_loader(self):
+    def test_config_uses_safe_loader(self, annotator_workspace):
         """Test that config loading uses safe YAML loader."""
-        # TODO: Current implementation uses yaml.Loader instead of SafeLoader
-        # This is a security concern
-        pytest.skip("Need to verify YAML loader type in actual code")
+        from annotate import MapAnnotator
+
+        config = annotator_workspace / "data" / "config.yaml"
+        config.write_text(
+            config.read_text(encoding="utf-8")
+            + "\nexploit: !!python/object/apply:os.system ['echo unsafe']\n",
+            encoding="utf-8",
+        )
 
-    def test_zone_info_uses_safe_loader(self):
+        with pytest.raises(ValueError, match="Invalid YAML"):
+            MapAnnotator()
+
+    def test_zone_info_uses_safe_loader(self, annotator_workspace):
         """Test that zone info loading uses safe YAML loader."""
-        # TODO: Current implementation uses yaml.Loader
-        pytest.skip("Need to verify YAML loader type in actual code")
+        from helpers import ZoneApi
+
+        zone_info = annotator_workspace / "data" / "zone_info.yaml"
+        zone_info.write_text("zone: !!python/name:os.system\n", encoding="utf-8")
+
+        with pytest.raises(yaml.YAMLError):
+            ZoneApi([]).load_zone_info()
+
+    def test_config_tuples(self, annotator_workspace):
+        """Test that values written as tuples are read as tuples, and only those."""
+        from annotate import MapAnnotator
+
+        config = annotator_workspace / "data" / "config.yaml"
+        config.write_text(
+            config.read_text(encoding="utf-8")
+            + "\nextra:\n  offset: (3, -2.5)\n  text: not (a tuple)\n",
+            encoding="utf-8",
+        )
+
+        extra = MapAnnotator()._config["extra"]
+
+        assert extra == {"offset": (3, -2.5), "text": "not (a tuple)"}
+
+    def test_data_snapshot_follows_edits(self, annotator_workspace):
+        """Test that the parsed data is reused, then refreshed after an edit."""
+        import os
+
+        from annotate import MapAnnotator
+
+        MapAnnotator()
+        assert (annotator_workspace / ".cache" / "data.pickle").exists()
+
+        marks_file = annotator_workspace / "data" / "marks.json"
+        marks = json.loads(marks_file.read_text(encoding="utf-8"))
+        marks[0]["spawns"] = [[9.0, 9.0]]
+        marks_file.write_text(json.dumps(marks), encoding="utf-8")
+        os.utime(marks_file, ns=(1, 1))  # same size, make sure the mtime differs too
+
+        zone_marks = MapAnnotator()._get_zone_marks("Test Zone")
+
+        assert zone_marks["Mark A"] == ("A", ((9.0, 9.0),))
@@ -0,0 +1,105 @@
+"""Tests for the benchmark suite and its synthetic data."""
+
+import json
+
+import pytest
+
+import bench
+
+
+@pytest.fixture
+def bench_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bench, "BENCH_DIR", tmp_path / "bench")
+    return tmp_path / "bench"
+
+
+def write_results(path, scale=1, **times):
+    results = {
+        name: {"min": t, "median": t, "number": 1, "repeats": 1}
+        for name, t in times.items()
+    }
+    with open(path, "wt", encoding="utf-8") as fp:
+        json.dump({"meta": {"scale": scale}, "results": results}, fp)
+    return path
+
+
+class TestSyntheticData:
+    """Tests for the synthetic data generator."""
+
+    @pytest.mark.parametrize("scale", [1, 10])
+    def test_data_scales(self, scale):
+        """Test that zones grow with the scale, and the spawns of the rendered zone too."""
+        zones, zone_info, marks = bench.make_data(scale)
+        assert len(zones) == len(zone_info) == bench.REAL_ZONES * scale
+        assert len(marks) == len(zones) * len(bench.RANKS)
+        spawns = {mark["zone"]: 0 for mark in marks}
+        for mark in marks:
+            spawns[mark["zone"]] += len(mark["spawns"])
+        assert spawns["Zone 0"] == scale * spawns["Zone 1"]
+
+    def test_data_is_reproducible(self):
+        """Test that the same seed generates the same data."""
+        assert bench.make_data(1, seed=3) == bench.make_data(1, seed=3)
+        assert bench.make_data(1, seed=3) != bench.make_data(1, seed=4)
+
+
+class TestBenchmarks:
+    """Tests for running and comparing benchmarks."""
+
+    def test_run_saves_results(self, bench_dir):
+        """Test a run of the whole suite on a small map."""
+        report = bench.run(scale=1, repeats=1, map_size=256)
+        assert set(report["results"]) == {
+            "annotate_map",
+            "blend_map",
+            "drop_shadow",
+            "drop_shadow_radial",
+            "legend_draw",
+            "get_zone_marks",
+            "check_spawn_points",
+        }
+        assert all(result["min"] > 0 for result in report["results"].values())
+        assert report["meta"]["scale"] == 1
+        saved = list((bench_dir / "results").glob("1x-*.json"))
+        assert len(saved) == 1
+        with open(saved[0], "rt", encoding="utf-8") as fp:
+            assert json.load(fp) == report
+
+    def test_run_compares_with_baseline(self, bench_dir):
+        """Test that a run is compared with the baseline of its scale."""
+        bench.run(
+            scale=1, repeats=1, only="get_zone_marks", baseline=True, map_size=256
+        )
+        assert (bench_dir / "baseline-1x.json").exists()
+        # Make the baseline unreachably fast
+        write_results(bench_dir / "baseline-1x.json", get_zone_marks=1e-12)
+        regressions = bench.run(scale=1, repeats=1, only="get_zone_marks", map_size=256)
+        assert list(regressions) == ["get_zone_marks"]
+
+    def test_compare_flags_regressions(self, tmp_path):
+        """Test that only the benchmarks slower than the threshold are flagged."""
+        old = write_results(tmp_path / "old.json", fast=1.0, slow=1.0, same=1.0)
+        new = write_results(
+            tmp_path / "new.json", fast=0.5, slow=1.5, same=1.05, extra=1.0
+        )
+        regressions = bench.compare(old, new, threshold=0.1)
+        assert regressions == {"slow": pytest.approx(0.5)}
+        assert bench.compare(old, new, threshold=0.6) == {}
+
+    def test_compare_exits_from_cli(self, tmp_path, monkeypatch, capsys):
+        """Test that the CLI exits with an error status on regressions."""
+        monkeypatch.setattr(bench, "_CLI", True)
+        old = write_results(tmp_path / "old.json", blend=1.0)
+        new = write_results(tmp_path / "new.json", blend=2.0)
+        with pytest.raises(SystemExit) as exc:
+            bench.compare(old, new)
+        assert exc.value.code == 1
+        assert "REGRESSION" in capsys.readouterr().out
+        bench.compare(old, old)
+
+    def test_compare_different_scales(self, tmp_path):
+        """Test that results at different scales aren't compared."""
+        old = write_results(tmp_path / "old.json", scale=1, blend=1.0)
+        new = write_results(tmp_path / "new.json", scale=10, blend=1.0)
+        with pytest.raises(ValueError, match="different scales"):
+            bench.compare(old, new)
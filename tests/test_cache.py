@@ -0,0 +1,445 @@
+"""Tests for the on-disk caches."""
+
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from cache import (
+    BackupCache, BuildCache, LegendCache, ResponseCache, Snapshot, file_hash, fingerprint
+)
+
+
+class TestBuildCache:
+    """Tests for BuildCache and fingerprints."""
+
+    def test_fingerprint_is_order_independent(self):
+        """Test that dict key order doesn't change a fingerprint."""
+        assert fingerprint({"a": 1, "b": [1, 2]}) == fingerprint({"b": [1, 2], "a": 1})
+        assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+
+    def test_file_hash(self, temp_dir):
+        """Test hashing a file's content."""
+        path = temp_dir / "file.bin"
+        path.write_bytes(b"abc")
+        assert file_hash(path).startswith("ba7816bf")
+
+    def test_record_and_reload(self, temp_dir):
+        """Test that recorded fingerprints survive a reload."""
+        cache = BuildCache(temp_dir / "cache" / "builds.json")
+        cache.record("annotate", "Zone", "abc")
+        cache.save()
+
+        reloaded = BuildCache(temp_dir / "cache" / "builds.json")
+
+        assert reloaded.is_fresh("annotate", "Zone", "abc")
+        assert not reloaded.is_fresh("annotate", "Zone", "def")
+        assert not reloaded.is_fresh("blend", "Zone", "abc")
+
+    def test_corrupted_manifest_is_ignored(self, temp_dir):
+        """Test that an unreadable manifest behaves like an empty one."""
+        path = temp_dir / "builds.json"
+        path.write_text("{ not json")
+
+        assert not BuildCache(path).is_fresh("annotate", "Zone", "abc")
+
+
+class TestLegendCache:
+    """Tests for LegendCache."""
+
+    @staticmethod
+    def tile(color):
+        return Image.new("RGBA", (20, 10), color=color)
+
+    def test_memory_hit(self, temp_dir):
+        """Test that a stored tile is returned as is."""
+        cache = LegendCache(temp_dir / "legends")
+        tile = self.tile((255, 0, 0, 128))
+        cache.put("abc", tile, (5, 7))
+
+        assert cache.get("abc") == (tile, (5, 7))
+        assert cache.get("def") is None
+
+    def test_disk_hit(self, temp_dir):
+        """Test that tiles survive in a new cache instance."""
+        tile = self.tile((255, 0, 0, 128))
+        LegendCache(temp_dir / "legends").put("abc", tile, (5, 7))
+
+        cached, origin = LegendCache(temp_dir / "legends").get("abc")
+
+        assert origin == (5, 7)
+        assert cached.tobytes() == tile.tobytes()
+
+    def test_memory_lru_eviction(self, temp_dir):
+        """Test that the least recently used tiles are dropped from memory first."""
+        cache = LegendCache(temp_dir / "legends", max_entries=2)
+        cache.put("a", self.tile("red"), (0, 0))
+        cache.put("b", self.tile("green"), (0, 0))
+        cache.get("a")
+        cache.put("c", self.tile("blue"), (0, 0))
+
+        assert list(cache._entries) == ["a", "c"]
+
+    def test_disk_lru_eviction(self, temp_dir):
+        """Test that the least recently used files are removed."""
+        import os
+
+        cache = LegendCache(temp_dir / "legends", max_files=2)
+        cache.put("a", self.tile("red"), (0, 0))
+        cache.put("b", self.tile("green"), (0, 0))
+        # Make "b" the least recently used file
+        os.utime(temp_dir / "legends" / "b.png", ns=(1, 1))
+        cache.put("c", self.tile("blue"), (0, 0))
+
+        assert sorted(p.stem for p in (temp_dir / "legends").glob("*.png")) == [
+            "a",
+            "c",
+        ]
+
+    @pytest.mark.parametrize("content", [b"not a png", None])
+    def test_unreadable_file_is_a_miss(self, temp_dir, content):
+        """Test that a corrupted or incomplete file is ignored."""
+        directory = temp_dir / "legends"
+        directory.mkdir()
+        if content is None:
+            Image.new("RGBA", (2, 2)).save(directory / "abc.png")  # no origin
+        else:
+            (directory / "abc.png").write_bytes(content)
+
+        assert LegendCache(directory).get("abc") is None
+
+
+class TestCachedLegends:
+    """Tests for the legend cache in MapAnnotator."""
+
+    def test_legend_reused_across_runs(self, annotator_workspace, monkeypatch):
+        """Test that a re-run draws the same map without rendering legends."""
+        from annotate import MapAnnotator
+        from helpers import Legend
+
+        first = MapAnnotator().annotate_map("Test Zone", show=False)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("legend rendered again")
+
+        monkeypatch.setattr(Legend, "render", fail)
+        second = MapAnnotator().annotate_map("Test Zone", show=False)
+
+        assert second.tobytes() == first.tobytes()
+
+    def test_legend_key_follows_inputs(self, annotator_workspace):
+        """Test that legends are keyed by marks, rows, position and style."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        marks = {"Mark A": "A1", "Mark S": "S"}
+        key = annotator._legend_fingerprint((512, 512), marks, 2, (10, 10))
+
+        assert key == annotator._legend_fingerprint((512, 512), dict(marks), 2, (10, 10))
+        assert key != annotator._legend_fingerprint((512, 512), marks, 3, (10, 10))
+        assert key != annotator._legend_fingerprint((512, 512), marks, 2, (10, 20))
+        assert key != annotator._legend_fingerprint(
+            (512, 512), {"Mark A": "A1", "Mark S": "SS"}, 2, (10, 10)
+        )
+        annotator._config["legend"]["font_size"] += 1
+        assert key != annotator._legend_fingerprint((512, 512), marks, 2, (10, 10))
+
+    def test_legend_key_follows_renderer_version(self, annotator_workspace, monkeypatch):
+        """Test that tiles drawn by an older Legend implementation aren't reused."""
+        from annotate import MapAnnotator
+        from helpers import Legend
+
+        annotator = MapAnnotator()
+        marks = {"Mark A": "A1"}
+        key = annotator._legend_fingerprint((512, 512), marks, 2, (10, 10))
+        monkeypatch.setattr(Legend, "VERSION", Legend.VERSION + 1)
+        assert key != annotator._legend_fingerprint((512, 512), marks, 2, (10, 10))
+
+
+class TestSnapshot:
+    """Tests for Snapshot."""
+
+    @pytest.fixture
+    def source(self, temp_dir):
+        path = temp_dir / "source.txt"
+        path.write_text("one")
+        return path
+
+    @staticmethod
+    def loader(path):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return {"content": path.read_text()}
+
+        return build, calls
+
+    def test_reused_until_source_changes(self, temp_dir, source):
+        """Test that the data is only rebuilt when a source's content changes."""
+        import os
+
+        build, calls = self.loader(source)
+        snapshot = Snapshot(temp_dir / "cache" / "data.pickle", [source])
+
+        assert snapshot.load(build) == {"content": "one"}
+        assert snapshot.load(build) == {"content": "one"}
+        assert len(calls) == 1
+
+        # Same content, new mtime: checked by hash, not rebuilt
+        os.utime(source, ns=(1, 1))
+        assert snapshot.load(build) == {"content": "one"}
+        assert len(calls) == 1
+
+        source.write_text("two")
+        os.utime(source, ns=(2, 2))
+        assert snapshot.load(build) == {"content": "two"}
+        assert len(calls) == 2
+
+    def test_missing_source_is_built(self, temp_dir):
+        """Test that a missing source goes through build, which reports it."""
+
+        def build():
+            raise FileNotFoundError("no source")
+
+        snapshot = Snapshot(temp_dir / "data.pickle", [temp_dir / "missing"])
+        with pytest.raises(FileNotFoundError, match="no source"):
+            snapshot.load(build)
+
+    @pytest.mark.parametrize("content", [b"garbage", b""])
+    def test_unreadable_snapshot_is_rebuilt(self, temp_dir, source, content):
+        """Test that a corrupted snapshot file is replaced."""
+        path = temp_dir / "data.pickle"
+        path.write_bytes(content)
+        build, calls = self.loader(source)
+
+        assert Snapshot(path, [source]).load(build) == {"content": "one"}
+        assert Snapshot(path, [source]).load(build) == {"content": "one"}
+        assert len(calls) == 1
+
+    def test_other_sources_are_rebuilt(self, temp_dir, source):
+        """Test that a snapshot of different sources isn't used."""
+        other = temp_dir / "other.txt"
+        other.write_text("other")
+        path = temp_dir / "data.pickle"
+        build, calls = self.loader(source)
+
+        Snapshot(path, [source]).load(build)
+        Snapshot(path, [source, other]).load(build)
+
+        assert len(calls) == 2
+
+
+
+class TestBackupCache:
+    """Tests for BackupCache."""
+
+    @pytest.fixture
+    def source(self, temp_dir):
+        path = temp_dir / "map.png"
+        Image.linear_gradient("L").resize((64, 32)).convert("RGBA").save(path)
+        return path
+
+    @staticmethod
+    def decoder(path):
+        calls = []
+
+        def decode():
+            calls.append(1)
+            with Image.open(path) as img:
+                return np.asarray(img.convert("RGBA"))
+
+        return decode, calls
+
+    def test_reused_until_source_changes(self, temp_dir, source):
+        """Test that a backup is only decoded again when its content changes."""
+        import os
+
+        decode, calls = self.decoder(source)
+        cache = BackupCache(temp_dir / "backups")
+
+        first = cache.load(source, decode)
+        again = BackupCache(temp_dir / "backups").load(source, decode)
+
+        assert len(calls) == 1
+        assert isinstance(again, np.memmap) and not again.flags.writeable
+        assert again.shape == (32, 64, 4)
+        assert (again == np.asarray(Image.open(source))).all()
+        assert (first == again).all()
+
+        # Same content, new mtime: checked by hash, not decoded
+        os.utime(source, ns=(1, 1))
+        assert (cache.load(source, decode) == again).all()
+        assert len(calls) == 1
+
+        Image.new("RGBA", (16, 16), "red").save(source)
+        os.utime(source, ns=(2, 2))
+        changed = BackupCache(temp_dir / "backups").load(source, decode)
+        assert len(calls) == 2
+        assert changed.shape == (16, 16, 4)
+        assert (changed == [255, 0, 0, 255]).all()
+
+    def test_truncated_entry_is_decoded(self, temp_dir, source):
+        """Test that a raw file that doesn't match its manifest entry is rebuilt."""
+        decode, calls = self.decoder(source)
+        BackupCache(temp_dir / "backups").load(source, decode)
+        raw = next((temp_dir / "backups").glob("*.rgba"))
+        raw.write_bytes(raw.read_bytes()[:100])
+
+        pixels = BackupCache(temp_dir / "backups").load(source, decode)
+
+        assert len(calls) == 2
+        assert (pixels == np.asarray(Image.open(source))).all()
+
+    def test_missing_source_is_decoded(self, temp_dir):
+        """Test that a missing source goes through decode, which reports it."""
+
+        def decode():
+            raise FileNotFoundError("no backup")
+
+        with pytest.raises(FileNotFoundError, match="no backup"):
+            BackupCache(temp_dir / "backups").load(temp_dir / "missing.dds", decode)
+
+
+
+class TestResponseCache:
+    """Tests for ResponseCache."""
+
+    def test_put_and_get(self, temp_dir):
+        """Test that a stored response is read back with its validators."""
+        cache = ResponseCache(temp_dir / "http")
+        cache.put("http://host/a", '{"x": 1}', {"ETag": '"abc"', "Last-Modified": "Mon"})
+
+        entry = ResponseCache(temp_dir / "http").get("http://host/a")
+
+        assert entry["body"] == '{"x": 1}'
+        assert cache.is_fresh(entry)
+        assert cache.validators(entry) == {"If-None-Match": '"abc"', "If-Modified-Since": "Mon"}
+        assert cache.get("http://host/b") is None
+
+    def test_expiry_and_touch(self, temp_dir):
+        """Test that entries expire after the ttl and are fresh again once touched."""
+        cache = ResponseCache(temp_dir / "http", ttl=60)
+        entry = cache.put("http://host/a", "body", {})
+        entry["stored"] -= 120
+
+        assert not cache.is_fresh(entry)
+        assert cache.validators(entry) == {}
+        assert cache.is_fresh(cache.touch("http://host/a", entry))
+        assert cache.is_fresh(cache.get("http://host/a"))
+
+
+class TestCachedBackups:
+    """Tests for MapAnnotator reading backups from the backup cache."""
+
+    def test_backups_are_decoded_once(self, annotator_workspace, monkeypatch):
+        """Test that later runs map the decoded backup instead of decoding it."""
+        from annotate import MapAnnotator
+
+        calls = []
+        decode = MapAnnotator._decode_backup
+        monkeypatch.setattr(
+            MapAnnotator, "_decode_backup", lambda self, name: calls.append(name) or decode(self, name)
+        )
+
+        first = np.asarray(MapAnnotator().annotate_map("Test Zone", show=False))
+        second = np.asarray(MapAnnotator().annotate_map("Test Zone", show=False))
+        MapAnnotator().blend_map("Test Zone", show=False)
+
+        assert calls == ["Test Zone"]
+        assert (first == second).all()
+
+    def test_same_output_without_cache(self, annotator_workspace):
+        """Test that cached backups render the same maps as decoded ones."""
+        from annotate import MapAnnotator
+
+        cached = MapAnnotator()
+        uncached = MapAnnotator()
+        uncached._backup_cache = None
+
+        for zone in cached._zones:
+            cached.annotate_map(zone, show=False)  # fills the cache
+            for command in ("annotate_map", "blend_map"):
+                expected = np.asarray(getattr(uncached, command)(zone, show=False))
+                result = np.asarray(getattr(cached, command)(zone, show=False))
+                assert (result == expected).all()
+    """Tests for incremental annotate_all/blend_all runs."""
+
+    def test_unchanged_zones_are_skipped(self, annotator_workspace):
+        """Test that a second run skips everything."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        first = annotator.annotate_all()
+        second = MapAnnotator().annotate_all()
+
+        assert {r.status for r in first.values()} == {"ok"}
+        assert {r.status for r in second.values()} == {"skipped"}
+
+    def test_marks_change_rebuilds_one_zone(self, annotator_workspace):
+        """Test that editing a mark only rebuilds its zone, and dry_run only lists it."""
+        from annotate import MapAnnotator
+
+        MapAnnotator().annotate_all()
+        marks_file = annotator_workspace / "data" / "marks.json"
+        marks = json.loads(marks_file.read_text(encoding="utf-8"))
+        marks[-1]["spawns"].append([4.0, 4.0])
+        marks_file.write_text(json.dumps(marks), encoding="utf-8")
+
+        annotator = MapAnnotator()
+        assert annotator.annotate_all(dry_run=True) == ["Second Zone"]
+        report = annotator.annotate_all()
+
+        assert report["Second Zone"].status == "ok"
+        assert report["Test Zone"].status == "skipped"
+
+    def test_style_change_and_force_rebuild_all(self, annotator_workspace):
+        """Test that a global style change or force=True rebuilds every zone."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        annotator.annotate_all()
+        assert set(annotator.annotate_all(force=True, dry_run=True)) == set(annotator._zones)
+
+        annotator._config["colors"]["S"] = "green"
+
+        assert set(annotator.annotate_all(dry_run=True)) == set(annotator._zones)
+
+    def test_missing_output_is_rebuilt(self, annotator_workspace):
+        """Test that deleting an output makes its zone stale again."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        annotator.annotate_all()
+        annotator._get_path("Test Zone", project=True, ext="png").unlink()
+
+        assert annotator.annotate_all(dry_run=True) == ["Test Zone"]
+
+    def test_failed_zone_is_retried(self, annotator_workspace):
+        """Test that a zone which failed is rebuilt on the next run."""
+        from annotate import MapAnnotator
+
+        mask = annotator_workspace / "project" / "Blended" / "masks" / "sb_mask.png"
+        content = mask.read_bytes()
+        mask.unlink()
+        annotator = MapAnnotator()
+        assert annotator.blend_all()["Second Zone"].status == "failed"
+        mask.write_bytes(content)
+
+        annotator = MapAnnotator()
+        assert annotator.blend_all(dry_run=True) == ["Second Zone"]
+        assert annotator.blend_all()["Second Zone"].status == "ok"
+
+    def test_fingerprint_bug_is_raised(self, annotator_workspace, monkeypatch):
+        """Test that only missing inputs make a zone stale, not an error in fingerprinting."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        annotator.annotate_all()
+        annotator._get_path("Test Zone", backup=True).unlink()
+        assert annotator.annotate_all(dry_run=True) == ["Test Zone"]
+
+        monkeypatch.setattr(annotator, "_annotate_fingerprint", lambda name: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            annotator.annotate_all(dry_run=True)
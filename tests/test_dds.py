@@ -0,0 +1,249 @@
+"""Tests for the native DDS/BC1 encoder."""
+
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from dds import MagickBatch, encode_bc1, save_dds
+
+
+def psnr(reference, other):
+    """Peak signal-to-noise ratio over the RGB channels, in dB"""
+    a = np.asarray(reference)[:, :, :3].astype(float)
+    b = np.asarray(other)[:, :, :3].astype(float)
+    mse = ((a - b) ** 2).mean()
+    return float("inf") if mse == 0 else 10 * np.log10(255**2 / mse)
+
+
+@pytest.fixture
+def map_like_image():
+    """Smooth parchment-like background with a few flat-coloured markers and text."""
+    size = (512, 512)
+    img = Image.merge(
+        "RGB",
+        [
+            Image.linear_gradient("L").resize(size),
+            Image.radial_gradient("L").resize(size),
+            Image.effect_noise(size, 20),
+        ],
+    ).filter(ImageFilter.GaussianBlur(2))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([100, 100, 140, 140], fill="orange")
+    draw.pieslice([200, 200, 240, 240], 180, 270, fill="royalblue")
+    draw.text((300, 300), "Test Mark (A)", fill="white")
+    return img.convert("RGBA")
+
+
+class TestSaveDds:
+    """Tests for save_dds."""
+
+    def test_roundtrip_quality(self, temp_dir, map_like_image):
+        """Test that the decoded file is close to the source image."""
+        path = temp_dir / "map.dds"
+        save_dds(map_like_image, path)
+
+        decoded = Image.open(path)
+
+        assert decoded.size == map_like_image.size
+        assert psnr(map_like_image, decoded) > 35
+
+    def test_file_layout(self, temp_dir, map_like_image):
+        """Test header and payload size of a BC1 file without mipmaps."""
+        path = temp_dir / "map.dds"
+        save_dds(map_like_image, path)
+
+        data = path.read_bytes()
+
+        assert data[:4] == b"DDS "
+        assert data[84:88] == b"DXT1"
+        assert len(data) == 128 + (512 // 4) ** 2 * 8
+
+    def test_mipmaps(self, temp_dir, map_like_image):
+        """Test that mipmaps down to 1x1 are appended and announced in the header."""
+        path = temp_dir / "map.dds"
+        save_dds(map_like_image, path, mipmaps=True)
+
+        data = path.read_bytes()
+        mipmap_count = int.from_bytes(data[28:32], "little")
+        expected = sum(max(1, (512 >> i) // 4) ** 2 * 8 for i in range(10))
+
+        assert mipmap_count == 10
+        assert len(data) == 128 + expected
+        assert Image.open(path).size == (512, 512)
+
+    def test_unaligned_size(self, temp_dir):
+        """Test that sizes which are not a multiple of 4 are padded."""
+        img = Image.new("RGB", (10, 6), "red")
+        path = temp_dir / "small.dds"
+        save_dds(img, path)
+
+        decoded = Image.open(path)
+
+        assert decoded.size == (10, 6)
+        assert (np.asarray(decoded)[:, :, :3] == (255, 0, 0)).all()
+
+    def test_solid_blocks_are_exact(self):
+        """Test that a colour representable in 5:6:5 survives encoding."""
+        rgb = np.zeros((4, 4, 3), dtype=np.uint8)
+        rgb[...] = (255, 0, 0)
+
+        block = encode_bc1(rgb)
+
+        assert len(block) == 8
+        assert int.from_bytes(block[:2], "little") == 0xF800
+
+    def test_close_to_reference(self, temp_dir):
+        """Test that the native encoder is on par with a committed reference DXT1 file.
+
+        tests/data/dxt1_reference.dds is dxt1_source.png encoded by Pillow's BC1 encoder;
+        `magick convert -define dds:compression=dxt1 -define dds:mipmaps=0` gives an
+        ImageMagick reference to replace it with."""
+        data = Path(__file__).with_name("data")
+        source = Image.open(data / "dxt1_source.png").convert("RGBA")
+        reference = Image.open(data / "dxt1_reference.dds")
+        native = temp_dir / "native.dds"
+        save_dds(source, native)
+
+        assert psnr(reference, Image.open(native)) > 35
+        assert psnr(source, Image.open(native)) > psnr(source, reference) - 0.5
+
+    @pytest.mark.skipif(shutil.which("magick") is None, reason="ImageMagick not installed")
+    def test_close_to_imagemagick(self, temp_dir, map_like_image):
+        """Test that the native encoder is on par with ImageMagick's dxt1 output."""
+        src = temp_dir / "map.bmp"
+        reference = temp_dir / "magick.dds"
+        native = temp_dir / "native.dds"
+        map_like_image.save(src, format="bmp")
+        subprocess.run(
+            ["magick", "convert", "-define", "dds:compression=dxt1", "-define",
+             "dds:mipmaps=0", str(src), str(reference)],
+            check=True,
+        )
+        save_dds(map_like_image, native)
+
+        assert psnr(Image.open(reference), Image.open(native)) > 35
+
+
+class TestAnnotatorSave:
+    """Tests for saving annotated maps without ImageMagick."""
+
+    def test_annotate_map_save(self, annotator_workspace):
+        """Test that annotate_map(save=True) writes the dds and its previews."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        img = annotator.annotate_map("Test Zone", save=True, show=False)
+
+        dds = annotator._get_path("Test Zone")
+        preview = annotator._get_path("Test Zone", project=True, ext="png")
+        assert dds.exists()
+        assert annotator._get_path("Test Zone", project=True).exists()
+        assert not dds.with_suffix(".bmp").exists()
+        assert psnr(img, Image.open(dds)) > 30
+        assert (np.asarray(Image.open(preview)) == np.asarray(img)).all()
+
+
+FAKE_MAGICK = [sys.executable, str(Path(__file__).with_name("fake_magick.py"))]
+
+
+class TestMagickBatch:
+    """Tests for MagickBatch, with a stand-in for the magick executable."""
+
+    def test_batch_conversion(self, temp_dir, map_like_image):
+        """Test that every queued image ends up at its destination."""
+        done = {}
+        images = [map_like_image.rotate(90 * i) for i in range(3)]
+
+        with MagickBatch(FAKE_MAGICK, done.__setitem__, batch_size=2) as batch:
+            for i, img in enumerate(images):
+                batch.add(f"zone{i}", img, temp_dir / f"zone{i}.dds")
+
+        assert done == {"zone0": None, "zone1": None, "zone2": None}
+        for i, img in enumerate(images):
+            assert psnr(img, Image.open(temp_dir / f"zone{i}.dds")) > 35
+        assert not list(temp_dir.glob("huntmaps-*"))
+
+    def test_failed_frame_points_to_zone(self, temp_dir, map_like_image, monkeypatch):
+        """Test that a frame ImageMagick couldn't write is reported for its own zone."""
+        monkeypatch.setenv("FAKE_MAGICK_SKIP_WIDTH", "256")
+        done = {}
+        images = [map_like_image, map_like_image.resize((256, 256)), map_like_image]
+
+        with MagickBatch(FAKE_MAGICK, done.__setitem__) as batch:
+            for i, img in enumerate(images):
+                batch.add(f"zone{i}", img, temp_dir / f"zone{i}.dds")
+
+        assert done["zone0"] is None and done["zone2"] is None
+        assert "zone1" in done["zone1"]
+        assert "unable to write frame 1" in done["zone1"]
+        assert not (temp_dir / "zone1.dds").exists()
+
+    def test_verbose_stderr_doesnt_block(self, temp_dir, map_like_image, monkeypatch):
+        """Test that warnings larger than a pipe buffer don't stall the batch."""
+        monkeypatch.setenv("FAKE_MAGICK_WARNINGS", str(2**20))
+        done = {}
+
+        with MagickBatch(FAKE_MAGICK, done.__setitem__) as batch:
+            for i in range(3):
+                batch.add(f"zone{i}", map_like_image, temp_dir / f"zone{i}.dds")
+
+        assert done == {"zone0": None, "zone1": None, "zone2": None}
+
+    @pytest.mark.parametrize("workers", [None, 2])
+    def test_annotate_all_with_batch(self, annotator_workspace, monkeypatch, workers):
+        """Test that annotate_all converts and publishes maps through a batch."""
+        from annotate import MapAnnotator
+
+        monkeypatch.setenv("FAKE_MAGICK_SKIP_WIDTH", "256")
+        annotator = MapAnnotator()
+        annotator._dds_encoder = "imagemagick"
+        annotator._magickpath = FAKE_MAGICK
+
+        report = annotator.annotate_all(workers=workers)
+
+        assert report["Test Zone"].status == "ok"
+        assert annotator._get_path("Test Zone", project=True).exists()
+        assert report["Second Zone"].status == "failed"
+        assert "Second Zone" in report["Second Zone"].error
+        assert not annotator._get_path("Second Zone", project=True).exists()
+        assert annotator._get_path("Second Zone", project=True, ext="png").exists()
+
+    def test_shared_map_released_when_batch_fails(self, annotator_workspace):
+        """Test that the shared memory of a map is released even if queuing it fails."""
+        from annotate import MapAnnotator
+        from parallel import SharedArray, ZoneReport
+
+        class BrokenBatch:
+            def add(self, *args):
+                raise BrokenPipeError("magick died")
+
+        shared = SharedArray.create(np.zeros((4, 4, 4), dtype=np.uint8))
+        spec = shared.spec
+        finish = MapAnnotator()._finish_shared(BrokenBatch())
+
+        with pytest.raises(BrokenPipeError):
+            finish("Test Zone", ZoneReport("ok"), shared)
+        with pytest.raises(FileNotFoundError):
+            SharedArray.attach(spec)
+
+    @pytest.mark.parametrize("workers", [None, 2])
+    def test_build_all_with_batch(self, annotator_workspace, monkeypatch, workers):
+        """Test that build_all converts the annotated maps through a batch."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        annotator._dds_encoder = "imagemagick"
+        annotator._magickpath = FAKE_MAGICK
+
+        report = annotator.build_all(workers=workers)
+
+        assert all(r.status == "ok" for r in report.values())
+        for zone in annotator._zones:
+            preview = Image.open(annotator._get_path(zone, project=True, ext="png"))
+            assert psnr(preview, Image.open(annotator._get_path(zone, project=True))) > 30
+            assert (annotator_workspace / "project" / "Blended" / f"{zone}.png").exists()
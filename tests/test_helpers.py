@@ -7,8 +7,9 @@ from PIL import Image
 import responses
 
 from helpers import (
-    Position, MarksHelper, ZoneApi,
-    m2c, c2m, compute_columns, drop_shadow, Legend
+    Position, PositionArray, MarksHelper, MarksRegistry, ZoneApi,
+    m2c, c2m, close_pairs, compute_columns, drop_shadow, band_rows, Legend,
+    draw_label, load_font, text_bbox, blend_multiply, TokenBucket
 )
 
 
@@ -162,6 +163,76 @@ class TestPosition:
         with pytest.raises(TypeError):
             result = pos - "invalid"
 
+    def test_position_is_slotted(self):
+        """Test that Position has no per-instance dict."""
+        pos = Position(10, 20)
+        assert not hasattr(pos, "__dict__")
+        with pytest.raises(AttributeError):
+            pos.z = 30
+
+    def test_position_unpacking(self):
+        """Test that Position unpacks as x, y and converts like a 2-tuple."""
+        import numpy as np
+
+        x, y = Position(10.5, 20)
+        assert (x, y) == (10.5, 20)
+        assert len(Position(1, 2)) == 2
+        assert np.asarray(Position(1, 2)).tolist() == [1, 2]
+
+
+class TestPositionArray:
+    """Tests for PositionArray class."""
+
+    def test_creation(self):
+        """Test PositionArray creation from points."""
+        points = PositionArray([(10, 20), Position(1.5, 2), [3, 4]])
+        assert len(points) == 3
+        assert points.xy.shape == (3, 2)
+        assert points.x.tolist() == [10, 1.5, 3]
+        assert points.y.tolist() == [20, 2, 4]
+
+    def test_empty(self):
+        """Test that an empty PositionArray still has 2 columns."""
+        points = PositionArray([])
+        assert points.xy.shape == (0, 2)
+        assert list(points + Position(1, 1)) == []
+
+    def test_indexing(self):
+        """Test that points are returned as Positions."""
+        points = PositionArray([(10, 20), (30, 40)])
+        assert isinstance(points[1], Position)
+        assert list(points[1]) == [30, 40]
+        assert points[:1].tolist() == [(10, 20)]
+        assert [list(point) for point in points] == [[10, 20], [30, 40]]
+
+    def test_arithmetic(self):
+        """Test operations with arrays, Position-likes and scalars."""
+        points = PositionArray([(10, 20), (30, 40)])
+        assert (points + Position(1, 2)).tolist() == [(11, 22), (31, 42)]
+        assert (Position(1, 2) + points).tolist() == [(11, 22), (31, 42)]
+        assert (points - (10, 20)).tolist() == [(0, 0), (20, 20)]
+        assert (Position(30, 40) - points).tolist() == [(20, 20), (0, 0)]
+        assert (2 * points).tolist() == [(20, 40), (60, 80)]
+        assert (points * points).tolist() == [(100, 400), (900, 1600)]
+        assert (-points).tolist() == [(-10, -20), (-30, -40)]
+
+    def test_floor(self):
+        """Test rounding the points down to pixels."""
+        points = PositionArray([(10.5, -0.25)])
+        assert points.floor().tolist() == [(10, -1)]
+
+    @pytest.mark.parametrize("other", ["invalid", (1, 2, 3), [None, None]])
+    def test_invalid_operand(self, other):
+        """Test that operands which aren't Position-likes or scalars are refused."""
+        points = PositionArray([(10, 20)])
+        with pytest.raises(TypeError):
+            points + other
+
+    def test_invalid_points(self):
+        """Test that non numeric coordinates are refused."""
+        with pytest.raises(TypeError):
+            PositionArray([("a", "b")])
+
 
 class TestMarksHelper:
     """Tests for MarksHelper class."""
@@ -216,6 +287,96 @@ class TestMarksHelper:
         assert len(data) == 3
 
 
+class TestMarksRegistry:
+    """Tests for the zone index built by MarksHelper.load_marks."""
+
+    @pytest.fixture
+    def marks_file(self, temp_dir, sample_marks_data):
+        data = sample_marks_data + [
+            {
+                "name": "Other Mark A",
+                "rank": "A",
+                "zone": "Test Zone",
+                "spawns": [[10.0, 20.0]],
+            },
+            {
+                "name": "Far Mark",
+                "rank": "B",
+                "zone": "Other Zone",
+                "spawns": [[1.0, 1.0]],
+            },
+        ]
+        marks_file = temp_dir / "marks.json"
+        with open(marks_file, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        return marks_file
+
+    def test_behaves_as_list(self, marks_file):
+        """The registry keeps the list interface of the previous return value."""
+        Mark, marks = MarksHelper.load_marks(str(marks_file))
+
+        assert isinstance(marks, MarksRegistry)
+        assert len(marks) == 5
+        assert marks[0].name == "Test Mark A"
+        assert [m.name for m in marks][-1] == "Far Mark"
+        assert len(json.loads(MarksHelper.dump_marks(marks, "str"))) == 5
+
+    def test_zone_index(self, marks_file):
+        """Marks are grouped per zone, with A/B ranks remapped by name."""
+        _, marks = MarksHelper.load_marks(str(marks_file))
+
+        zone = marks.zone("Test Zone")
+        assert set(zone.marks) == {
+            "Test Mark A", "Test Mark B", "Test Mark S", "Other Mark A"
+        }
+        assert zone.marks["Test Mark A"] == ("A", ((10.0, 20.0), (15.0, 25.0)))
+        assert zone.remapped["Other Mark A"][0] == "A1"
+        assert zone.remapped["Test Mark A"][0] == "A2"
+        assert zone.remapped["Test Mark B"][0] == "B1"
+        assert zone.remapped["Test Mark S"][0] == "S"
+        assert set(marks.zone("Other Zone").marks) == {"Far Mark"}
+
+    def test_unknown_zone(self, marks_file):
+        """A zone without marks gets an empty index."""
+        _, marks = MarksHelper.load_marks(str(marks_file))
+
+        assert dict(marks.zone("Nowhere").marks) == {}
+        assert marks.markers("Nowhere", 100) == ()
+
+    def test_markers_precomputed(self, marks_file):
+        """Marker pixel positions are computed once for known scales, then kept."""
+        _, marks = MarksHelper.load_marks(str(marks_file), {"Test Zone": 100})
+
+        markers = marks.zone("Test Zone").markers
+        assert markers is marks.markers("Test Zone", 100)
+        positions = dict(markers)
+        # The shared spawn point holds both A marks
+        assert dict(positions[(m2c(10.0, 100), m2c(20.0, 100))]) == {
+            "Test Mark A": "A2",
+            "Other Mark A": "A1",
+        }
+        assert dict(positions[(m2c(50.0, 100), m2c(60.0, 100))]) == {
+            "Test Mark S": "S"
+        }
+        assert len(markers) == 4
+
+    def test_markers_other_scale(self, marks_file):
+        """Markers are recomputed for a scale other than the indexed one."""
+        _, marks = MarksHelper.load_marks(str(marks_file), {"Test Zone": 100})
+
+        markers = dict(marks.markers("Test Zone", 200))
+        assert (m2c(30.0, 200), m2c(40.0, 200)) in markers
+        assert marks.zone("Other Zone").markers is None
+        assert len(marks.markers("Other Zone", 100)) == 1
+
+    def test_read_only(self, marks_file):
+        """The index can't be modified by callers."""
+        _, marks = MarksHelper.load_marks(str(marks_file))
+
+        with pytest.raises(TypeError):
+            marks.zone("Test Zone").marks["New"] = ("A", ())
+
+
 class TestZoneApi:
     """Tests for ZoneApi class."""
 
@@ -369,6 +530,185 @@ class TestZoneApi:
         assert zones["Test Zone"]["extra_key"] == "value"
 
 
+
+class TestConcurrentZoneApi:
+    """Tests for the concurrent fetching of ZoneApi, against the local xivapi stand-in."""
+
+    ZONES = {
+        f"Zone {i}": {"region": f"Region {i % 3}", "scale": 100 + i, "filename": f"z{i}f100"}
+        for i in range(12)
+    }
+
+    def test_fetches_all_zones_in_order(self):
+        """Test that concurrent results match the served data, in the order of zones."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES) as server:
+            api = ZoneApi(list(reversed(self.ZONES)), base_url=server.url, rate=None)
+            result = api.get_all_zone_info()
+
+        assert list(result) == list(reversed(self.ZONES))
+        assert result == self.ZONES
+
+    def test_requests_are_concurrent(self):
+        """Test that zones are fetched in parallel on a pooled session."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES, latency=0.1) as server:
+            api = ZoneApi(self.ZONES, base_url=server.url, workers=12, rate=None)
+            api.get_all_zone_info()
+
+        # Requests overlap; no wall clock bound, which is flaky on loaded CI runners
+        assert server.max_concurrency > 4
+
+    def test_rate_limit(self):
+        """Test that requests are spaced by the token bucket."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES) as server:
+            api = ZoneApi(self.ZONES, base_url=server.url, workers=6, rate=40, burst=4)
+            api.get_all_zone_info()
+
+        times = sorted(t for _, t in server.requests)
+        assert len(times) == 24
+        # 4 requests of burst then 40/s: the 24th can't come before 20/40 s
+        assert times[-1] - times[0] >= 0.45
+
+    def test_transient_errors_are_retried(self):
+        """Test that 429 and 5xx answers are retried with backoff."""
+        from tests.xivapi_server import XivApiServer
+
+        failures = {"/search": [503, 429, 502], "/placename/1": [500]}
+        with XivApiServer(self.ZONES, failures=failures) as server:
+            api = ZoneApi(self.ZONES, base_url=server.url, rate=None, backoff=0.01)
+            result = api.get_all_zone_info()
+
+        assert result == self.ZONES
+        assert len(server.requests) == 24 + 4
+
+    def test_retries_are_bounded(self):
+        """Test that a zone failing more than `retries` times reports its error."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES, failures={"/placename/3": [503] * 3}) as server:
+            api = ZoneApi(self.ZONES, base_url=server.url, rate=None, retries=2, backoff=0.01)
+            with pytest.raises(RuntimeError, match="'Zone 2': HTTP 503"):
+                api.get_all_zone_info()
+
+        assert sum(path == "/placename/3" for path, _ in server.requests) == 3
+
+    def test_connection_errors_are_retried(self):
+        """Test that a server that can't be reached is reported after the retries."""
+        import socket
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        api = ZoneApi(["Zone 0"], base_url=f"http://127.0.0.1:{port}", retries=1, backoff=0.01)
+
+        with pytest.raises(RuntimeError, match="Failed to connect"):
+            api.get_all_zone_info()
+
+    def test_token_bucket(self):
+        """Test that a bucket lets a burst through then waits for the rate."""
+        import time
+
+        bucket = TokenBucket(rate=50, capacity=3)
+        start = time.perf_counter()
+        for _ in range(3):
+            bucket.acquire()
+        burst = time.perf_counter() - start
+        for _ in range(5):
+            bucket.acquire()
+
+        assert burst < 0.02
+        assert time.perf_counter() - start >= 5 / 50 - 0.01
+
+
+
+class TestZoneApiCache:
+    """Tests for the response cache and the incremental refresh of ZoneApi."""
+
+    ZONES = TestConcurrentZoneApi.ZONES
+
+    def api(self, temp_dir, server, ttl=3600, zones=None):
+        from cache import ResponseCache
+
+        api = ZoneApi(
+            list(zones or self.ZONES),
+            base_url=server.url,
+            rate=None,
+            cache=ResponseCache(temp_dir / "http", ttl=ttl),
+        )
+        api.cachename = str(temp_dir / "zone_info")
+        return api
+
+    def test_fresh_responses_are_reused(self, temp_dir):
+        """Test that a second crawl is served from the cache."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES) as server:
+            first = self.api(temp_dir, server).get_all_zone_info()
+            requests = len(server.requests)
+            second = self.api(temp_dir, server).get_all_zone_info()
+
+        assert requests == 24
+        assert len(server.requests) == 24
+        assert first == second == self.ZONES
+
+    def test_expired_responses_are_revalidated(self, temp_dir):
+        """Test that expired responses are revalidated with their ETag."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES) as server:
+            self.api(temp_dir, server, ttl=0).get_all_zone_info()
+            result = self.api(temp_dir, server, ttl=0).get_all_zone_info()
+
+        assert result == self.ZONES
+        assert len(server.not_modified) == 24
+
+    def test_refresh_fetches_missing_zones_only(self, temp_dir):
+        """Test that only the zones missing from the zone info file are fetched."""
+        from tests.xivapi_server import XivApiServer
+
+        known = dict(list(self.ZONES.items())[:10])
+        with XivApiServer(self.ZONES) as server:
+            api = self.api(temp_dir, server)
+            api.save_zone_info(known)
+            fetched = api.refresh_zone_info()
+
+        assert fetched == ["Zone 10", "Zone 11"]
+        assert len(server.requests) == 4
+        assert api.load_zone_info() == self.ZONES
+
+    def test_refresh_revalidates_stale_zones(self, temp_dir):
+        """Test that stale zones are revalidated even when their responses are fresh."""
+        from tests.xivapi_server import XivApiServer
+
+        with XivApiServer(self.ZONES) as server:
+            api = self.api(temp_dir, server)
+            api.refresh_zone_info()
+            server.requests.clear()
+
+            assert api.refresh_zone_info() == []
+            assert api.refresh_zone_info(stale=["Zone 3"]) == ["Zone 3"]
+            assert len(server.requests) == 2
+            assert len(server.not_modified) == 2
+
+            assert len(api.refresh_zone_info(full=True)) == 12
+
+        assert api.load_zone_info() == self.ZONES
+
+    def test_missing_zones_are_reported(self, temp_dir, sample_zone_info):
+        """Test that merging zone info for zones it doesn't have names them."""
+        api = ZoneApi([])
+        api.cachename = str(temp_dir / "zone_info")
+        api.save_zone_info(sample_zone_info)
+
+        with pytest.raises(KeyError, match="New Zone"):
+            api.load_zone_info({"Test Zone": {}, "New Zone": {}})
+
+
 class TestCoordinateConversion:
     """Tests for coordinate conversion functions."""
 
@@ -410,6 +750,22 @@ class TestCoordinateConversion:
         # Should be approximately equal (rounding may cause small difference)
         assert abs(back - original) < 0.1
 
+    @pytest.mark.parametrize("scale", [95, 100, 200, 400])
+    def test_vectorized_matches_scalar(self, scale):
+        """Test that converting a PositionArray gives the per-coordinate results."""
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        points = np.round(rng.uniform(1, 42, (500, 2)), 1).tolist()
+        pixels = m2c(PositionArray(points), scale)
+        assert pixels.tolist() == [(m2c(x, scale), m2c(y, scale)) for x, y in points]
+        assert all(isinstance(v, int) for v in pixels.tolist()[0])
+
+        coordinates = c2m(pixels, scale).tolist()
+        assert coordinates == [
+            (c2m(x, scale), c2m(y, scale)) for x, y in pixels.tolist()
+        ]
+
 
 class TestComputeColumns:
     """Tests for compute_columns function."""
@@ -439,6 +795,51 @@ class TestComputeColumns:
         assert cols == 3
 
 
+class TestClosePairs:
+    """Tests for close_pairs grid hash."""
+
+    @staticmethod
+    def brute_force(points, threshold, groups):
+        pairs = []
+        for i in range(len(points)):
+            for j in range(i + 1, len(points)):
+                dx = points[i][0] - points[j][0]
+                dy = points[i][1] - points[j][1]
+                if groups[i] == groups[j] and (dx * dx + dy * dy) ** 0.5 <= threshold:
+                    pairs.append([i, j])
+        return pairs
+
+    def test_close_pairs_basic(self):
+        """Test finding points closer than the threshold."""
+        points = [(1.0, 1.0), (1.3, 1.4), (5.0, 5.0), (1.0, 1.5)]
+        assert close_pairs(points, 0.5).tolist() == [[0, 1], [0, 3], [1, 3]]
+
+    def test_close_pairs_threshold_inclusive(self):
+        """Test that points exactly at the threshold are reported."""
+        assert close_pairs([(3.0, 3.0), (3.5, 3.0)], 0.5).tolist() == [[0, 1]]
+
+    def test_close_pairs_groups(self):
+        """Test that points of different groups are never paired."""
+        points = [(1.0, 1.0), (1.0, 1.0), (1.1, 1.0)]
+        assert close_pairs(points, 0.5, [0, 1, 1]).tolist() == [[1, 2]]
+
+    def test_close_pairs_empty(self):
+        """Test with fewer than 2 points."""
+        assert close_pairs([], 0.5).shape == (0, 2)
+        assert close_pairs([(1.0, 1.0)], 0.5).shape == (0, 2)
+
+    def test_close_pairs_matches_brute_force(self):
+        """Test against comparing all pairs, including across cell borders."""
+        import random
+
+        rng = random.Random(0)
+        points = [(round(rng.uniform(1, 42), 1), round(rng.uniform(1, 42), 1)) for _ in range(400)]
+        groups = [rng.randrange(3) for _ in points]
+        for threshold in (0.1, 0.5, 2.0):
+            expected = self.brute_force(points, threshold, groups)
+            assert close_pairs(points, threshold, groups).tolist() == expected
+
+
 class TestDropShadow:
     """Tests for drop_shadow function."""
 
@@ -490,6 +891,219 @@ class TestDropShadow:
         assert result.size == img.size
 
 
+    @staticmethod
+    def sparse_image(size, boxes, seed=0):
+        """Random pixels in `boxes`, transparent elsewhere but with random hidden colors"""
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        pixels = rng.integers(0, 256, (size[1], size[0], 4), dtype=np.uint8)
+        pixels[:, :, 3] = 0
+        for x0, y0, x1, y1 in boxes:
+            pixels[y0:y1, x0:x1, 3] = rng.integers(0, 256, (y1 - y0, x1 - x0))
+        return Image.fromarray(pixels)
+
+    @pytest.mark.parametrize("direction", [None, "radial"])
+    @pytest.mark.parametrize(
+        "boxes",
+        [
+            [(90, 60, 110, 80)],
+            [(0, 0, 10, 10), (185, 140, 200, 150)],
+            [(40, 2, 60, 6)],
+            [],
+        ],
+    )
+    def test_drop_shadow_matches_whole_image(self, boxes, direction):
+        """Processing the content bbox gives the same pixels as the whole image."""
+        from helpers import _cast_shadow, _shadow_offsets
+
+        img = self.sparse_image((200, 150), boxes)
+        for offset, iterations, color in [
+            (Position(3, 3), 7, "#737373"),
+            (Position(-2, 5), 1, (10, 20, 30, 128)),
+            (Position(0, 0), 0, "black"),
+        ]:
+            expected = _cast_shadow(
+                img, color, iterations, 1, _shadow_offsets(offset, direction)
+            )
+            result = drop_shadow(
+                img, offset, color, iterations, 1, direction, engine="pillow"
+            )
+            assert result.tobytes() == expected.tobytes()
+
+    @pytest.mark.parametrize("direction", [None, "radial"])
+    @pytest.mark.parametrize("iterations", [3, 7, 15])
+    def test_drop_shadow_alpha_engine_close_to_pillow(self, iterations, direction):
+        """The alpha engine approximates iterated BLUR passes within a few levels."""
+        import numpy as np
+        from PIL import ImageDraw
+
+        # Content away from the borders, which BLUR leaves unfiltered
+        img = Image.new("RGBA", (240, 200), color=(0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.ellipse([50, 60, 90, 100], fill=(255, 0, 0, 255))
+        draw.rectangle([120, 80, 180, 110], fill=(0, 0, 255, 200))
+        args = (img, Position(3, 3), "#737373", iterations, 1, direction)
+
+        expected = np.asarray(drop_shadow(*args, engine="pillow"), dtype=int)
+        result = np.asarray(drop_shadow(*args, engine="alpha"), dtype=int)
+
+        alpha_error = np.abs(result[:, :, 3] - expected[:, :, 3])
+        assert alpha_error.max() <= 8
+        assert alpha_error.mean() < 1
+        visible = expected[:, :, 3] > 0
+        assert np.abs(result - expected)[visible][:, :3].max() <= 8
+
+    @pytest.mark.parametrize("direction", [None, "radial"])
+    @pytest.mark.parametrize("iterations", [1, 7])
+    def test_drop_shadow_alpha_engine_borders(self, iterations, direction):
+        """Near the image borders, the alpha engine gives the pillow shadow."""
+        import numpy as np
+
+        from helpers import _shadow_margin, _shadow_offsets
+
+        img = self.sparse_image((120, 90), [(60, 30, 80, 50)])
+        # Opaque pixels on the borders, like a legend drawn against the map edge
+        for xy in [(119, 45), (0, 10), (60, 0), (30, 89), (119, 89)]:
+            img.putpixel(xy, (255, 255, 255, 255))
+        offset = Position(3, 3)
+        args = (img, offset, "#737373", iterations, 1, direction)
+
+        expected = np.asarray(drop_shadow(*args, engine="pillow"), dtype=int)
+        result = np.asarray(drop_shadow(*args, engine="alpha"), dtype=int)
+
+        margin = _shadow_margin(iterations, _shadow_offsets(offset, direction))
+        error = np.abs(result - expected)
+        border = np.ones(error.shape[:2], dtype=bool)
+        border[margin:-margin, margin:-margin] = False
+        assert error[border].max() == 0
+
+    @pytest.mark.parametrize("engine", ["alpha", "pillow"])
+    @pytest.mark.parametrize("direction", [None, "radial"])
+    def test_drop_shadow_in_bands(self, engine, direction):
+        """Processing bands of rows gives the shadow of the whole image."""
+        import numpy as np
+
+        img = self.sparse_image(
+            (200, 150), [(0, 0, 10, 10), (50, 30, 90, 70), (120, 64, 180, 90)]
+        )
+        args = (img, Position(3, 3), "#737373", 7, 1, direction, engine)
+        expected = np.asarray(drop_shadow(*args), dtype=int)
+        # About 5 rows per band, which are made as high as their 25 rows of context
+        result = np.asarray(drop_shadow(*args, max_bytes=32 * 200 * 5), dtype=int)
+
+        tolerance = 1 if engine == "alpha" else 0
+        assert np.abs(result - expected).max() <= tolerance
+
+    def test_band_rows(self):
+        """Test the rows of a band for a memory budget."""
+        assert band_rows((2048, 1024), 32, None) == 1024
+        assert band_rows((2048, 1024), 32, 2**20) == 16
+        assert band_rows((2048, 1024), 32, 10) == 1
+
+    def test_drop_shadow_alpha_engine_empty(self):
+        """A fully transparent image gets no shadow."""
+        img = Image.new("RGBA", (50, 40), color=(0, 0, 0, 0))
+        result = drop_shadow(img, Position(3, 3), "#737373", 7, 1, "radial")
+        assert result.getchannel("A").getbbox() is None
+
+    def test_drop_shadow_invalid_engine(self, sample_image):
+        """Test that an unknown engine is rejected."""
+        with pytest.raises(ValueError, match="shadow engine"):
+            drop_shadow(sample_image, Position(3, 3), "#000000", engine="gpu")
+
+
+class TestBlendMultiply:
+    """Tests for the fixed point blend kernel."""
+
+    @staticmethod
+    def float_blend(pixels, mask):
+        """The float computation blend_map used before the fixed point kernel"""
+        import numpy as np
+
+        blended = np.zeros(pixels.shape, dtype=pixels.dtype)
+        blended[:, :, :3] = pixels.astype(float)[:, :, :3] * mask[:, :, :3] / 255.0
+        blended[:, :, 3] = pixels[:, :, 3]
+        return blended
+
+    def test_matches_float_path_exhaustively(self):
+        """Test every (pixel, mask) pair against the float computation."""
+        import numpy as np
+
+        values = np.arange(256, dtype=np.uint8)
+        pixels = np.empty((256, 256, 4), dtype=np.uint8)
+        pixels[...] = values[:, None, None]
+        mask = np.empty((256, 256, 4), dtype=np.uint8)
+        mask[...] = values[None, :, None]
+        mask[:, :, 3] = 255
+
+        expected = self.float_blend(pixels, mask)
+
+        assert (blend_multiply(pixels, mask) == expected).all()
+
+    def test_works_in_place_with_scratch(self):
+        """Test that the result is written in the input array and scratch is reusable."""
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        scratch = np.empty((64, 32, 4), dtype=np.uint16)
+        for _ in range(2):
+            pixels = rng.integers(0, 256, (64, 32, 4), dtype=np.uint8)
+            mask = rng.integers(0, 256, (64, 32, 4), dtype=np.uint8)
+            mask[:, :, 3] = 255
+            expected = self.float_blend(pixels, mask)
+
+            result = blend_multiply(pixels, mask, scratch)
+
+            assert result is pixels
+            assert (pixels == expected).all()
+
+
+class TestTextCache:
+    """Tests for the font, text metrics and label bitmap caches."""
+
+    def test_load_font_is_shared(self, sample_config):
+        """Test that fonts are loaded once per path and size."""
+        path = sample_config["legend"]["font"]
+
+        assert load_font(path, 30) is load_font(path, 30)
+        assert load_font(path, 30) is not load_font(path, 31)
+        assert Legend(sample_config).font is Legend(sample_config).font
+
+    def test_load_font_missing(self, temp_dir):
+        """Test that a missing font is reported with its path."""
+        with pytest.raises(FileNotFoundError, match="Font file not found"):
+            load_font(str(temp_dir / "missing.ttf"), 30)
+
+    def test_text_bbox_matches_imagedraw(self, sample_config):
+        """Test that cached metrics are those of ImageDraw.textbbox."""
+        from PIL import ImageDraw
+
+        font = load_font(sample_config["legend"]["font"], 30)
+        draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+        for text, stroke in [("a", 1), ("Mark (A)", 2), ("Ýÿ'q", 0)]:
+            expected = draw.textbbox((0, 0), text, font=font, stroke_width=stroke)
+            assert text_bbox(font, text, stroke) == expected
+
+    @pytest.mark.parametrize(
+        "xy", [(10, 12), (30.5, 8.25), (0.3, 0.7), (-6, 5), (110, 40)]
+    )
+    def test_draw_label_matches_imagedraw(self, sample_config, xy):
+        """Test that labels are identical to ImageDraw.text, clipped or not."""
+        from PIL import ImageDraw
+
+        font = load_font(sample_config["legend"]["font"], 30)
+        expected = Image.new("RGBA", (160, 60), color=(0, 0, 0, 0))
+        ImageDraw.Draw(expected).text(
+            xy, "Mark (A)", fill="white", font=font, stroke_width=1, stroke_fill="black"
+        )
+
+        for _ in range(2):  # rendered, then from the bitmap cache
+            result = Image.new("RGBA", (160, 60), color=(0, 0, 0, 0))
+            draw_label(result, xy, "Mark (A)", font, 1)
+            assert result.tobytes() == expected.tobytes()
+
+
 class TestLegend:
     """Tests for Legend class."""
 
@@ -520,3 +1134,41 @@ class TestLegend:
 
         assert result.size == (2048, 2048)
         assert result.mode == "RGBA"
+
+    @pytest.mark.parametrize(
+        "position", [(100, 100), (0, 0), (1950, 1980), (850.5, 20)]
+    )
+    def test_legend_render_matches_full_layer(self, sample_config, position):
+        """The legend drawn on its own canvas matches a full-size layer."""
+        import numpy as np
+
+        legend = Legend(sample_config)
+        marks = {"Test Mark A": "A1", "Other Mark": "A2", "Test Mark B": "B1", "": "S"}
+
+        tile, origin = legend.render((2048, 2048), position, marks, 2)
+        assert tile.width < 1000 and tile.height < 300
+
+        # Reference: every step on a full-size layer
+        items, size = legend._layout(
+            Position(*position) + legend.inner_offset, marks, 2
+        )
+        expected = Image.new("RGBA", (2048, 2048), color=(0, 0, 0, 0))
+        for item_position, mark, rank in items:
+            legend._draw_legend_item(expected, item_position, mark, rank)
+        expected = drop_shadow(
+            expected, legend.shadow_offset, legend.shadow_color,
+            legend.shadow_iterations, engine=legend.shadow_engine,
+        )
+        expected = legend._draw_border(
+            expected, Position(*position), size + 2 * legend.inner_offset
+        )
+
+        result = np.asarray(legend.draw((2048, 2048), position, marks, 2))
+        expected = np.asarray(expected)
+        assert np.array_equal(result[:, :, 3], expected[:, :, 3])
+        visible = expected[:, :, 3] > 0
+        assert np.array_equal(result[visible], expected[visible])
+        assert np.array_equal(
+            result[origin[1]:origin[1] + tile.height, origin[0]:origin[0] + tile.width],
+            np.asarray(tile),
+        )
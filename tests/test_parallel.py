@@ -0,0 +1,254 @@
+"""Tests for the process-pool helpers and parallel batch commands."""
+
+import os
+
+import numpy as np
+import pytest
+
+from parallel import SharedArray, ZoneReport, run_pool, run_serial
+
+
+def _echo_worker(zone, spec):
+    """Double the shared array in place"""
+    shared = SharedArray.attach(spec)
+    try:
+        shared.array *= 2
+    finally:
+        shared.close()
+    return ZoneReport("ok")
+
+
+def _flaky_worker(zone):
+    if zone == "crash":
+        os._exit(1)
+    if zone == "error":
+        raise ValueError("bad zone")
+    return ZoneReport("ok")
+
+
+class TestSharedArray:
+    """Tests for SharedArray."""
+
+    def test_create_and_attach(self):
+        """Test that an attached array sees the creator's data."""
+        data = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+        shared = SharedArray.create(data)
+        try:
+            other = SharedArray.attach(shared.spec)
+            other.array[0, 0, 0] = 99
+            other.close()
+            assert shared.array[0, 0, 0] == 99
+            assert (shared.array[1] == data[1]).all()
+        finally:
+            shared.close()
+            shared.unlink()
+
+
+class TestRunPool:
+    """Tests for run_pool."""
+
+    def test_shared_memory_roundtrip(self):
+        """Test that workers write their results back through shared memory."""
+        results = {}
+
+        def prepare(zone):
+            shared = SharedArray.create(np.full((4, 4), zone, dtype=np.int32))
+            return (shared.spec,), shared
+
+        def finish(zone, report, shared):
+            results[zone] = shared.array.copy()
+            shared.close()
+            shared.unlink()
+            return report
+
+        report = run_pool([1, 2, 3], _echo_worker, 2, prepare=prepare, finish=finish)
+
+        assert all(r.status == "ok" for r in report.values())
+        assert [results[z][0, 0] for z in (1, 2, 3)] == [2, 4, 6]
+
+    def test_failures_are_isolated(self):
+        """Test that an exception or a crashed worker only fails its own zone."""
+        zones = ["a", "error", "b", "crash", "c", "d"]
+
+        report = run_pool(zones, _flaky_worker, 2)
+
+        assert list(report) == zones
+        assert report["error"].status == "failed"
+        assert "bad zone" in report["error"].error
+        assert report["crash"].status == "failed"
+        assert "crashed" in report["crash"].error
+        for zone in ("a", "b", "c", "d"):
+            assert report[zone].status == "ok"
+
+    def test_finish_failure_is_isolated(self):
+        """Test that finish raising only fails its own zone."""
+        zones = ["a", "b", "c", "d"]
+
+        def finish(zone, report, handle):
+            if zone == "b":
+                raise OSError("disk full")
+            return report
+
+        report = run_pool(zones, _flaky_worker, 2, finish=finish)
+
+        assert report["b"] == ZoneReport("failed", "OSError: disk full")
+        for zone in ("a", "c", "d"):
+            assert report[zone].status == "ok"
+
+    def test_handles_released_on_exit(self):
+        """Test that the handles of running zones are released when run_pool raises."""
+        prepared, finished = [], []
+
+        def prepare(zone):
+            prepared.append(zone)
+            return (), zone
+
+        def finish(zone, report, handle):
+            finished.append(handle)
+            return report
+
+        def progress(zone, report):
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            run_pool(
+                list("abcdef"), _flaky_worker, 2, prepare=prepare, finish=finish,
+                progress=progress,
+            )
+
+        assert len(prepared) > 1
+        assert sorted(finished) == sorted(prepared)
+
+    def test_serial_failures_are_isolated(self):
+        """Test that run_serial reports like run_pool, and calls progress for every zone."""
+        zones = ["a", "error", "b"]
+        progress = []
+
+        report = run_serial(zones, _flaky_worker, lambda *args: progress.append(args))
+
+        assert list(report) == zones
+        assert report["error"] == ZoneReport("failed", "ValueError: bad zone")
+        assert report["a"] == report["b"] == ZoneReport("ok")
+        assert progress == list(report.items())
+
+
+class TestParallelAnnotate:
+    """Tests for MapAnnotator.annotate_all with a process pool."""
+
+    def test_annotate_all_reports_per_zone(self, annotator_workspace):
+        """Test that a missing backup fails its zone without stopping the others."""
+        from annotate import MapAnnotator
+
+        missing = next(annotator_workspace.rglob("t1f200_m_backup.dds"))
+        missing.unlink()
+
+        report = MapAnnotator().annotate_all(workers=2)
+
+        assert set(report) == {"Test Zone", "Second Zone"}
+        assert report["Second Zone"].status == "failed"
+        assert "FileNotFoundError" in report["Second Zone"].error
+        assert report["Test Zone"].status == "ok"
+
+    def test_annotate_all_serial_matches_parallel(self, annotator_workspace):
+        """Test that maps rendered by workers are identical to serial ones."""
+        from PIL import Image
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        previews = {z: annotator._get_path(z, project=True, ext="png") for z in annotator._zones}
+
+        assert all(r.status == "ok" for r in annotator.annotate_all().values())
+        serial = {z: np.array(Image.open(p)) for z, p in previews.items()}
+        report = annotator.annotate_all(workers=2, force=True)
+        parallel = {z: np.array(Image.open(p)) for z, p in previews.items()}
+
+        assert all(r.status == "ok" for r in report.values())
+        for zone in serial:
+            assert (serial[zone] == parallel[zone]).all()
+
+
+class TestParallelBlend:
+    """Tests for MapAnnotator.blend_all with a process pool."""
+
+    def test_masks_are_decoded_once(self, annotator_workspace):
+        """Test that zones of the same expansion share one decoded mask."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        annotator._zones["Third Zone"] = dict(annotator._zones["Test Zone"])
+
+        mask = annotator._get_mask("Test Zone")
+
+        assert annotator._get_mask("Third Zone") is mask
+        assert mask.shape == (512, 512, 4)
+        assert (mask[:, :, 3] == 255).all()
+        assert not mask.flags.writeable
+
+    def test_blend_all_parallel_matches_serial(self, annotator_workspace):
+        """Test that blends computed by workers are identical to serial ones."""
+        from PIL import Image
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        blended = annotator_workspace / "project" / "Blended"
+
+        assert all(r.status == "ok" for r in annotator.blend_all().values())
+        serial = {z: np.array(Image.open(blended / f"{z}.png")) for z in annotator._zones}
+        report = annotator.blend_all(workers=2, force=True)
+        parallel = {z: np.array(Image.open(blended / f"{z}.png")) for z in annotator._zones}
+
+        assert all(r.status == "ok" for r in report.values())
+        for zone in serial:
+            assert (serial[zone] == parallel[zone]).all()
+
+    def test_blend_all_missing_mask_fails_zone(self, annotator_workspace):
+        """Test that a missing mask only fails the zones that need it."""
+        from annotate import MapAnnotator
+
+        (annotator_workspace / "project" / "Blended" / "masks" / "sb_mask.png").unlink()
+
+        report = MapAnnotator().blend_all(workers=2)
+
+        assert report["Test Zone"].status == "ok"
+        assert report["Second Zone"].status == "failed"
+        assert "Mask file not found" in report["Second Zone"].error
+
+    def test_shared_memory_failure_is_raised(self, annotator_workspace, monkeypatch):
+        """Test that failing to share a mask stops the run and releases the shared ones."""
+        from annotate import MapAnnotator
+        from parallel import SharedArray
+
+        created = []
+        create = SharedArray.create.__func__
+
+        def create_once(cls, array):
+            if created:
+                raise MemoryError("no shared memory left")
+            created.append(create(cls, array))
+            return created[-1]
+
+        monkeypatch.setattr(SharedArray, "create", classmethod(create_once))
+
+        with pytest.raises(MemoryError):
+            MapAnnotator().blend_all(workers=2)
+        with pytest.raises(FileNotFoundError):
+            SharedArray.attach((created[0]._shm.name, (1,), "u1"))
+
+
+class TestParallelBuild:
+    """Tests for MapAnnotator.build_all with a process pool."""
+
+    def test_build_all_parallel_matches_serial(self, annotator_workspace):
+        """Test that outputs built by workers are identical to serial ones."""
+        from annotate import MapAnnotator
+
+        annotator = MapAnnotator()
+        outputs = [p for z in annotator._zones for p in annotator._build_outputs(z, True)]
+
+        assert all(r.status == "ok" for r in annotator.build_all(composite=True).values())
+        serial = {path: path.read_bytes() for path in outputs}
+        report = annotator.build_all(workers=2, force=True, composite=True)
+
+        assert all(r.status == "ok" for r in report.values())
+        for path in outputs:
+            assert path.read_bytes() == serial[path], path
@@ -0,0 +1,219 @@
+"""Tests for the stage timings and the progress of the batch commands."""
+
+import io
+import json
+import time
+
+import pytest
+
+import profiling
+from parallel import ZoneReport
+
+
+class TestTracer:
+    """Tests for the stage tracer."""
+
+    def test_stage_is_noop_without_trace(self):
+        """Test that stages record nothing when no trace is running."""
+        with profiling.stage("idle"):
+            pass
+        assert profiling._tracer is None
+
+    def test_nested_stages(self):
+        """Test that nested stages inherit the zone and are excluded from self time."""
+        with profiling.trace() as tracer:
+            with profiling.stage("annotate", "Test Zone"):
+                with profiling.stage("drop_shadow"):
+                    time.sleep(0.02)
+                with profiling.stage("legend"):
+                    pass
+
+        spans = {span["name"]: span for span in tracer.spans}
+        assert set(spans) == {"annotate", "drop_shadow", "legend"}
+        assert {span["zone"] for span in tracer.spans} == {"Test Zone"}
+        outer = spans["annotate"]
+        assert outer["wall"] >= spans["drop_shadow"]["wall"] >= 0.02
+        assert outer["self"] == pytest.approx(
+            outer["wall"] - spans["drop_shadow"]["wall"] - spans["legend"]["wall"]
+        )
+        assert tracer.zones()["Test Zone"]["drop_shadow"] == spans["drop_shadow"]["wall"]
+
+    def test_traced_decorator(self):
+        """Test that decorated functions are timed only during a trace."""
+
+        @profiling.traced("work")
+        def work(value):
+            return value * 2
+
+        assert work(2) == 4
+        with profiling.trace() as tracer:
+            assert work(3) == 6
+        assert [span["name"] for span in tracer.spans] == ["work"]
+
+    def test_traces_dont_nest(self):
+        """Test that starting a trace within a trace is refused."""
+        with profiling.trace():
+            with pytest.raises(RuntimeError, match="already running"):
+                with profiling.trace():
+                    pass
+
+    def test_chrome_trace(self, temp_dir):
+        """Test the exported Chrome trace events."""
+        with profiling.trace() as tracer:
+            with profiling.stage("decode", "Test Zone"):
+                pass
+        path = temp_dir / "trace.json"
+        tracer.save(path)
+
+        with open(path, "rt", encoding="utf-8") as fp:
+            (event,) = json.load(fp)["traceEvents"]
+        assert event["name"] == "decode"
+        assert event["ph"] == "X"
+        assert event["args"]["zone"] == "Test Zone"
+        assert {"ts", "dur", "pid", "tid"} <= set(event)
+
+    def test_summary(self):
+        """Test that the summary has a row per stage, slowest first."""
+        with profiling.trace() as tracer:
+            for _ in range(2):
+                with profiling.stage("slow"):
+                    time.sleep(0.01)
+            with profiling.stage("fast"):
+                pass
+
+        assert tracer.stages()["slow"]["count"] == 2
+        lines = tracer.summary().splitlines()
+        assert lines[0].split()[:2] == ["stage", "count"]
+        assert [line.split()[0] for line in lines[1:]] == ["slow", "fast"]
+
+    def test_worker_spans_are_collected(self):
+        """Test that the spans flushed by a worker are merged into the trace."""
+        with profiling.trace() as tracer:
+            directory, memory = profiling.worker_args()
+            worker = profiling.Tracer(memory)
+            with worker.stage("annotate", "Test Zone"):
+                pass
+            worker.flush(f"{directory}/123.jsonl")
+        assert [span["name"] for span in tracer.spans] == ["annotate"]
+        assert worker.spans == []
+
+
+class TestMemoryTrace:
+    """Tests for the memory peaks of the stages."""
+
+    def test_stage_peaks(self):
+        """Test that allocations are attributed to their stage and its parents."""
+        import numpy as np
+
+        with profiling.trace(memory=True) as tracer:
+            with profiling.stage("annotate", "Test Zone"):
+                with profiling.stage("small"):
+                    np.ones(2**18, dtype=np.uint8)
+                with profiling.stage("large"):
+                    buffer = np.ones(2**23, dtype=np.uint8)
+                    del buffer
+
+        stages = tracer.stages()
+        assert stages["large"]["py_peak"] >= 2**23
+        assert stages["small"]["py_peak"] < 2**23
+        assert stages["annotate"]["py_peak"] >= stages["large"]["py_peak"]
+        assert "py peak" in tracer.summary().splitlines()[0]
+
+    @pytest.mark.skipif(profiling.rss() is None, reason="RSS isn't readable here")
+    def test_rss_samples(self):
+        """Test that the resident set size is sampled into counter events."""
+        with profiling.trace(memory=True) as tracer:
+            with profiling.stage("sleep"):
+                time.sleep(0.05)
+
+        assert tracer.stages()["sleep"]["rss_peak"] > 0
+        counters = [e for e in tracer.chrome_trace()["traceEvents"] if e["ph"] == "C"]
+        assert counters
+        assert counters[0]["name"] == "rss"
+        assert tracer.peak_rss() >= tracer.stages()["sleep"]["rss_peak"]
+
+    def test_memory_trace_stops_tracemalloc(self):
+        """Test that tracemalloc is only running during the trace."""
+        import tracemalloc
+
+        with profiling.trace(memory=True):
+            assert tracemalloc.is_tracing()
+        assert not tracemalloc.is_tracing()
+
+
+class TestProgress:
+    """Tests for the progress line of the batch commands."""
+
+    def test_progress_lines(self):
+        """Test that every zone is reported with the count, throughput and ETA."""
+        stream = io.StringIO()
+        progress = profiling.Progress(2, "annotate", stream)
+        progress.update("Zone A", ZoneReport("ok"))
+        progress.update("Zone B", ZoneReport("failed", "boom"))
+        progress.close()
+
+        first, second = stream.getvalue().splitlines()
+        assert first.startswith("annotate 1/2 50% ")
+        assert "zones/s ETA " in first
+        assert first.endswith("- Zone A")
+        assert second.endswith("- Zone B (failed)")
+
+
+class TestTracedCommands:
+    """Tests for the traces of the batch commands."""
+
+    def test_annotate_all_trace(self, annotator_workspace):
+        """Test that annotate_all saves the stages of every zone."""
+        from annotate import MapAnnotator
+
+        path = annotator_workspace / "trace.json"
+        MapAnnotator().annotate_all(trace=str(path))
+
+        with open(path, "rt", encoding="utf-8") as fp:
+            events = json.load(fp)["traceEvents"]
+        stages = {(event["name"], event["args"].get("zone")) for event in events}
+        for zone in ("Test Zone", "Second Zone"):
+            for name in ("annotate", "decode", "markers", "drop_shadow", "legend"):
+                assert (name, zone) in stages
+
+    def test_parallel_trace(self, annotator_workspace):
+        """Test that the stages run by pool workers end up in the trace."""
+        from annotate import MapAnnotator
+
+        path = annotator_workspace / "trace.json"
+        MapAnnotator().build_all(workers=2, trace=str(path))
+
+        with open(path, "rt", encoding="utf-8") as fp:
+            events = json.load(fp)["traceEvents"]
+        builds = [event for event in events if event["name"] == "build"]
+        assert {event["args"]["zone"] for event in builds} == {
+            "Test Zone",
+            "Second Zone",
+        }
+        assert {event["name"] for event in events} >= {"share", "multiply", "preview"}
+        assert len({event["pid"] for event in events}) > 1
+
+    def test_parallel_memory_trace(self, annotator_workspace):
+        """Test that pool workers report the memory peaks of their stages."""
+        from annotate import MapAnnotator
+
+        path = annotator_workspace / "trace.json"
+        MapAnnotator().annotate_all(workers=2, trace=str(path), trace_memory=True)
+
+        with open(path, "rt", encoding="utf-8") as fp:
+            events = json.load(fp)["traceEvents"]
+        annotations = [event for event in events if event["name"] == "annotate"]
+        assert len(annotations) == 2
+        assert all("py_peak_mb" in event["args"] for event in annotations)
+
+    def test_cli_progress_and_summary(self, annotator_workspace, monkeypatch, capsys):
+        """Test that the CLI shows the progress and prints the stage summary."""
+        import annotate
+
+        monkeypatch.setattr(annotate, "_CLI", True)
+        annotate.MapAnnotator().blend_all(trace=True)
+
+        captured = capsys.readouterr()
+        assert "blend 2/2 100%" in captured.err
+        assert "multiply" in captured.out
+        assert "2/2 zones done" in captured.out
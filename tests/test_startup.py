@@ -0,0 +1,86 @@
+"""Start-up budget of the CLI: heavy dependencies are only loaded by the commands using them."""
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Cumulative `import annotate` time in ms, about 4x what it takes on a laptop
+IMPORT_BUDGET_MS = 200
+
+HEAVY_MODULES = ["numpy", "PIL", "requests", "fire", "pyperclip", "yaml", "dds"]
+
+
+def run_python(code, cwd=REPO_ROOT, importtime=False):
+    env = dict(os.environ, PYTHONPATH=str(REPO_ROOT))
+    args = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", code]
+    result = subprocess.run(
+        args, cwd=cwd, env=env, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    return result
+
+
+def parse_importtime(stderr):
+    """Return {top level module: cumulative import time in us} from -X importtime"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.rstrip()] = int(cumulative)
+    return times
+
+
+def loaded_modules(code, cwd=REPO_ROOT):
+    result = run_python(code + "\nimport sys; print(*sys.modules)", cwd=cwd)
+    return set(result.stdout.splitlines()[-1].split())
+
+
+class TestStartup:
+    """Tests for the import cost of the CLI."""
+
+    def test_import_skips_heavy_dependencies(self):
+        """Test that importing annotate doesn't load any heavy dependency."""
+        modules = loaded_modules("import annotate")
+        assert "annotate" in modules
+        for name in HEAVY_MODULES:
+            assert name not in modules, f"{name} is imported by 'import annotate'"
+
+    def test_import_budget(self):
+        """Test that importing annotate fits the start-up budget."""
+        # Best of 3 runs, the first one may compile the modules
+        best = min(
+            parse_importtime(run_python("import annotate", importtime=True).stderr)[
+                " annotate"
+            ]
+            for _ in range(3)
+        )
+        assert best / 1000 < IMPORT_BUDGET_MS
+
+    def test_check_files_skips_heavy_dependencies(self, annotator_workspace):
+        """Test that a quick command run with a fresh snapshot loads no heavy dependency."""
+        code = "from annotate import MapAnnotator; MapAnnotator().check_files()"
+        run_python(code, cwd=annotator_workspace)  # builds the data snapshot
+        modules = loaded_modules(code, cwd=annotator_workspace)
+        for name in ["numpy", "PIL", "requests", "fire", "pyperclip", "yaml"]:
+            assert name not in modules, f"{name} is imported by check_files"
+
+    def test_cli_mode_is_set_by_main(self, monkeypatch, annotator_workspace):
+        """Test that MapAnnotator only reports in CLI mode when started by main()."""
+        import annotate
+
+        assert annotate.MapAnnotator()._iscli is False
+        monkeypatch.setattr(annotate, "_CLI", True)
+        assert annotate.MapAnnotator()._iscli is True
+
+    def test_cli_command(self, annotator_workspace):
+        """Test running a quick command through the CLI entry point."""
+        result = run_python(
+            "import sys; sys.argv = ['ffxiv-huntmaps', 'check_files']\n"
+            "import annotate; annotate.main()",
+            cwd=annotator_workspace,
+        )
+        assert "File check complete." in result.stdout
@@ -0,0 +1,137 @@
+"""Local stand-in for the xivapi endpoints used by ZoneApi.
+
+Serves `/search?indexes=PlaceName&string=<name>` and `/placename/<id>` for a set of
+zones, over a threaded HTTP server on localhost. Each request can be delayed, and the
+first requests of a path can be answered with an error status, to exercise the
+throughput and the retries of the concurrent fetcher offline. Run it directly to serve
+the zones of data/zone_info.yaml on port 8765.
+
+Responses carry an ETag, and a matching If-None-Match is answered with 304."""
+
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class XivApiServer:
+    """Mock xivapi serving `zones` {name: {"region", "scale", "filename"}}.
+
+    - latency: seconds slept before answering each request
+    - failures: {path: [status, ...]} answered, in order, to the first requests of path
+      (a path is the url without its query, e.g. "/search" or "/placename/1")
+
+    Use as a context manager; `url` is the base url to give ZoneApi. `requests` records
+    the (path, time) of every request, `not_modified` the paths answered with 304 and
+    `max_concurrency` the most requests handled at the same time."""
+
+    def __init__(self, zones, latency=0, failures=None, port=0):
+        self.zones = {
+            name: (i + 1, info) for i, (name, info) in enumerate(zones.items())
+        }
+        self.latency = latency
+        self.failures = {path: list(codes) for path, codes in (failures or {}).items()}
+        self.requests = []
+        self.not_modified = []
+        self.max_concurrency = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def respond(self, path, query):
+        """Return (status, payload) for a request"""
+        with self._lock:
+            self.requests.append((path, time.monotonic()))
+            failures = self.failures.get(path)
+            if failures:
+                return failures.pop(0), {"Error": True}
+        if path == "/search":
+            name = query.get("string", [""])[0]
+            results = [
+                {"Name": zone, "ID": zone_id, "Url": f"/placename/{zone_id}"}
+                for zone, (zone_id, _) in self.zones.items()
+                if name.lower() in zone.lower()
+            ]
+            return 200, {"Results": results}
+        for zone, (zone_id, info) in self.zones.items():
+            if path == f"/placename/{zone_id}":
+                filename = info["filename"]
+                return 200, {
+                    "Maps": [
+                        {
+                            "PlaceNameRegion": {"Name": info["region"]},
+                            "SizeFactor": info["scale"],
+                            "MapFilenameId": f"{filename[:-2]}/{filename[-2:]}",
+                        }
+                    ]
+                }
+        return 404, {"Error": True, "Message": "Not found"}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so pooled connections are reused
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server._lock:
+                    server._active += 1
+                    server.max_concurrency = max(server.max_concurrency, server._active)
+                try:
+                    time.sleep(server.latency)
+                    url = urlparse(self.path)
+                    status, payload = server.respond(url.path, parse_qs(url.query))
+                finally:
+                    with server._lock:
+                        server._active -= 1
+                body = json.dumps(payload).encode("utf-8")
+                etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    with server._lock:
+                        server.not_modified.append(url.path)
+                    status, body = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import yaml
+
+    with open("data/zone_info.yaml", "rt", encoding="utf-8") as fp:
+        zones = yaml.safe_load(fp)
+    server = XivApiServer(zones, port=8765)
+    print(f"Serving {len(zones)} zones on {server.url}")
+    server.serve_forever()